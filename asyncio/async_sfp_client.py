@@ -12,77 +12,691 @@ import sys
 import os
 import datetime
 import asyncio
+import collections
+import contextlib
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sfp.progress import TransferProgress, RangeProgress
+from sfp.ranges import splitRange
+from sfp.checksum import ChecksumError, chooseAlgorithm, newDigest
+from sfp.blobs import hashFile
+from sfp.compression import chooseMethod, worthCompressing, encodeBlock, decodeBlock, parseFrameHeader, \
+    FRAME_HEADER, BLOCK_SIZE, RAW
+from sfp.framing import VERSION_PREFIX, VERSION_ACCEPTED, HEADER, encodeMessage, parseHeader, decodeFields
+
+CHUNK_SIZE = 65536          # Receive buffer size
+SENDFILE_CHUNK = 1048576    # Bytes handed to each sendfile() call, one progress update each
+COMPRESSION_DEPTH = 4       # Blocks of an upload being compressed at once
+TREE_SEPARATOR = '__'       # Joins subdirectory names into the flat names of synced files
+
+compression_pool: ProcessPoolExecutor = None
+
+class RemoteFileNotFoundError(FileNotFoundError):
+    '''
+    Raised when the server answers NOTFOUND. Unlike a local FileNotFoundError,
+    the response has been read whole and the session can go on.
+    '''
+
+def compressionPool() -> ProcessPoolExecutor:
+    '''
+    Processes compressing and decompressing blocks, so that CPU-bound work
+    never runs in the event loop. Created on first use.
+    '''
+    global compression_pool
+    if compression_pool is None:
+        compression_pool = ProcessPoolExecutor()
+    return compression_pool
 
 class SFPClient:
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.reader = reader
         self.writer = writer
+        self.checksum: str = None   # Algorithm accepted by the server, None if disabled
+        self.compression: str = None    # Method accepted by the server, None if disabled
+        self.version = 1        # 2 once the server accepted binary framing
+        self.request_id = 0     # Id of the last command sent with binary framing
+        self.reply_id = 0       # and of the last response received
+
+    async def uploadFile(self, filename, filesize, progress=None, resume=False, dedupe=False):
+        '''
+        Uploads a file to the server, telling the user how it went.
+        :param resume: continue a partial upload left on the server by a previous connection
+        :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+        '''
+        response = await self.upload(filename, filesize, progress=progress, resume=resume, dedupe=dedupe)
+        if response == b'STORED\n':
+            print("File already on server, not transferred")
+        elif response == b'EXISTS\n':
+            print("File exists")
+        elif response != b'OK\n':
+            print("Server error")
 
-    async def uploadFile(self, filename, filesize):
-        command = f"U {filename} {filesize}\n".encode('utf-8')
-        self.writer.write(command)
-        await self.writer.drain()
-
-        can_tx = await self.reader.readline()
-        if can_tx == b'OK\n':
+    async def upload(self, filename, filesize=None, remote=None, progress=None, resume=False, dedupe=False) -> bytes:
+        '''
+        Uploads a file to the server.
+        :param filename: path of the local file
+        :param filesize: size of the local file, read from disk if None
+        :param remote: name of the file on the server, the name of the local file by default
+        :param resume: continue a partial upload left on the server by a previous connection
+        :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+        :return: b'OK\n' if the file has been sent, b'STORED\n' if the server had its content already,
+            b'EXISTS\n' if the server has a file with that name, b'ERROR\n' otherwise
+        :raise ChecksumError: if checksums are enabled and the server received something else
+        '''
+        if filesize is None:
+            filesize = os.path.getsize(filename)
+        if remote is None:
+            remote = filename
+        if dedupe:
+            announced = await self.announceFile(filename, filesize, remote)
+            if announced == b'OK\n':
+                return b'STORED\n'
+            elif announced == b'EXISTS\n':
+                return announced
+
+        verb = 'R' if resume else 'U'
+        await self.sendCommand(verb, remote, str(filesize))
+
+        can_tx = await self.readReply()
+        if can_tx == b'OK\n' or (resume and can_tx.rstrip(b'\n').isdigit()):
+            offset = 0 if can_tx == b'OK\n' else int(can_tx)   # Bytes already on the server
+            digest = newDigest(self.checksum) if self.checksum else None
             with open(filename, 'rb') as fd:
-                self.writer.write(fd.read())
-                await self.writer.drain()
+                fd.seek(offset)
+                await self.sendFromFile(fd, filesize - offset, progress, digest)
+            await self.checkDigest(digest)
+            return b'OK\n'
         elif can_tx == b'EXISTS\n':
-            print("File exists")
+            return can_tx
         else:
-            print("Server error")
-
-    async def downloadFile(self, filename, date):
-        command = f"D {filename} {date}\n".encode('utf-8')
-        self.writer.write(command)
-        await self.writer.drain()
-
-        response = await self.reader.readline()
-        if response == b'NOTFOUND\n':
+            return b'ERROR\n'
+
+    async def announceFile(self, filename, filesize, remote=None) -> bytes:
+        '''
+        Announces the digest of a file, so that a server with a deduplicating
+        store can create it without the upload. Hashing reads the local file once, in a thread.
+        :param remote: name of the file on the server, the name of the local file by default
+        :return: server response, b'OK\n' if the file has been created,
+            b'MISSING\n' if it has to be uploaded
+        '''
+        digest = await asyncio.get_running_loop().run_in_executor(None, hashFile, filename)
+        await self.sendCommand('A', remote or filename, str(filesize), digest)
+        return await self.readReply()
+
+    async def downloadFile(self, filename, date, progress=None, resume=False):
+        '''
+        Downloads a file from the server, telling the user how it went.
+        :param resume: if a partial copy of filename exists, only request the missing bytes
+        '''
+        try:
+            count = await self.download(filename, date, progress=progress, resume=resume)
+        except RemoteFileNotFoundError:
             print("File not found on server")
+            return
+        if count is None:
+            print("Server error")   # Also sent when offset is past the end of the remote file
+        else:
+            print(f"Received {count} bytes")
+
+    async def download(self, filename, date, local=None, progress=None, resume=False):
+        '''
+        Downloads a file from the server.
+        :param filename: name of the file on the server
+        :param date: day the file has been uploaded, as yyyymmdd
+        :param local: path of the local copy, filename by default
+        :param resume: if a partial copy exists, only request the missing bytes
+        :return: number of bytes received, None if the server refused the request
+        :raise RemoteFileNotFoundError: if the server has no such file
+        :raise ChecksumError: if checksums are enabled and the file arrived corrupted
+        '''
+        if local is None:
+            local = filename
+        offset = os.path.getsize(local) if resume and os.path.exists(local) else 0
+        if offset:
+            await self.sendCommand('D', filename, date, str(offset))
+        else:
+            await self.sendCommand('D', filename, date)
 
+        response = await self.readReply()
+        if response == b'NOTFOUND\n':
+            raise RemoteFileNotFoundError(f"{filename} of {date} not found on server")
         elif response == b'ERROR\n':
-            print("Server error")
-
+            return None
+
+        count = int(response.split()[0])   # Ranged responses also carry the whole file size
+
+        digest = newDigest(self.checksum) if self.checksum else None
+        with open(local, 'ab' if offset else 'wb') as fd:
+            await self.readToFile(fd, count, progress, digest)
+        await self.checkDigest(digest)
+        return count
+
+    async def listFiles(self, date):
+        '''
+        :param date: day to list, as yyyymmdd
+        :return: names of the files uploaded that day, None if there are none
+        '''
+        await self.sendCommand('L', date)
+        if self.version == 2:
+            fields = await self.readFields()    # One field per file, names may contain ", "
         else:
-            filesize = int(response.decode('utf-8'))
-
-            with open(filename, 'wb') as fd:
-                fd.write(await self.reader.readexactly(filesize))
-            print(f"Received {filesize} bytes")
+            fields = (await self.reader.readline()).decode('utf-8').rstrip('\n').split(', ')
+        if fields in (['NOTFOUND'], ['ERROR']):
+            return None
+        return [name for name in fields if name]
+
+    async def readToFile(self, fd, n, progress=None, digest=None):
+        '''
+        Reads exactly n bytes from the stream and writes them to fd,
+        one chunk at a time, so memory usage doesn't depend on n.
+        Writes run in a thread, not to block the event loop on the disk.
+        :param fd: binary file object to write to
+        :param n: number of bytes to transfer
+        :param progress: optional callback, called as progress(transferred, n)
+        :param digest: optional hash object, updated with every chunk
+        '''
+        if self.compression:
+            return await self.readFramesToFile(fd, n, progress, digest)
+
+        loop = asyncio.get_running_loop()
+        received = 0
+        while received < n:
+            chunk = await self.reader.read(min(n - received, CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', n - received)
+            await loop.run_in_executor(None, fd.write, chunk)
+            if digest: digest.update(chunk)
+            received += len(chunk)
+            if progress: progress(received, n)
+
+    async def sendFromFile(self, fd, n, progress=None, digest=None):
+        '''
+        Sends n bytes of fd through the stream, using sendfile when available.
+        :param fd: binary file object to read from, at its current position
+        :param n: number of bytes to transfer
+        :param progress: optional callback, called as progress(transferred, n)
+        :param digest: optional hash object, updated with every chunk.
+            Bytes have to pass through user space then, so sendfile isn't used, and are read in a thread
+        '''
+        if self.compression:
+            return await self.sendFramesFromFile(fd, n, progress, digest)
+
+        loop = asyncio.get_running_loop()
+        offset = fd.tell()
+        sent = 0
+        while sent < n:
+            if digest:
+                chunk = await loop.run_in_executor(None, fd.read, min(n - sent, CHUNK_SIZE))
+                digest.update(chunk)
+                self.writer.write(chunk)
+                await self.writer.drain()
+                length = len(chunk)
+            else:
+                length = await loop.sendfile(self.writer.transport, fd, offset + sent, min(n - sent, SENDFILE_CHUNK))
+            if not length:
+                raise EOFError(f"{fd.name} is shorter than {n} bytes")
+            sent += length
+            if progress: progress(sent, n)
+
+    async def readFramesToFile(self, fd, n, progress=None, digest=None):
+        '''
+        Reads the frames carrying n bytes of a file (see sfp/compression.py),
+        decompresses them in the process pool and writes them to fd.
+        :raise ValueError: if a frame is invalid
+        '''
+        loop = asyncio.get_running_loop()
+        received = 0
+        while received < n:
+            flag, length = parseFrameHeader(await self.reader.readexactly(FRAME_HEADER.size))
+            block = await self.reader.readexactly(length)
+            if flag != RAW:
+                block = await loop.run_in_executor(compressionPool(), decodeBlock, self.compression, flag, block)
+            if received + len(block) > n:
+                raise ValueError(f"{received + len(block) - n} bytes more than announced")
+            await loop.run_in_executor(None, fd.write, block)
+            if digest: digest.update(block)
+            received += len(block)
+            if progress: progress(received, n)
+
+    async def sendFramesFromFile(self, fd, n, progress=None, digest=None):
+        '''
+        Sends n bytes of fd as frames (see sfp/compression.py).
+        Up to COMPRESSION_DEPTH blocks are compressed in the process pool
+        while the previous ones are being sent.
+        '''
+        loop = asyncio.get_running_loop()
+        method = self.compression
+        pending = collections.deque()
+        read = sent = 0
+        while sent < n:
+            while read < n and len(pending) < COMPRESSION_DEPTH:
+                block = await loop.run_in_executor(None, fd.read, min(n - read, BLOCK_SIZE))
+                if not block:
+                    raise EOFError(f"{fd.name} is shorter than {n} bytes")
+                if digest: digest.update(block)
+                if not read and not await loop.run_in_executor(compressionPool(), worthCompressing, fd.name, block):
+                    method = None   # Raw frames from now on, compressing isn't worth the CPU
+
+                if method:
+                    frame = loop.run_in_executor(compressionPool(), encodeBlock, method, block)
+                else:
+                    frame = loop.create_future()
+                    frame.set_result(encodeBlock(None, block))
+                pending.append((frame, len(block)))
+                read += len(block)
+
+            frame, length = pending.popleft()
+            self.writer.write(await frame)
+            await self.writer.drain()
+            sent += length
+            if progress: progress(sent, n)
+
+    async def uploadRange(self, filename, filesize, offset, count, progress=None) -> bytes:
+        '''
+        Uploads bytes [offset; offset + count) of a file, as part of a parallel upload.
+        :return: server response, b'OK\n' if the range has been sent
+        '''
+        await self.sendCommand('U', filename, str(filesize), str(offset), str(count))
+
+        response = await self.readReply()
+        if response == b'OK\n':
+            digest = newDigest(self.checksum) if self.checksum else None
+            with open(filename, 'rb') as fd:
+                fd.seek(offset)
+                await self.sendFromFile(fd, count, progress, digest)
+            await self.checkDigest(digest)
+        return response
+
+    async def downloadRange(self, filename, date, offset, count, progress=None):
+        '''
+        Downloads bytes [offset; offset + count) of a file into the same range
+        of the local copy, as part of a parallel download.
+        The local file must already exist unless count is 0.
+        :return: size of the whole remote file, None if it can't be downloaded
+        '''
+        await self.sendCommand('D', filename, date, str(offset), str(count))
+
+        response = await self.readReply()
+        if response in (b'NOTFOUND\n', b'ERROR\n'):
+            return None
+
+        count, filesize = map(int, response.split())
+        digest = newDigest(self.checksum) if self.checksum else None
+        if count:
+            with open(filename, 'r+b') as fd:
+                fd.seek(offset)
+                await self.readToFile(fd, count, progress, digest)
+        await self.checkDigest(digest)
+        return filesize
 
     async def sendTextCommand(self, command: str, payload: str = None) -> str:
-        command += f" {payload}\n"
-
-        self.writer.write(command.encode('utf-8'))
+        if payload is not None:     # Q, H and S take no argument
+            command += f" {payload}"
+
+        await self.sendCommand(*command.split(' '))
+        return await self.recvResponse(command, self.request_id)
+
+    async def sendBatch(self, commands) -> list:
+        '''
+        Pipelines commands: sends all of them at once, then reads the responses
+        in order, paying a single round trip instead of one per command.
+        Uploads can't be pipelined, they wait for the server's go-ahead.
+        :param commands: command lines without the trailing LF, e.g. "L 20201019".
+            D commands download the whole file, saved with its remote name
+        :return: list of responses, as returned by sendTextCommand
+        '''
+        for command in commands:
+            if command[0] in ('U', 'R') or (command[0] == 'D' and len(command.split(' ')) != 3):
+                raise ValueError(f"Command can't be pipelined: {command}")
+
+        batch = []
+        request_ids = []
+        for command in commands:
+            batch.append(self.encodeCommand(*command.split(' ')))
+            request_ids.append(self.request_id)
+        self.writer.write(b''.join(batch))
         await self.writer.drain()
-        if command[0] == 'H':
-            response = await self.reader.readuntil(b'\n\n')
+        return [await self.recvResponse(command, request_id) for command, request_id in zip(commands, request_ids)]
+
+    async def recvResponse(self, command: str, request_id: int = None) -> str:
+        '''
+        Receives the response to a command, and the file that follows it for downloads.
+        :param request_id: id the response must carry, with binary framing
+        :raise ValueError: if the response answers another command
+        '''
+        if self.version == 1 and command[0] in ('H', 'S'):
+            return (await self.reader.readuntil(b'\n\n')).decode('utf-8')
+
+        if self.version == 1:
+            response = await self.readReply()
         else:
-            response = await self.reader.readline()
+            fields = await self.readFields()
+            if request_id is not None and self.reply_id != request_id:
+                raise ValueError(f"Response to command {self.reply_id}, expected {request_id}")
+            if command[0] in ('H', 'S'):
+                return fields[0]    # Help text or statistics, LF terminated already
+            separator = ', ' if command[0] == 'L' else ' '
+            response = (separator.join(fields) + "\n").encode('utf-8')
+        if command[0] == 'D' and response[:1].isdigit():
+            digest = newDigest(self.checksum) if self.checksum else None
+            with open(command.split(' ')[1], 'wb') as fd:
+                await self.readToFile(fd, int(response.split()[0]), digest=digest)
+            await self.checkDigest(digest)
         return response.decode('utf-8')
 
-    async def auth(self, user: str) -> bool:
+    async def enableExtensions(self, *extensions) -> bool:
+        '''
+        Enables protocol extensions for the rest of the session:
+        a checksum algorithm (see sfp/checksum.py) and/or a compression method (see sfp/compression.py).
+        :param extensions: names of the extensions, e.g. 'blake2b', 'zlib'
+        :return: True if the server supports all of them
+        '''
+        await self.sendCommand('E', *extensions)
+        accepted = (await self.readReply()).decode('utf-8').split()[1:]
+        self.checksum = chooseAlgorithm(accepted)
+        self.compression = chooseMethod(accepted)
+        return set(extensions) <= set(accepted)
+
+    async def checkDigest(self, digest) -> None:
+        '''
+        Receives the digest trailer of a payload and compares it with the local one.
+        :param digest: hash object fed with the payload, None if checksums are disabled
+        :raise ChecksumError: if the two digests differ
+        '''
+        if digest is None:
+            return
+        remote = (await self.readReply()).decode('utf-8').rstrip('\n')
+        if remote != digest.hexdigest():
+            raise ChecksumError(f"{self.checksum} mismatch: local {digest.hexdigest()}, server {remote}")
+
+    async def auth(self, user: str, version: int = 1) -> bool:
+        '''
+        :param version: 2 to ask for binary framing, see sfp/framing.py.
+            The session stays on text lines if the server doesn't support it
+        '''
+        if version == 2:
+            user = VERSION_PREFIX + user
         self.writer.write(user.encode('utf-8') + b'\n')
         await self.writer.drain()
 
         auth_result = await self.reader.readline()
-        if auth_result == b'OK\n':
+        if auth_result == VERSION_ACCEPTED:
+            self.version = 2
+            return True
+        elif auth_result == b'OK\n':
             return True
         else:
             return False
 
-async def main(host, port):
+    def encodeCommand(self, verb: str, *arguments: str) -> bytes:
+        '''
+        Encodes a command as text line or binary message, depending on the session.
+        '''
+        if self.version == 1:
+            return (" ".join([verb, *arguments]) + "\n").encode('utf-8')
+        self.request_id += 1
+        return encodeMessage(verb, self.request_id, arguments)
+
+    async def sendCommand(self, verb: str, *arguments: str) -> None:
+        self.writer.write(self.encodeCommand(verb, *arguments))
+        await self.writer.drain()
+
+    async def readFields(self) -> list:
+        '''
+        Reads a binary message and records its request id.
+        :return: fields of the message
+        '''
+        verb, count, self.reply_id, length = parseHeader(await self.reader.readexactly(HEADER.size))
+        return decodeFields(await self.reader.readexactly(length), count)
+
+    async def readReply(self) -> bytes:
+        '''
+        Reads a single line response, or a binary message rendered as such a line
+        (fields separated by spaces), so that both versions compare the same.
+        '''
+        if self.version == 1:
+            return await self.reader.readline()
+        return (" ".join(await self.readFields()) + "\n").encode('utf-8')
+
+    @classmethod
+    async def connect(cls, host, port, user, extensions=(), version=1) -> 'SFPClient':
+        '''
+        Opens an authenticated connection.
+        :param extensions: protocol extensions to enable, e.g. ('blake2b', 'zlib')
+        :param version: 2 to ask for binary framing
+        :raise ConnectionRefusedError: if the server doesn't accept user
+        '''
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        if not await client.auth(user, version):
+            writer.close()
+            await writer.wait_closed()
+            raise ConnectionRefusedError(f"Authentication of {user} failed")
+        if extensions and not await client.enableExtensions(*extensions):
+            writer.close()
+            await writer.wait_closed()
+            raise ConnectionRefusedError(f"Server doesn't support {' '.join(extensions)}")
+        return client
+
+    async def close(self):
+        '''
+        Says goodbye to the server and closes the connection.
+        '''
+        await self.sendTextCommand('Q')
+        self.writer.close()
+        await self.writer.wait_closed()
+
+def remoteName(relative_path: str) -> str:
+    '''
+    Name a file of a synced tree gets on the server. Working directories are flat,
+    so subdirectories become part of the name: notes/week1.txt is uploaded as notes__week1.txt.
+    '''
+    return TREE_SEPARATOR.join(pathlib.PurePath(relative_path).parts)
+
+def listTree(root) -> list:
+    '''
+    :return: paths of the files under root, relative to it
+    '''
+    files = []
+    for directory, _, names in os.walk(root):
+        files.extend(os.path.relpath(os.path.join(directory, name), root) for name in names)
+    return files
+
+class SFPPool:
+    '''
+    Authenticated connections to a server, shared by concurrent tasks.
+    Connections are opened when needed, up to size, and reused by later calls:
+
+        async with SFPPool('localhost', 9999, 'rossi mario', size=8) as pool:
+            await pool.syncTree('homework')
+            print(await pool.list())
+    '''
+    def __init__(self, host, port, user, size=4, extensions=(), version=1):
+        '''
+        :param size: maximum number of connections, i.e. of calls running at once
+        :param extensions: protocol extensions enabled on every connection, e.g. ('blake2b', 'zlib')
+        :param version: 2 to ask for binary framing on every connection
+        '''
+        self.host = host
+        self.port = port
+        self.user = user
+        self.size = size
+        self.extensions = extensions
+        self.version = version
+        self._idle = []     # Connected clients waiting for a call
+        self._slots = asyncio.Semaphore(size)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        '''
+        Lends a connection for a sequence of calls, opening one if none is idle.
+        Connections left in an unknown state by an error are closed, not returned to the pool.
+        '''
+        async with self._slots:
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                client = await SFPClient.connect(self.host, self.port, self.user, self.extensions, self.version)
+            try:
+                yield client
+            except (RemoteFileNotFoundError, ChecksumError):
+                self._idle.append(client)   # The response has been read whole, the session goes on
+                raise
+            except BaseException:
+                client.writer.close()
+                raise
+            self._idle.append(client)
+
+    async def upload(self, filename, remote=None, progress=None, dedupe=False) -> bytes:
+        '''
+        Uploads a file, see SFPClient.upload.
+        '''
+        async with self.connection() as client:
+            return await client.upload(filename, remote=remote, progress=progress, dedupe=dedupe)
+
+    async def download(self, filename, date=None, local=None, progress=None):
+        '''
+        Downloads a file, see SFPClient.download.
+        :param date: day the file has been uploaded, as yyyymmdd, today by default
+        '''
+        date = date or datetime.datetime.now().strftime("%Y%m%d")
+        async with self.connection() as client:
+            return await client.download(filename, date, local, progress)
+
+    async def list(self, date=None):
+        '''
+        :param date: day to list, as yyyymmdd, today by default
+        :return: names of the files uploaded that day, None if there are none
+        '''
+        date = date or datetime.datetime.now().strftime("%Y%m%d")
+        async with self.connection() as client:
+            return await client.listFiles(date)
+
+    async def syncTree(self, root, dedupe=False) -> dict:
+        '''
+        Uploads every file under root that today's directory on the server doesn't have,
+        as many at once as the pool has connections. Names listed on the server
+        are skipped without sending them a request.
+        :param dedupe: announce the files' digests, skip those whose content the server holds
+        :return: dict mapping paths relative to root to the response of their upload
+            (see SFPClient.upload), b'EXISTS\n' for skipped files, or the exception
+            an upload raised (e.g. ChecksumError)
+        '''
+        listed = set(await self.list() or ())
+        files = await asyncio.get_running_loop().run_in_executor(None, listTree, root)
+
+        async def syncOne(relative_path):
+            remote = remoteName(relative_path)
+            if remote in listed:
+                return b'EXISTS\n'
+            return await self.upload(os.path.join(root, relative_path), remote, dedupe=dedupe)
+
+        responses = await asyncio.gather(*(syncOne(path) for path in files), return_exceptions=True)
+        return dict(zip(files, responses))
+
+    async def close(self):
+        '''
+        Says goodbye on every idle connection and closes it.
+        '''
+        while self._idle:
+            await self._idle.pop().close()
+
+    async def __aenter__(self) -> 'SFPPool':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+async def parallelUpload(host, port, user, filename, streams, progress=None, extensions=(), dedupe=False,
+                         version=1) -> bool:
+    '''
+    Uploads a file splitting it in byte ranges, each one sent over its own connection.
+    :param streams: maximum number of concurrent connections
+    :param extensions: protocol extensions enabled on every connection, e.g. ('blake2b', 'zlib')
+    :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+    :param version: 2 to ask for binary framing on every connection
+    :return: True if the whole file has been uploaded
+    '''
+    filesize = os.path.getsize(filename)
+    if dedupe:
+        client = await SFPClient.connect(host, port, user, version=version)
+        announced = await client.announceFile(filename, filesize)
+        await client.close()
+        if announced == b'OK\n':
+            print("File already on server, not transferred")
+            return True
+    if not filesize:    # No range to upload, the server refuses empty ones
+        client = await SFPClient.connect(host, port, user, extensions, version)
+        response = await client.upload(filename, filesize, progress=progress)
+        await client.close()
+        if response != b'OK\n':
+            print("File exists" if response == b'EXISTS\n' else "Server error")
+        return response == b'OK\n'
+    combined = RangeProgress(progress, filesize)
+
+    async def uploadOne(offset, count):
+        client = await SFPClient.connect(host, port, user, extensions, version)
+        response = await client.uploadRange(filename, filesize, offset, count, combined.forRange(offset))
+        await client.close()    # Once Q is answered, the server is done with the range
+        return response
+
+    responses = await asyncio.gather(*(uploadOne(*r) for r in splitRange(filesize, streams)))
+
+    if all(response == b'OK\n' for response in responses):
+        return True
+    print("File exists" if b'EXISTS\n' in responses else "Server error")
+    return False
+
+async def parallelDownload(host, port, user, filename, date, streams, progress=None, extensions=(),
+                           version=1) -> bool:
+    '''
+    Downloads a file splitting it in byte ranges, each one received over its own connection.
+    :param streams: maximum number of concurrent connections
+    :param extensions: protocol extensions enabled on every connection, e.g. ('blake2b', 'zlib')
+    :param version: 2 to ask for binary framing on every connection
+    :return: True if the whole file has been downloaded
+    '''
+    client = await SFPClient.connect(host, port, user, extensions, version)
+    filesize = await client.downloadRange(filename, date, 0, 0)    # Only asks for the size
+    await client.close()
+    if filesize is None:
+        print("File not found on server")
+        return False
+
+    with open(filename, 'wb') as fd:
+        fd.truncate(filesize)
+    combined = RangeProgress(progress, filesize)
+
+    async def downloadOne(offset, count):
+        client = await SFPClient.connect(host, port, user, extensions, version)
+        received = await client.downloadRange(filename, date, offset, count, combined.forRange(offset))
+        await client.close()
+        return received
+
+    results = await asyncio.gather(*(downloadOne(*r) for r in splitRange(filesize, streams)))
+
+    if None in results:
+        print("Server error")
+        return False
+    print(f"Received {filesize} bytes")
+    return True
+
+async def main(host, port, streams=1, extensions=(), dedupe=False, version=1):
     reader, writer = await asyncio.open_connection(host, port)
 
     client = SFPClient(reader, writer)
 
     logged = True
     user = input("What's your name?")
-    if not await client.auth(user):
+    if not await client.auth(user, version):
         print("User authentication error")
         logged = False
+    elif extensions and not await client.enableExtensions(*extensions):
+        print(f"Server doesn't support {' '.join(extensions)}")
+        logged = False
 
     while logged:
         command = input(">> ")
@@ -95,19 +709,29 @@ async def main(host, port):
                 print("This file doesn't exist")
                 continue
 
-            await client.uploadFile(filename, filesize)
+            if streams > 1:
+                await parallelUpload(host, port, user, filename, streams, TransferProgress(filename), extensions,
+                                 dedupe, version)
+            else:
+                await client.uploadFile(filename, filesize, TransferProgress(filename), resume=True, dedupe=dedupe)
 
         elif command[0] == 'D':
             dirname = input("What day did you upload the file?(yyyymmdd) ")
             if not dirname: dirname = datetime.datetime.now().strftime("%Y%m%d")
             filename = input("Enter filename: ")
+            resume = False
             if os.path.exists(filename):
-                overwrite = input("File exists. Overwrite?[y/n] ")
-                if overwrite != 'y':
+                choice = input("File exists. Resume, overwrite or abort?[r/o/n] ")
+                if choice not in ('r', 'o'):
                     print("File download aborted")
                     continue
+                resume = choice == 'r'
 
-            await client.downloadFile(filename, dirname)
+            if streams > 1 and not resume:
+                await parallelDownload(host, port, user, filename, dirname, streams, TransferProgress(filename),
+                                   extensions, version)
+            else:
+                await client.downloadFile(filename, dirname, TransferProgress(filename), resume)
 
         elif command[0] == 'L':
             dirname = input("What day do you want to search for?(yyyymmdd) ")
@@ -131,7 +755,19 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", metavar="host", type=str, default='localhost', required=False)
     parser.add_argument("--port", metavar="port", type=int, default=9999, required=False)
+    parser.add_argument("--streams", metavar="streams", type=int, default=1, required=False,
+                        help="connections used to transfer each file in parallel")
+    parser.add_argument("--checksum", metavar="algorithm", type=str, default=None, required=False,
+                        help="verify every transfer with a digest, e.g. blake2b or sha256")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="skip uploads of files whose content the server already holds")
+    parser.add_argument("--compression", metavar="method", type=str, default=None, required=False,
+                        help="compress transfers with zlib, bz2 or lzma")
+    parser.add_argument("--protocol", metavar="version", type=int, choices=(1, 2), default=1, required=False,
+                        help="2 to use binary framing, if the server supports it")
 
     args = parser.parse_args(sys.argv[1:])
 
-    asyncio.run(main(args.host, args.port))
\ No newline at end of file
+    asyncio.run(main(args.host, args.port, args.streams,
+                     [name for name in (args.checksum, args.compression) if name], args.dedupe,
+                     args.protocol))
\ No newline at end of file
@@ -5,163 +5,284 @@ Students File Protocol server implementation.
 Using non-blocking IO model and asyncio.
 
 Protocol is defined in README.md of this /students_file_transfer.
+Sessions are implemented by sfp/protocol.py, this server performs their I/O.
 '''
 
 import os
 import logging
 import argparse
 import sys
-import datetime as dt
 import asyncio
+import collections
+import functools
+import signal
+import socket
+import time
+import multiprocessing
+import multiprocessing.connection
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sfp.protocol import ServerSession, NeedData, Send, Disk, OpenFile, Write, Decode, SendFile, CloseFile, \
+    Profile, Close, TruncatedFileError, request_log
+from sfp.compression import worthCompressing, encodeBlock, decodeBlock, BLOCK_SIZE
+from sfp.shaping import AsyncTransferGate
+from sfp.serving import CHUNK_SIZE, context, profiler, limits, addServerOptions, configureServer
+from sockutil.logqueue import addLoggingOptions, configureFromOptions
 
 __author__ = 'Giulio Corradini'
 
-def sanitizeInput(user_input: str, type = "str"):
-    '''
-    Sanitizes user input for path and dates.
-    :param input: string to santize.
-    :param type: "str" or "date", defines the sanity check method.
-    :return: input without paths for str.
-        True/False if date is valid.
-    '''
-    if type == "str":
-        head, tail = os.path.split(user_input)
-        return tail.strip().strip('.')  # Remove leading/trailing spaces and dots
-    elif type == "date":
-        try:
-            dt.datetime.strptime(user_input, "%Y%m%d")
-            return True
-        except ValueError:
-            return False
-
-
-client_counter = 0
-
-async def async_sfp_client_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    global client_counter
-    this_client = 0
-    client_counter += 1
-
-    logging.info(f"Client {client_counter} connected")
-    user_auth_str = await reader.readline()
-    user = sanitizeInput(user_auth_str.decode().rstrip('\n'))
-
-    if not user:
-        writer.write(b'ERROR\n')
-        await writer.drain()
-        logging.warning("Sent an invalid sequence as login name. Forcing disconnection")
-        return
-
-    else:
-        writer.write(b'OK\n')
-        await writer.drain()
+WRITE_BUFFER_HIGH = 262144  # Transport buffer size that pauses a download until the client catches up,
+WRITE_BUFFER_LOW = 65536    # and size it has to drain to before the download resumes
+COMPRESSION_DEPTH = 4   # Blocks of a download being compressed at once
+RESTART_DELAY = 1.0     # Seconds between restarts of a worker that keeps dying
+SHUTDOWN_TIMEOUT = 10.0     # Seconds given to workers to exit before killing them
+LOG_FORMAT = "%(asctime)s\t%(levelname)s\t%(processName)s\t%(threadName)s\t%(message)s"
 
-        working_directory = dt.datetime.today().strftime("%Y%m%d") + user
-        if not os.path.exists(working_directory):
-            os.mkdir(working_directory)
+compression_pool: ProcessPoolExecutor = None
+file_pool: ThreadPoolExecutor = None    # Threads doing every filesystem call, sized with --file-threads
+write_buffer_limits = (WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)     # Set with --write-high and --write-low
 
-        logging.debug("{} logged in".format(user))
-
-    while True:
-
-        raw_cmd = await reader.readline()
-        command = raw_cmd.decode('utf-8').rstrip('\n').split(' ', 3)
-
-        # Parse commands
-        if command[0] == 'U':
-            filename, filesize = command[1:]
-
-            try:
-                filesize = int(filesize)
-            except ValueError:
-                writer.write(b'ERROR\n')
-                await writer.drain()
-
-            filename = sanitizeInput(filename)
-
-            path = os.path.join(working_directory, filename)
+async def inFilePool(function, *args, **kwargs):
+    '''
+    Runs a blocking filesystem call in the file pool, so that a slow disk
+    stalls the client waiting for it but never the event loop.
+    :return: what function returns
+    '''
+    call = functools.partial(function, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(file_pool, call)
 
-            if os.path.exists(path):
-                writer.write(b'EXISTS\n')
-                await writer.drain()
-                continue
-            else:
-                writer.write(b'OK\n')
-                await writer.drain()
-                with open(path, 'bw') as fd:
-                    fd.write(await reader.readexactly(filesize))
-
-                logging.info(f"{user} uploaded a file: {filename}")
-
-        elif command[0] == 'D':
-            fname, date = command[1:]
-            fname = sanitizeInput(fname)
-            if not sanitizeInput(date, type="date"):
-                writer.write(b'ERROR\n')
-                await writer.drain()
-                continue
+def writeChunk(fd, chunk: bytes, digest=None) -> None:
+    fd.write(chunk)
+    if digest: digest.update(chunk)
 
-            found = None
-            for dirpath, _, filenames in os.walk(f"{date}{user}"):
-                if fname in filenames:
-                    found = os.path.join(dirpath, fname)
+def readChunk(fd, n: int, digest=None) -> bytes:
+    chunk = fd.read(n)
+    if digest: digest.update(chunk)
+    return chunk
 
-            if found:
-                filesize = os.stat(found).st_size
-                writer.write(f"{filesize}\n".encode('utf-8'))
-                with open(found, 'rb') as fd:
-                    writer.write(fd.read())
+def compressionPool() -> ProcessPoolExecutor:
+    '''
+    Processes compressing and decompressing blocks, so that CPU-bound work
+    never runs in the event loop. Created on first use, shut down by main().
+    They're started by a fork server (or spawned where there's none), never forked
+    from the server itself: they would inherit its listening socket and connections,
+    and keep the port bound if they outlived it.
+    '''
+    global compression_pool
+    if compression_pool is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        compression_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+    return compression_pool
+
+async def sendFramesFromFile(writer: asyncio.StreamWriter, fd, offset: int, n: int, digest, compression: str,
+                             user=None, stats=None):
+    '''
+    Sends n bytes of fd starting from offset as frames (see sfp/compression.py).
+    Up to COMPRESSION_DEPTH blocks are compressed in the process pool
+    while the previous ones are being sent.
+    '''
+    loop = asyncio.get_running_loop()
+    await inFilePool(fd.seek, offset)
+    method = compression
+    pending = collections.deque()
+    remaining = n
+    while remaining > 0 or pending:
+        while remaining > 0 and len(pending) < COMPRESSION_DEPTH:
+            block = await inFilePool(readChunk, fd, min(remaining, BLOCK_SIZE), digest)
+            if not block:
+                raise TruncatedFileError(f"{fd.name} is shorter than {offset + n} bytes")
+            if remaining == n and not await loop.run_in_executor(compressionPool(), worthCompressing, fd.name, block):
+                method = None   # Raw frames from now on, compressing isn't worth the CPU
+
+            if method:
+                frame = loop.run_in_executor(compressionPool(), encodeBlock, method, block)
             else:
-                writer.write(b'NOTFOUND\n')
+                frame = loop.create_future()
+                frame.set_result(encodeBlock(None, block))
+            pending.append(frame)
+            remaining -= len(block)
+
+        frame = await pending.popleft()
+        writer.write(frame)
+        if stats: stats.sent += len(frame)
+        await writer.drain()
+        await limits.paceAsync(user, len(frame))
 
+async def sendFromFile(writer: asyncio.StreamWriter, fd, offset: int, n: int, digest, compression=None, user=None,
+                       stats=None):
+    '''
+    Sends n bytes of fd starting from offset, one chunk at a time,
+    updating digest with every chunk on the way.
+    The next chunk is read in the file pool while the current one is being sent.
+    A slow client holds at most the transport's high water mark, plus two chunks,
+    of its download in memory: drain() waits until the buffer falls to the low mark.
+    '''
+    if compression:
+        return await sendFramesFromFile(writer, fd, offset, n, digest, compression, user, stats)
+
+    loop = asyncio.get_running_loop()
+    await inFilePool(fd.seek, offset)
+    pending = None
+    remaining = n
+    try:
+        if remaining > 0:
+            pending = loop.run_in_executor(file_pool, readChunk, fd, min(remaining, CHUNK_SIZE), digest)
+        while pending:
+            chunk = await pending
+            pending = None
+            if not chunk:
+                raise TruncatedFileError(f"{fd.name} is shorter than {offset + n} bytes")
+            remaining -= len(chunk)
+            if remaining > 0:
+                pending = loop.run_in_executor(file_pool, readChunk, fd, min(remaining, CHUNK_SIZE), digest)
+            writer.write(chunk)
+            if stats: stats.sent += len(chunk)
             await writer.drain()
+            await limits.paceAsync(user, len(chunk))
+    finally:
+        if pending: await pending   # fd must not be closed under a read
 
-        elif command[0] == 'L':
-            date = command[1]
-            if not sanitizeInput(date, type="date"):
-                writer.write(b'ERROR\n')
-                await writer.drain()
-                continue
 
-            filelist = None
-            for _, _, filenames in os.walk(f"{date}{user}"):
-                filelist = ", ".join(filenames) + "\n"
-                writer.write(filelist.encode('utf-8'))
-                break
+client_counter = 0
 
-            if not filelist: writer.write(b'NOTFOUND\n')
+async def clientSession(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    '''
+    Serves a client, recording the metrics of its session.
+    '''
+    stats = context.metrics.openSession()
+    try:
+        await async_sfp_client_handler(reader, writer, stats)
+    finally:
+        context.metrics.closeSession(stats)
 
-            await writer.drain()
+async def async_sfp_client_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stats):
+    '''
+    Drives the session of a client (see sfp/protocol.py): filesystem calls run in the file pool,
+    decompression in the process pool, the event loop only moves bytes.
+    '''
+    global client_counter
+    client_counter += 1
 
-        elif command[0] == 'H':
-            writer.write('''Students File Protocol commands usage:
-            U - Upload a file
-            D - Download a file
-            L - List files in directory
-            H - Show this help message
-            Q - Disconnect from server, close client\n\n'''.encode('utf-8'))
-            await writer.drain()
+    request_log.info("Client %d connected", client_counter)
+    writer.transport.set_write_buffer_limits(*write_buffer_limits)
+    session = ServerSession(context, stats)
+    loop = asyncio.get_running_loop()
 
-        elif command[0] == 'Q':
-            writer.write(b'GOODBYE\n')
-            await writer.drain()
-            logging.info(f"{user} disconnected")
-            break
+    async with contextlib.AsyncExitStack() as transfer:     # Slot and file of the running transfer
+        fd = None
+        pending = None  # Write of the previous chunk of an upload, overlapped with receiving the next one
+        try:
+            action = session.nextAction()
+            while not isinstance(action, Close):
+                if isinstance(action, NeedData):
+                    await writer.drain()    # Pipelined commands wait in the reader's buffer meanwhile
+                    data = await reader.read(CHUNK_SIZE)
+                    stats.received += len(data)
+                    session.receiveData(data)
+                    action = session.nextAction()
+                    continue
+
+                result = None
+                try:
+                    if isinstance(action, Send):
+                        writer.write(action.data)
+                        stats.sent += len(action.data)
+                    elif isinstance(action, Disk):
+                        result = await inFilePool(action.call)
+                    elif isinstance(action, Write):
+                        if pending:
+                            pending, write = None, pending
+                            await write
+                        pending = loop.run_in_executor(file_pool, writeChunk, fd, action.data, action.digest)
+                        await limits.paceAsync(session.user, action.cost)
+                    elif isinstance(action, Decode):
+                        result = await loop.run_in_executor(compressionPool(), decodeBlock,
+                                                            action.method, action.flag, action.block)
+                    elif isinstance(action, OpenFile):
+                        await transfer.enter_async_context(limits.slot(session.user))
+                        fd = await inFilePool(action.call)
+                        transfer.push_async_callback(inFilePool, fd.close)
+                    elif isinstance(action, SendFile):
+                        await writer.drain()
+                        if action.digest or action.compression or limits.shaper:
+                            await sendFromFile(writer, fd, action.offset, action.count, action.digest,
+                                               action.compression, session.user, stats)
+                        elif action.count:
+                            # Zero-copy when the transport allows it, chunked read/write otherwise
+                            sent = await loop.sendfile(writer.transport, fd, action.offset, action.count)
+                            stats.sent += sent
+                            if sent < action.count:     # The client waits for the rest, the session can't go on
+                                raise TruncatedFileError(
+                                    f"{fd.name} is shorter than {action.offset + action.count} bytes")
+                    elif isinstance(action, CloseFile):
+                        try:
+                            if pending:
+                                pending, write = None, pending
+                                await write
+                        finally:
+                            await transfer.aclose()
+                            fd = None
+                    elif isinstance(action, Profile):
+                        if action.seconds is None:
+                            result = profiler.dumpStacks()
+                        else:
+                            result = await profiler.captureAsync(action.seconds)
+                except (ValueError, RuntimeError, OSError) as e:    # Refused, e.g. an invalid frame, or a disk error
+                    action = session.actionFailed(action, e)
+                else:
+                    action = session.nextAction(result)
 
-        else:
-            writer.write(b'INVALID\n')
             await writer.drain()
+        except TruncatedFileError as e:
+            request_log.warning("%s, closing the connection", e)
+        finally:
+            if pending: await pending   # fd must not be closed under a write
+            writer.close()  # The client waits for EOF after GOODBYE or ERROR
+            try:
+                await writer.wait_closed()
+            except OSError:     # Reset by the client meanwhile
+                pass
 
 
-
-async def main(host, port):
+async def main(host, port, blobs=None, file_threads=None, reuse_port=False, write_buffer=None, transfer_limits=None,
+               metrics_port=None, admin_users=(), profile_dir=None, profile_seconds=None, lifeline=None):
     '''
     Front desk. Manages the registration of clients.
     :param host: host to bind the listening socket to
     :param port: port to listen on
+    :param blobs: directory of the deduplicating blob store, None to disable it
+    :param file_threads: size of the pool doing filesystem calls, None for the executor's default
+    :param reuse_port: share the port with other processes (SO_REUSEPORT), as a worker of supervise()
+    :param write_buffer: (high, low) water marks of every connection's write buffer, in bytes
+    :param transfer_limits: (user_rate, total_rate, user_transfers, total_transfers) of transfers,
+        bytes per second and transfers at once, None for no limit. Each worker process applies them on its own
+    :param metrics_port: local port of the Prometheus endpoint, None to disable it
+    :param admin_users: users allowed to run admin commands, e.g. S
+    :param profile_dir: directory of profiling reports, the working directory by default
+    :param profile_seconds: length of the captures started by SIGUSR1
+    :param lifeline: as a worker of supervise(), connection which reaches EOF when the supervisor dies
     '''
-
-    server = await asyncio.start_server(async_sfp_client_handler, host, port)
+    global file_pool, write_buffer_limits
+    if write_buffer:
+        write_buffer_limits = write_buffer
+    limits.configure(*(transfer_limits or ()), gate=AsyncTransferGate)
+    file_pool = ThreadPoolExecutor(max_workers=file_threads, thread_name_prefix="File")
+    configureServer(blobs, metrics_port, admin_users, profile_dir, profile_seconds)
+    profiler.installSignals(asyncio.get_running_loop())
+
+    server = await asyncio.start_server(clientSession, host, port, reuse_port=reuse_port)
+    # SIGTERM (the supervisor stops its workers with it) unwinds main like Ctrl-C, shutting down the pools
+    loop, task = asyncio.get_running_loop(), asyncio.current_task()
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    if lifeline:
+        def orphaned():
+            loop.remove_reader(lifeline.fileno())
+            logging.warning("Supervisor died, stopping")
+            task.cancel()
+        loop.add_reader(lifeline.fileno(), orphaned)    # Even SIGKILL closes the supervisor's end
 
     logging.info(f"Starting server on {host} {port}")
 
@@ -170,13 +291,136 @@ async def main(host, port):
             await server.serve_forever()
         except KeyboardInterrupt:
             logging.info("Exiting")
+        finally:
+            if compression_pool:
+                compression_pool.shutdown(wait=False, cancel_futures=True)  # Joined at exit
+
+def runWorker(host, port, blobs, file_threads, write_buffer, transfer_limits, metrics_port, admin_users, profiling,
+              lifeline, logging_options=None):
+    '''
+    Body of a worker process started by supervise(): an event loop of its own.
+    :param lifeline: (reader, writer) ends of the supervisor's pipe. Workers close the writer they inherit,
+        so that the reader reaches EOF once the supervisor dies, however it dies
+    :param logging_options: --log-* options (see sockutil/logqueue.py), None to keep the inherited configuration
+    '''
+    # The supervisor's handlers, if inherited, would ignore SIGTERM and forward SIGUSR1 to workers this one doesn't have
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl-C reaches the whole group, the supervisor handles it
+    if logging_options:
+        configureFromOptions(logging_options, LOG_FORMAT, request_log)
+    reader, writer = lifeline
+    writer.close()
+    try:
+        asyncio.run(main(host, port, blobs, file_threads, reuse_port=True, write_buffer=write_buffer,
+                         transfer_limits=transfer_limits, metrics_port=metrics_port, admin_users=admin_users,
+                         profile_dir=profiling[0], profile_seconds=profiling[1], lifeline=reader))
+    except asyncio.CancelledError:
+        logging.info("Worker stopped")
+
+def supervise(host, port, workers, blobs=None, file_threads=None, write_buffer=None, transfer_limits=None,
+              metrics_port=None, admin_users=(), profiling=(None, None), logging_options=None):
+    '''
+    Runs the server in several worker processes, each one with its own event loop
+    and interpreter, all bound to the same port with SO_REUSEPORT: the kernel spreads
+    incoming connections among them. Workers share nothing but the filesystem,
+    whose state (partial uploads, ranges, blobs, directory mtimes) is safe across processes.
+    Workers which die are restarted. SIGINT or SIGTERM stop all of them, and workers
+    stop on their own if the supervisor dies, even killed with SIGKILL.
+    Each worker keeps metrics of its own connections: the S command reports those of the
+    worker serving it, and worker i serves its Prometheus endpoint on metrics_port + i.
+    SIGUSR1 and SIGUSR2 are forwarded to every worker, which profiles itself.
+    :param workers: number of worker processes
+    :param profiling: (profile_dir, profile_seconds), see main()
+    :param logging_options: --log-* options, which every worker configures its logging with
+    '''
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    processes = {}  # index -> (process, start time)
+    lifeline = multiprocessing.Pipe(duplex=False)   # Never written, see runWorker
+
+    def forward(signum, frame):
+        for process, _ in processes.values():
+            if process.pid:
+                os.kill(process.pid, signum)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+
+    def spawn(index):
+        worker_metrics_port = metrics_port + index if metrics_port else None
+        process = multiprocessing.Process(target=runWorker, name=f"Worker-{index}",
+                                          args=(host, port, blobs, file_threads, write_buffer, transfer_limits,
+                                                worker_metrics_port, admin_users, profiling, lifeline, logging_options))
+        process.start()
+        processes[index] = (process, time.monotonic())
+        logging.info(f"{process.name} started, pid {process.pid}")
+
+    for index in range(workers):
+        spawn(index)
+
+    while not stopping:
+        multiprocessing.connection.wait([process.sentinel for process, _ in processes.values()], timeout=1)
+        for index, (process, started) in list(processes.items()):
+            if process.is_alive() or stopping:
+                continue
+            logging.warning(f"{process.name} exited with code {process.exitcode}, restarting it")
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)   # Don't spin on a worker that can't start, e.g. port in use
+            if not stopping:
+                spawn(index)
+
+    logging.info("Stopping workers")
+    for process, _ in processes.values():
+        process.terminate()
+    for process, _ in processes.values():
+        process.join(SHUTDOWN_TIMEOUT)
+        if process.is_alive():
+            logging.warning(f"{process.name} didn't exit, killing it")
+            process.kill()
+            process.join()
 
 
 if __name__ == '__main__':
-    logging.basicConfig(format="%(asctime)s\t%(levelname)s\t%(threadName)s\t%(message)s", level=logging.DEBUG)
     parser = argparse.ArgumentParser()
-    parser.add_argument("--address", "-a", default='', required=False, metavar="address")
-    parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    addServerOptions(parser)
+    parser.add_argument("--file-threads", type=int, default=None, required=False, metavar="threads",
+                        help="threads doing filesystem calls, so that slow disks never block the event loop")
+    parser.add_argument("--workers", "-w", type=int, default=1, required=False, metavar="workers",
+                        help="worker processes sharing the port, e.g. one per core (needs SO_REUSEPORT). "
+                             "Worker i serves its metrics on --metrics-port + i")
+    parser.add_argument("--write-high", type=int, default=WRITE_BUFFER_HIGH, required=False, metavar="bytes",
+                        help="write buffer size that pauses sending to a connection")
+    parser.add_argument("--write-low", type=int, default=WRITE_BUFFER_LOW, required=False, metavar="bytes",
+                        help="write buffer size that resumes sending to a connection")
+    addLoggingOptions(parser)
 
     args = parser.parse_args(sys.argv[1:])
-    asyncio.run(main(args.address, args.port))
\ No newline at end of file
+    configureFromOptions(args, LOG_FORMAT, request_log)
+    if not 0 <= args.write_low <= args.write_high:
+        parser.error("--write-low must be between 0 and --write-high")
+    write_buffer = (args.write_high, args.write_low)
+    transfer_limits = (args.user_rate, args.total_rate, args.user_transfers, args.total_transfers)
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, which this platform doesn't support")
+        supervise(args.address, args.port, args.workers, args.blobs, args.file_threads, write_buffer, transfer_limits,
+                  args.metrics_port, args.admin, (args.profile_dir, args.profile_seconds), args)
+    else:
+        try:
+            asyncio.run(main(args.address, args.port, args.blobs, args.file_threads,
+                             write_buffer=write_buffer, transfer_limits=transfer_limits,
+                             metrics_port=args.metrics_port, admin_users=args.admin, profile_dir=args.profile_dir,
+                             profile_seconds=args.profile_seconds))
+        except asyncio.CancelledError:  # SIGTERM
+            logging.info("Stopped")
@@ -11,9 +11,14 @@ __author__ = 'Giulio Corradini'
 import asyncio
 import logging
 import sys
+import os
 import argparse
 import threading
 
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sockutil.profiling import Profiler
+
 client_counter = 0
 
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -50,8 +55,9 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
         await writer.drain()
 
 
-async def main(host, port):
+async def main(host, port, profile_dir='.'):
     server = await asyncio.start_server(handle_client, host, port)
+    Profiler(profile_dir).installSignals(asyncio.get_running_loop())    # SIGUSR1 profiles, SIGUSR2 dumps stacks
 
     logging.info(f"Started server on {server.sockets[0].getsockname()} {port}")
 
@@ -63,6 +69,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--address", "-a", default='', required=False, metavar="address")
     parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    parser.add_argument("--profile-dir", default='.', required=False, metavar="directory",
+                        help="where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written")
 
     args = parser.parse_args(sys.argv[1:])
-    asyncio.run(main(args.address, args.port))
\ No newline at end of file
+    asyncio.run(main(args.address, args.port, args.profile_dir))
\ No newline at end of file
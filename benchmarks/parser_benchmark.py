@@ -0,0 +1,166 @@
+'''
+parser_benchmark.py
+
+Micro-benchmark of the SFP protocol engine (sfp/protocol.py), without sockets.
+
+A stream of pipelined commands, as text lines or SFP/2 messages, is cut
+into chunks of a fixed size, as a socket would deliver them, and fed to
+either the bare CommandParser or a whole ServerSession, whose actions are
+performed inline in a temporary directory. Uploads are included with
+--upload, to measure the payload path as well.
+
+Results are printed as JSON: commands per second and the time spent per
+command, for every chunk size.
+'''
+
+__author__ = 'Giulio Corradini'
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPOSITORY)
+from sfp.protocol import ServerContext, ServerSession, CommandParser, NeedData, Send, Disk, OpenFile, Write, \
+    CloseFile, Close
+from sfp.framing import VERSION_PREFIX, encodeMessage
+
+
+def commandStream(count: int, version: int, upload: int, seed: int) -> tuple:
+    '''
+    :param upload: payload size of the uploads, 0 for none
+    :return: (auth line and commands as bytes, number of commands)
+    '''
+    rng = random.Random(seed)
+    today = datetime.date.today().strftime("%Y%m%d")
+    commands = []
+    for i in range(count):
+        choice = rng.choice('LDHU' if upload else 'LDH')
+        if choice == 'L':
+            command = ['L', today]
+        elif choice == 'D':
+            command = ['D', f'missing{i}.txt', today]
+        elif choice == 'U':
+            command = ['U', f'upload{i}.bin', str(upload)]
+        else:
+            command = ['H']
+
+        if version == 2:
+            commands.append(encodeMessage(command[0], i, command[1:]))
+        else:
+            commands.append((" ".join(command) + "\n").encode('utf-8'))
+        if choice == 'U':
+            commands.append(bytes(upload))
+
+    auth = (VERSION_PREFIX if version == 2 else '') + 'bench\n'
+    return auth.encode('utf-8') + b''.join(commands), count
+
+
+def chunked(stream: bytes, size: int) -> list:
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def runParser(chunks: list, version: int) -> int:
+    '''
+    :return: commands parsed
+    '''
+    parser = CommandParser()
+    authenticated = False
+    parsed = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        if not authenticated:
+            authenticated = parser.line() is not None
+            if not authenticated:
+                continue
+        while parser.command(version) is not None:
+            parsed += 1
+    return parsed
+
+
+def runSession(chunks: list) -> int:
+    '''
+    Drives a session like the threaded server does, without a socket.
+    :return: bytes of the responses
+    '''
+    session = ServerSession(ServerContext())
+    chunks = iter(chunks)
+    responses = 0
+    fd = None
+    action = session.nextAction()
+    while not isinstance(action, Close):
+        result = None
+        if isinstance(action, NeedData):
+            session.receiveData(next(chunks, b''))
+        elif isinstance(action, Send):
+            responses += len(action.data)
+        elif isinstance(action, Disk):
+            result = action.call()
+        elif isinstance(action, OpenFile):
+            fd = action.call()
+        elif isinstance(action, Write):
+            fd.write(action.data)
+        elif isinstance(action, CloseFile):
+            fd.close()
+        action = session.nextAction(result)
+    return responses
+
+
+def benchmark(target: str, stream: bytes, count: int, size: int, version: int, repeat: int) -> dict:
+    chunks = chunked(stream, size)
+    best = float('inf')
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)     # Sessions work in the current directory
+            try:
+                began = time.perf_counter()
+                if target == 'parser':
+                    runParser(chunks, version)
+                else:
+                    runSession(chunks)
+                best = min(best, time.perf_counter() - began)
+            finally:
+                os.chdir(cwd)
+
+    return {
+        'chunk_size': size,
+        'seconds': best,
+        'commands_per_second': count / best,
+        'microseconds_per_command': best / count * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the SFP protocol engine, printing results as JSON")
+    parser.add_argument("--target", choices=('parser', 'session'), default='parser',
+                        help="bare command parser, or whole sessions with inline actions")
+    parser.add_argument("--commands", type=int, default=100000, help="pipelined commands in the stream")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1, help="2 to use binary framing")
+    parser.add_argument("--chunks", type=int, nargs='+', default=[1, 16, 1460, 65536],
+                        help="sizes of the chunks the stream is fed in")
+    parser.add_argument("--upload", type=int, default=0, help="include uploads of this many bytes (session only)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every measure, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random commands")
+    parser.add_argument("--output", type=str, default=None, help="file to write the JSON report to, stdout by default")
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.upload and args.target != 'session':
+        parser.error("--upload needs --target session, the bare parser doesn't know about payloads")
+
+    stream, count = commandStream(args.commands, args.protocol, args.upload, args.seed)
+    config = {'target': args.target, 'commands': count, 'protocol': args.protocol, 'upload': args.upload,
+              'stream_bytes': len(stream)}
+    results = [benchmark(args.target, stream, count, size, args.protocol, args.repeat) for size in args.chunks]
+
+    report = json.dumps({'config': config, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(report + '\n')
+    else:
+        print(report)
@@ -0,0 +1,347 @@
+'''
+sfp_benchmark.py
+
+Load generator comparing the Students File Protocol servers.
+
+Each server is started on loopback, seeded with one file per size class,
+then driven for a fixed time by simulated clients, spread over client
+processes so that the load generator isn't bound by a single GIL.
+Every client repeatedly picks an operation (U, D or L) and a file size
+from the configured distributions, and times it from the command to the
+last byte of the response.
+
+Without --checksum nothing acknowledges an upload, so U latency ends when
+its last byte is handed to the kernel; with --checksum it includes the
+server's digest trailer.
+
+Results are printed as JSON: throughput, latency percentiles per verb,
+and CPU time and peak RSS of each server, read from its rusage.
+'''
+
+__author__ = 'Giulio Corradini'
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPOSITORY, 'students_file_transfer'))
+from sfp_client import connect
+from sfp.checksum import newDigest, ChecksumError
+
+SERVERS = {
+    'thread': os.path.join(REPOSITORY, 'students_file_transfer', 'sfp_server.py'),
+    'stream': os.path.join(REPOSITORY, 'students_file_transfer', 'sfp_server_stream.py'),
+    'async': os.path.join(REPOSITORY, 'asyncio', 'async_sfp_server.py'),
+    'select': os.path.join(REPOSITORY, 'wait_fd_select', 'sfp_server_select.py'),
+}
+USER = 'bench'
+START_TIMEOUT = 10.0    # Seconds a server may take to accept connections
+SETUP_TIME = 1.0        # Seconds given to client processes to connect before the load starts
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parseSize(text: str) -> int:
+    '''
+    :param text: a number of bytes, optionally followed by K, M or G, e.g. 64K
+    '''
+    text = text.strip().upper()
+    unit = text[-1] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parseWeights(text: str, parseKey=str) -> list:
+    '''
+    Parses a distribution, e.g. "U=1,D=3,L=2" or "4K=5,1M=2,16M=1".
+    :return: list of (key, weight) tuples
+    :raise ValueError: if an item isn't key=weight, or every weight is 0
+    '''
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((parseKey(key), float(weight or 1)))
+    if not any(weight > 0 for _, weight in weights):
+        raise ValueError(f"No positive weight in {text}")
+    return weights
+
+
+def percentile(ordered: list, p: float) -> float:
+    '''
+    Nearest-rank percentile.
+    :param ordered: sorted samples, at least one
+    '''
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def startServer(name: str, port: int, directory: str, arguments=()) -> subprocess.Popen:
+    '''
+    Starts a server in directory and waits until it accepts connections.
+    :raise RuntimeError: if it doesn't within START_TIMEOUT
+    '''
+    server = subprocess.Popen([sys.executable, SERVERS[name], '--port', str(port), *arguments], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('localhost', port)) as probe:
+                if probe.getsockname() != probe.getpeername():     # Not connected to itself
+                    return server
+        except OSError:
+            pass
+        if server.poll() is not None:
+            break
+        time.sleep(0.05)
+    server.kill()
+    raise RuntimeError(f"{name} server didn't start on port {port}")
+
+
+def stopServer(server: subprocess.Popen) -> dict:
+    '''
+    Stops a server and collects its resource usage, children included.
+    :return: CPU seconds and peak RSS in bytes
+    '''
+    server.terminate()
+    _, _, usage = os.wait4(server.pid, 0)
+    server.returncode = 0   # Reaped here, Popen mustn't wait for it again
+    peak = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024  # Bytes on macOS, KiB elsewhere
+    return {
+        'cpu_user_seconds': usage.ru_utime,
+        'cpu_system_seconds': usage.ru_stime,
+        'peak_rss_bytes': peak,
+    }
+
+
+def makeFiles(directory: str, sizes) -> dict:
+    '''
+    Writes a file of random bytes for every size class.
+    :return: dict mapping sizes to paths
+    '''
+    files = {}
+    for size, _ in sizes:
+        path = os.path.join(directory, f"{size}.bin")
+        with open(path, 'wb') as fd:
+            remaining = size
+            while remaining > 0:
+                fd.write(os.urandom(min(remaining, 1048576)))
+                remaining -= min(remaining, 1048576)
+        files[size] = path
+    return files
+
+
+def uploadAs(s, path: str, name: str, size: int) -> None:
+    '''
+    Uploads a local file under another name.
+    :raise ValueError: if the server refuses it
+    '''
+    s.sendCommand('U', name, str(size))
+    if s.recvReply() != b'OK\n':
+        raise ValueError(f"Upload of {name} refused")
+    digest = newDigest(s.checksum) if s.checksum else None
+    with open(path, 'rb') as fd:
+        s.sendFromFile(fd, size, digest=digest)
+    s.checkDigest(digest)
+
+
+def downloadTo(s, sink, name: str, date: str) -> int:
+    '''
+    Downloads a file, writing it to sink.
+    :return: bytes received
+    :raise ValueError: if the server doesn't send it
+    '''
+    s.sendCommand('D', name, date)
+    response = s.recvReply()
+    if not response[:1].isdigit():
+        raise ValueError(f"Download of {name} refused: {response}")
+    count = int(response.split()[0])
+    digest = newDigest(s.checksum) if s.checksum else None
+    s.recvToFile(sink, count, digest=digest)
+    s.checkDigest(digest)
+    return count
+
+
+def seed(port: int, files: dict, config: dict) -> None:
+    '''
+    Uploads the files every D downloads.
+    '''
+    with connect('localhost', port, USER, config['extensions'], config['version']) as s:
+        for size, path in files.items():
+            uploadAs(s, path, os.path.basename(path), size)
+        s.sendTextCommand('Q')
+
+
+def runClient(port: int, index: int, files: dict, config: dict, start: float) -> dict:
+    '''
+    One simulated client: runs random operations from start (time.time())
+    for the configured duration.
+    :return: latencies per verb, bytes transferred and errors
+    '''
+    rng = random.Random(config['seed'] + index)
+    verbs, verb_weights = zip(*config['mix'])
+    sizes, size_weights = zip(*config['sizes'])
+    today = datetime.datetime.now().strftime("%Y%m%d")
+    results = {'latencies': {verb: [] for verb in verbs}, 'bytes': 0, 'errors': 0}
+    s = connect('localhost', port, USER, config['extensions'], config['version'])
+    sequence = 0
+
+    time.sleep(max(0.0, start - time.time()))
+    deadline = start + config['duration']
+    with open(os.devnull, 'wb') as sink:
+        while time.time() < deadline:
+            verb = rng.choices(verbs, verb_weights)[0]
+            size = rng.choices(sizes, size_weights)[0]
+            began = time.perf_counter()
+            try:
+                if verb == 'U':
+                    sequence += 1
+                    uploadAs(s, files[size], f"c{index}-{sequence}.bin", size)
+                elif verb == 'D':
+                    size = downloadTo(s, sink, os.path.basename(files[size]), today)
+                else:
+                    s.sendTextCommand('L', today)
+                    size = 0
+            except (OSError, ValueError, ChecksumError):
+                results['errors'] += 1
+                s.close()
+                s = connect('localhost', port, USER, config['extensions'], config['version'])
+                continue
+            results['latencies'][verb].append(time.perf_counter() - began)
+            results['bytes'] += size
+    s.sendTextCommand('Q')
+    s.close()
+    return results
+
+
+def runClientProcess(port: int, indices: list, config: dict, start: float) -> list:
+    '''
+    Body of a client process: runs its share of the clients as threads.
+    :return: results of its clients, see runClient
+    '''
+    directory = tempfile.mkdtemp(prefix='sfp-bench-client-')
+    try:
+        files = makeFiles(directory, config['sizes'])
+        with ThreadPoolExecutor(len(indices)) as executor:
+            return list(executor.map(lambda index: runClient(port, index, files, config, start), indices))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchmark(name: str, config: dict, port: int, arguments=()) -> dict:
+    '''
+    Starts a server, loads it with the configured clients, stops it.
+    :return: measurements, ready to be dumped as JSON
+    '''
+    directory = tempfile.mkdtemp(prefix=f'sfp-bench-{name}-')
+    server = startServer(name, port, directory, arguments)
+    try:
+        files = makeFiles(directory, config['sizes'])   # Outside the server's user directory
+        seed(port, files, config)
+
+        processes = min(config['clients'], config['processes'])
+        shares = [list(range(config['clients']))[i::processes] for i in range(processes)]
+        start = time.time() + SETUP_TIME
+        with multiprocessing.Pool(processes) as pool:
+            outcomes = pool.starmap(runClientProcess, [(port, share, config, start) for share in shares])
+    finally:
+        usage = stopServer(server)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    latencies = {verb: [] for verb, _ in config['mix']}
+    transferred, errors = 0, 0
+    for outcome in (client for share in outcomes for client in share):
+        for verb, samples in outcome['latencies'].items():
+            latencies[verb].extend(samples)
+        transferred += outcome['bytes']
+        errors += outcome['errors']
+
+    operations = sum(len(samples) for samples in latencies.values())
+    report = {
+        'server': name,
+        'operations': operations,
+        'errors': errors,
+        'bytes': transferred,
+        'throughput_bytes_per_second': transferred / config['duration'],
+        'operations_per_second': operations / config['duration'],
+        'latency_seconds': {},
+        **usage,
+    }
+    for verb, samples in latencies.items():
+        samples.sort()
+        report['latency_seconds'][verb] = {
+            'count': len(samples),
+            'mean': sum(samples) / len(samples) if samples else None,
+            'p50': percentile(samples, 50) if samples else None,
+            'p99': percentile(samples, 99) if samples else None,
+            'max': samples[-1] if samples else None,
+        }
+    return report
+
+
+def freePort() -> int:
+    '''
+    :return: a port nobody is listening on
+    '''
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the SFP servers, printing results as JSON")
+    parser.add_argument("--servers", nargs='+', choices=SERVERS, default=list(SERVERS),
+                        help="servers to benchmark, one after the other")
+    parser.add_argument("--clients", type=int, default=16, help="simulated clients")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="client processes the simulated clients are spread over")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load on each server")
+    parser.add_argument("--mix", type=str, default="U=1,D=3,L=2",
+                        help="weights of the operations, e.g. U=1,D=3,L=2")
+    parser.add_argument("--sizes", type=str, default="4K=5,256K=3,4M=1",
+                        help="weights of the file sizes used by U and D, e.g. 4K=5,1M=2,16M=1")
+    parser.add_argument("--checksum", type=str, default=None, help="enable a checksum, e.g. blake2b")
+    parser.add_argument("--compression", type=str, default=None, help="enable compression, e.g. zlib")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1, help="2 to use binary framing")
+    parser.add_argument("--async-workers", type=int, default=1, help="worker processes of the asyncio server")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random operations")
+    parser.add_argument("--output", type=str, default=None, help="file to write the JSON report to, stdout by default")
+
+    args = parser.parse_args(sys.argv[1:])
+    try:
+        config = {
+            'clients': args.clients,
+            'processes': args.processes,
+            'duration': args.duration,
+            'mix': parseWeights(args.mix, lambda verb: verb.strip().upper()),
+            'sizes': parseWeights(args.sizes, parseSize),
+            'extensions': [name for name in (args.checksum, args.compression) if name],
+            'version': args.protocol,
+            'seed': args.seed,
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    if any(verb not in ('U', 'D', 'L') for verb, _ in config['mix']):
+        parser.error("--mix may only weigh U, D and L")
+
+    results = []
+    for name in args.servers:
+        arguments = ['--workers', str(args.async_workers)] if name == 'async' and args.async_workers > 1 else []
+        print(f"Benchmarking {name} server", file=sys.stderr)
+        results.append(benchmark(name, config, freePort(), arguments))
+
+    report = json.dumps({'config': config, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(report + '\n')
+    else:
+        print(report)
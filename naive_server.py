@@ -24,6 +24,8 @@ import socket
 import threading
 import logging
 
+from sockutil.profiling import Profiler
+
 quit_on_idle = threading.Event()
 shutdown = threading.Event()
 
@@ -88,6 +90,8 @@ class ThreadedRequestHandler(threading.Thread):
 
 
 def main():
+    Profiler().installSignals()     # SIGUSR1 profiles, SIGUSR2 dumps stacks
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('', 9999))
         s.listen(5)
@@ -0,0 +1,11 @@
+'''
+sfp
+
+Building blocks shared by the Students File Protocol servers and clients
+in students_file_transfer/, asyncio/ and wait_fd_select/.
+
+Scripts in those directories put the repository root on sys.path
+before importing from here.
+'''
+
+__author__ = 'Giulio Corradini'
@@ -0,0 +1,127 @@
+'''
+blobs.py
+
+Content-addressed storage of uploaded files.
+
+Every completed upload is hashed and hard linked into a blob directory,
+under the name of its digest. When the same bytes are uploaded again,
+by any user, the new copy is replaced with another link to the existing
+blob, so identical files take disk space only once.
+
+A client that knows the digest of a file can announce it (A) before
+uploading: if the server already holds a blob with that digest and size,
+the file is linked into the user's directory without transferring it.
+
+Files in SFP are never modified after upload, so sharing an inode
+between users is safe. Hard links can't cross filesystems: the blob
+directory must live on the same one as the working directories, or
+uploads are simply left as separate copies.
+'''
+
+import os
+import hashlib
+import logging
+import string
+from typing import Optional
+
+from sfp.uploads import PARTIAL_DIRECTORY, partialPath, commitUpload
+
+__author__ = 'Giulio Corradini'
+
+BLOB_ALGORITHM = 'sha256'
+HASH_CHUNK = 1048576
+
+
+def newContentDigest():
+    return hashlib.new(BLOB_ALGORITHM)
+
+
+def hashFile(path: str) -> str:
+    '''
+    :return: hex digest of the content of path, as used to name blobs
+    '''
+    digest = newContentDigest()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def isContentDigest(hexdigest: str) -> bool:
+    '''
+    Validates a digest sent by a client, before using it as a path.
+    '''
+    return len(hexdigest) == newContentDigest().digest_size * 2 \
+        and all(c in string.hexdigits for c in hexdigest)
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        '''
+        :param root: blob directory, created if it doesn't exist
+        '''
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, hexdigest: str) -> str:
+        hexdigest = hexdigest.lower()
+        return os.path.join(self.root, hexdigest[:2], hexdigest)   # Keeps directories small
+
+    def contains(self, hexdigest: str, size: int) -> bool:
+        if not isContentDigest(hexdigest):
+            return False
+        try:
+            return os.path.getsize(self.path(hexdigest)) == size
+        except FileNotFoundError:
+            return False
+
+    def ingest(self, working_directory: str, filename: str, hexdigest: Optional[str] = None) -> None:
+        '''
+        Adds a completed upload to the store, or replaces it with a link
+        to an identical blob that's already stored.
+        :param working_directory: user's working directory
+        :param filename: name of the completed upload
+        :param hexdigest: digest of the file, computed while receiving it.
+            When None (e.g. resumed or parallel uploads), the file is hashed from disk
+        '''
+        path = os.path.join(working_directory, filename)
+        if hexdigest is None:
+            hexdigest = hashFile(path)
+        blob = self.path(hexdigest)
+
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)     # First copy of this content
+                return
+            except FileExistsError:
+                pass
+
+            if os.path.samefile(path, blob):
+                return
+            duplicate = os.path.join(working_directory, PARTIAL_DIRECTORY, f".{filename}.blob")
+            os.link(blob, duplicate)
+            os.replace(duplicate, path)     # The uploaded copy is freed here
+            logging.debug("%s deduplicated as %s", path, hexdigest)
+        except OSError as e:
+            logging.warning(f"Can't store {path} as a blob: {e}")
+
+    def linkInto(self, hexdigest: str, size: int, working_directory: str, filename: str) -> bool:
+        '''
+        Creates filename in working_directory as a link to a stored blob,
+        as if it had been uploaded.
+        :return: False if there's no blob with that digest and size
+        '''
+        if not self.contains(hexdigest, size):
+            return False
+
+        staged = partialPath(working_directory, filename)
+        try:
+            if os.path.exists(staged):
+                os.remove(staged)   # Leftover of an interrupted upload of the same file
+            os.link(self.path(hexdigest), staged)
+        except OSError as e:
+            logging.warning(f"Can't link blob {hexdigest}: {e}")
+            return False
+        commitUpload(working_directory, filename)
+        return True
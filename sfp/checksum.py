@@ -0,0 +1,89 @@
+'''
+checksum.py
+
+End-to-end checksums of transferred files.
+
+A session enables checksums with the E command. From then on, the payload
+of every U, R and D command is followed by a line with the hex digest
+of exactly the bytes in that payload. Both sides compute it
+incrementally, chunk by chunk, while the bytes go through the socket.
+
+Whenever a payload covers a whole file, the server stores its digest next
+to the file, so a later download of the whole file can still use sendfile
+without another pass over the disk.
+'''
+
+import os
+import hashlib
+from typing import Optional
+
+__author__ = 'Giulio Corradini'
+
+ALGORITHMS = ('blake2b', 'sha256')   # In order of preference
+SUMS_DIRECTORY = '.sums'
+
+
+class ChecksumError(Exception):
+    '''
+    Raised when the digest received after a payload doesn't match the transferred bytes.
+    '''
+
+
+def chooseAlgorithm(requested) -> Optional[str]:
+    '''
+    Picks the checksum algorithm of a session.
+    :param requested: algorithm names proposed by the client
+    :return: the first requested algorithm the server supports, None if there's none
+    '''
+    for name in requested:
+        if name in ALGORITHMS:
+            return name
+    return None
+
+
+def newDigest(algorithm: str):
+    return hashlib.new(algorithm)
+
+
+def storeDigest(directory: str, filename: str, algorithm: str, hexdigest: str) -> None:
+    '''
+    Saves the digest of a whole file, along with the size and modification time
+    the file has now, which tell whether the digest is still valid.
+    '''
+    sums = os.path.join(directory, SUMS_DIRECTORY)
+    os.makedirs(sums, exist_ok=True)
+    stat = os.stat(os.path.join(directory, filename))
+    with open(os.path.join(sums, filename), 'w') as fd:
+        fd.write(f"{algorithm} {hexdigest} {stat.st_size} {stat.st_mtime_ns}\n")
+
+
+def storedDigest(directory: str, filename: str, algorithm: str) -> Optional[str]:
+    '''
+    :return: hex digest of a whole file computed by algorithm, None if unknown or stale
+    '''
+    try:
+        with open(os.path.join(directory, SUMS_DIRECTORY, filename)) as fd:
+            stored_algorithm, hexdigest, size, mtime = fd.read().split()
+        stat = os.stat(os.path.join(directory, filename))
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if stored_algorithm != algorithm or int(size) != stat.st_size or int(mtime) != stat.st_mtime_ns:
+        return None
+    return hexdigest
+
+
+class DigestSet:
+    '''
+    Feeds the same bytes to several hash objects, skipping the None ones,
+    so a payload can be checksummed and content-addressed in a single pass.
+    '''
+    def __init__(self, *digests):
+        self.digests = [digest for digest in digests if digest is not None]
+
+    def update(self, data) -> None:
+        for digest in self.digests:
+            digest.update(data)
+
+    def __bool__(self) -> bool:
+        return bool(self.digests)
@@ -0,0 +1,118 @@
+'''
+compression.py
+
+Compression of transferred files.
+
+A session enables compression with the E command, naming one of the
+stdlib methods below. From then on, the payload of every U, R and D
+command is sent as a sequence of frames instead of a raw byte stream:
+
+    flag (1 byte) | length (4 bytes, big endian) | data
+
+Each frame carries up to BLOCK_SIZE bytes of the file, compressed on its
+own (flag COMPRESSED) or as they are (flag RAW). Sizes and offsets in
+commands and responses still count file bytes, so the receiver stops
+once it has decoded as many bytes as it asked for.
+
+Blocks are independent of each other, so they can be compressed in
+parallel, e.g. in a process pool, and the sender may give up compressing
+at any time: already compressed formats and data with a poor ratio on
+their first block are sent in RAW frames, which cost no CPU.
+'''
+
+import os
+import bz2
+import lzma
+import zlib
+import struct
+from typing import Optional
+
+__author__ = 'Giulio Corradini'
+
+METHODS = {
+    'zlib': (zlib.compress, zlib.decompressobj),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor),
+    'lzma': (lzma.compress, lzma.LZMADecompressor),
+}
+
+BLOCK_SIZE = 262144     # File bytes per frame
+FRAME_HEADER = struct.Struct('!BI')
+RAW, COMPRESSED = 0, 1
+
+SAMPLE_SIZE = 65536
+MIN_SAVING = 0.1        # Compress only if the sample shrinks by at least 10%
+
+# Formats which are compressed already, sent without trying
+INCOMPRESSIBLE = {
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar', '.jar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.ogg', '.flac', '.aac', '.mp4', '.mkv', '.avi', '.mov', '.webm',
+}
+
+
+def chooseMethod(requested) -> Optional[str]:
+    '''
+    Picks the compression method of a session.
+    :param requested: extension names proposed by the client
+    :return: the first requested method the server supports, None if there's none
+    '''
+    for name in requested:
+        if name in METHODS:
+            return name
+    return None
+
+
+def worthCompressing(filename: str, sample: bytes) -> bool:
+    '''
+    Tells whether a file is worth compressing, from its name and a sample
+    of its first bytes, using fast zlib as an estimate for every method.
+    '''
+    if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE:
+        return False
+    sample = sample[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def encodeBlock(method: Optional[str], data: bytes) -> bytes:
+    '''
+    Builds the frame of a block of file bytes.
+    Module-level and free of state, so that it can run in a process pool.
+    :param method: compression method, None to send the block as it is
+    :return: frame header followed by the (compressed) block
+    '''
+    if method:
+        compressed = METHODS[method][0](data)
+        if len(compressed) < len(data):
+            return FRAME_HEADER.pack(COMPRESSED, len(compressed)) + compressed
+    return FRAME_HEADER.pack(RAW, len(data)) + data
+
+
+def parseFrameHeader(header: bytes) -> tuple:
+    '''
+    :return: (flag, length) of a frame
+    :raise ValueError: if the header is invalid, the stream can't be trusted anymore
+    '''
+    flag, length = FRAME_HEADER.unpack(header)
+    if flag not in (RAW, COMPRESSED) or length > BLOCK_SIZE:
+        raise ValueError(f"Invalid frame header: flag {flag}, length {length}")
+    return flag, length
+
+
+def decodeBlock(method: str, flag: int, data: bytes) -> bytes:
+    '''
+    Restores the file bytes carried by a frame.
+    Module-level and free of state, so that it can run in a process pool.
+    :raise ValueError: if data doesn't decompress to at most BLOCK_SIZE bytes
+    '''
+    if flag == RAW:
+        return data
+
+    decompressor = METHODS[method][1]()
+    try:
+        block = decompressor.decompress(data, BLOCK_SIZE)   # Bounded, against decompression bombs
+    except (zlib.error, OSError, lzma.LZMAError) as e:
+        raise ValueError(f"Corrupted {method} block: {e}")
+    if not decompressor.eof:
+        raise ValueError(f"Corrupted {method} block: truncated or larger than {BLOCK_SIZE} bytes")
+    return block
@@ -0,0 +1,85 @@
+'''
+framing.py
+
+Binary framing of SFP/2 messages.
+
+A client opts in while authenticating, sending "SFP/2 name\n" instead of
+"name\n". The server accepts with "OK SFP/2\n" and from then on every
+command and every response is a message:
+
+    code (1 byte) | field count (2 bytes) | request id (4 bytes) | body length (4 bytes) | body
+
+with integers in network byte order. The body is the sequence of fields,
+each one a 2 bytes length followed by that many utf-8 bytes.
+
+A command carries its verb as code and its arguments as fields. A response
+echoes the code and request id of the command it answers, with the tokens
+of the text response as fields: e.g. "OK", or range and file size for a
+ranged D, or one field per file for L. Fields may contain spaces and
+newlines, and reading a message takes two reads of known size, without
+scanning for separators.
+
+File payloads are not framed: they follow their response exactly as in
+the text protocol. Digest trailers (see checksum.py) are responses.
+'''
+
+import struct
+
+__author__ = 'Giulio Corradini'
+
+VERSION_PREFIX = 'SFP/2 '       # Prepended to the user name to request binary framing
+VERSION_ACCEPTED = b'OK SFP/2\n'
+
+HEADER = struct.Struct('!cHII')
+FIELD_LENGTH = struct.Struct('!H')
+MAX_BODY = 16777216     # Bound to the memory a peer can make us allocate for a message
+
+
+def encodeMessage(code: str, request_id: int, fields) -> bytes:
+    '''
+    :param code: verb of the command, or of the command being answered
+    :param request_id: identifier chosen by the client for the command
+    :param fields: strings, each one shorter than 64 KiB once encoded
+    :return: header and body of the message
+    '''
+    body = bytearray()
+    count = 0
+    for field in fields:
+        data = field.encode('utf-8')
+        body += FIELD_LENGTH.pack(len(data))
+        body += data
+        count += 1
+    return HEADER.pack(code.encode('ascii'), count, request_id, len(body)) + body
+
+
+def parseHeader(header: bytes) -> tuple:
+    '''
+    :return: (code, field count, request id, body length) of a message
+    :raise ValueError: if the header is invalid, the stream can't be trusted anymore
+    '''
+    code, count, request_id, length = HEADER.unpack(header)
+    if length > MAX_BODY:
+        raise ValueError(f"Message body of {length} bytes, more than {MAX_BODY}")
+    return code.decode('ascii'), count, request_id, length
+
+
+def decodeFields(body: bytes, count: int) -> list:
+    '''
+    :return: the count fields of a message body, as strings
+    :raise ValueError: if body doesn't hold exactly count fields
+    '''
+    fields = []
+    position = 0
+    for _ in range(count):
+        if position + FIELD_LENGTH.size > len(body):
+            raise ValueError("Truncated message body")
+        length, = FIELD_LENGTH.unpack_from(body, position)
+        position += FIELD_LENGTH.size
+        if position + length > len(body):
+            raise ValueError("Truncated message body")
+        fields.append(bytes(body[position:position + length]).decode('utf-8'))
+        position += length
+
+    if position != len(body):
+        raise ValueError(f"{len(body) - position} bytes after the last field")
+    return fields
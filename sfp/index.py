@@ -0,0 +1,73 @@
+'''
+index.py
+
+In-memory index of the working directories (yyyymmdd<user>) served by SFP,
+so that L and D are answered with dictionary lookups instead of walking
+the filesystem at every command.
+
+Each entry remembers the modification time of its directory and is
+rebuilt when it changes, i.e. when another program adds, removes or
+renames files. Uploads completed by the server update the index directly.
+'''
+
+import os
+import threading
+from typing import Dict, Optional
+
+__author__ = 'Giulio Corradini'
+
+
+class DirectoryIndex:
+    def __init__(self):
+        self._entries: Dict[str, tuple] = {}    # directory -> (mtime_ns, {filename: size})
+        self._lock = threading.Lock()
+
+    def listing(self, directory: str) -> Optional[Dict[str, int]]:
+        '''
+        Files in a working directory, with their sizes.
+        Costs a stat of the directory, plus a scan if it changed since the last call.
+        :param directory: working directory, e.g. 20201019rossi
+        :return: dict mapping file names to sizes, None if the directory doesn't exist
+        '''
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(directory, None)
+            return None
+
+        entry = self._entries.get(directory)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, self._scan(directory))
+            with self._lock:
+                self._entries[directory] = entry
+        return entry[1]
+
+    def lookup(self, directory: str, filename: str) -> Optional[int]:
+        '''
+        :return: size of filename in directory, None if there's no such file
+        '''
+        files = self.listing(directory)
+        return None if files is None else files.get(filename)
+
+    def add(self, directory: str, filename: str, size: int) -> None:
+        '''
+        Records a file the server itself has just written in directory,
+        without rescanning it.
+        '''
+        with self._lock:
+            entry = self._entries.get(directory)
+            if entry is None:
+                return
+            files = dict(entry[1])  # Readers may be iterating over the old dict
+            files[filename] = size
+            self._entries[directory] = (os.stat(directory).st_mtime_ns, files)
+
+    @staticmethod
+    def _scan(directory: str) -> Dict[str, int]:
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files[entry.name] = entry.stat().st_size
+        return files
@@ -0,0 +1,209 @@
+'''
+metrics.py
+
+Live metrics of the SFP servers: sessions, bytes received and sent,
+requests and their latency for every verb.
+
+Every session records into a Recorder of its own, which only the thread or
+task serving the session ever writes, so counting a request or a chunk of
+bytes costs a few integer additions and no lock. Metrics only takes its lock
+when a session starts or ends, and to take a snapshot, which adds the live
+recorders to the totals of the finished sessions. A snapshot may miss the
+chunk being counted meanwhile, which is fine for monitoring.
+
+Snapshots are rendered in the Prometheus text format, both for the S admin
+command and for the optional HTTP endpoint started by serveMetrics.
+'''
+
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__author__ = 'Giulio Corradini'
+
+VERBS = ('U', 'R', 'A', 'D', 'L', 'E', 'H', 'Q', 'S', 'P', 'other')    # other counts invalid commands
+SLOTS = {verb: slot for slot, verb in enumerate(VERBS)}
+OTHER = SLOTS['other']
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the latency histogram buckets, in seconds
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Recorder:
+    '''
+    Metrics of a single session. Lists have a slot per verb and never grow,
+    so other threads can read them while the session updates them.
+    '''
+    def __init__(self):
+        self.received = 0   # Bytes
+        self.sent = 0
+        self.requests = [0] * len(VERBS)
+        self.seconds = [0.0] * len(VERBS)   # Total latency of the requests
+        self.buckets = [[0] * (len(BUCKETS) + 1) for _ in VERBS]   # Last one is +Inf
+
+        self._verb = None   # Request being served, see begin()
+        self._began = 0.0
+
+    def begin(self, verb: str) -> None:
+        '''
+        Starts timing a request.
+        '''
+        self._verb = verb
+        self._began = time.perf_counter()
+
+    def end(self) -> None:
+        '''
+        Records the request started by begin(), if any.
+        Requests interrupted by a disconnection are never ended, so they aren't counted.
+        '''
+        if self._verb is None:
+            return
+        elapsed = time.perf_counter() - self._began
+        slot = SLOTS.get(self._verb, OTHER)
+        self.requests[slot] += 1
+        self.seconds[slot] += elapsed
+        self.buckets[slot][bisect.bisect_left(BUCKETS, elapsed)] += 1
+        self._verb = None
+
+    def addTo(self, total: 'Recorder') -> None:
+        total.received += self.received
+        total.sent += self.sent
+        for slot in range(len(VERBS)):
+            total.requests[slot] += self.requests[slot]
+            total.seconds[slot] += self.seconds[slot]
+            for bucket, count in enumerate(self.buckets[slot]):
+                total.buckets[slot][bucket] += count
+
+
+class Metrics:
+    def __init__(self):
+        self.sessions = 0   # Sessions started
+        self.finished = Recorder()  # Totals of the sessions which ended
+        self.pool = None    # PoolStats of the worker pool serving the sessions, if any (see sockutil/pool.py)
+        self._live = set()
+        self._lock = threading.Lock()
+
+    def openSession(self) -> Recorder:
+        '''
+        :return: the recorder of a new session, to be closed with closeSession
+        '''
+        recorder = Recorder()
+        with self._lock:
+            self.sessions += 1
+            self._live.add(recorder)
+        return recorder
+
+    def closeSession(self, recorder: Recorder) -> None:
+        with self._lock:
+            self._live.discard(recorder)
+            recorder.addTo(self.finished)
+
+    def snapshot(self) -> tuple:
+        '''
+        :return: (active sessions, sessions started, Recorder with the totals)
+        '''
+        total = Recorder()
+        with self._lock:
+            self.finished.addTo(total)
+            for recorder in self._live:
+                recorder.addTo(total)
+            return len(self._live), self.sessions, total
+
+    def render(self) -> str:
+        '''
+        :return: a snapshot in the Prometheus text exposition format
+        '''
+        active, sessions, total = self.snapshot()
+        lines = [
+            "# HELP sfp_sessions_active Sessions connected right now.",
+            "# TYPE sfp_sessions_active gauge",
+            f"sfp_sessions_active {active}",
+            "# HELP sfp_sessions_total Sessions started.",
+            "# TYPE sfp_sessions_total counter",
+            f"sfp_sessions_total {sessions}",
+            "# HELP sfp_received_bytes_total Bytes received from clients.",
+            "# TYPE sfp_received_bytes_total counter",
+            f"sfp_received_bytes_total {total.received}",
+            "# HELP sfp_sent_bytes_total Bytes sent to clients.",
+            "# TYPE sfp_sent_bytes_total counter",
+            f"sfp_sent_bytes_total {total.sent}",
+            "# HELP sfp_requests_total Commands served.",
+            "# TYPE sfp_requests_total counter",
+        ]
+        lines += [f'sfp_requests_total{{verb="{verb}"}} {total.requests[slot]}' for slot, verb in enumerate(VERBS)]
+        lines += [
+            "# HELP sfp_request_duration_seconds Time spent serving a command, transfers included.",
+            "# TYPE sfp_request_duration_seconds histogram",
+        ]
+        for slot, verb in enumerate(VERBS):
+            if not total.requests[slot]:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), total.buckets[slot]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'sfp_request_duration_seconds_bucket{{verb="{verb}",le="{le}"}} {cumulative}')
+            lines.append(f'sfp_request_duration_seconds_sum{{verb="{verb}"}} {total.seconds[slot]}')
+            lines.append(f'sfp_request_duration_seconds_count{{verb="{verb}"}} {total.requests[slot]}')
+        if self.pool:
+            lines += self.renderPool(self.pool)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def renderPool(pool) -> list:
+        '''
+        :param pool: PoolStats, read without its lock: values may be a connection apart
+        :return: lines of the worker pool metrics
+        '''
+        return [
+            "# HELP sfp_pool_workers Threads of the worker pool.",
+            "# TYPE sfp_pool_workers gauge",
+            f"sfp_pool_workers {pool.workers}",
+            "# HELP sfp_pool_busy_workers Workers serving a connection.",
+            "# TYPE sfp_pool_busy_workers gauge",
+            f"sfp_pool_busy_workers {pool.busy}",
+            "# HELP sfp_pool_queue_capacity Connections the accept queue holds.",
+            "# TYPE sfp_pool_queue_capacity gauge",
+            f"sfp_pool_queue_capacity {pool.capacity}",
+            "# HELP sfp_pool_queued_connections Connections waiting for a worker.",
+            "# TYPE sfp_pool_queued_connections gauge",
+            f"sfp_pool_queued_connections {pool.queued}",
+            "# HELP sfp_pool_refused_total Connections refused because the accept queue was full.",
+            "# TYPE sfp_pool_refused_total counter",
+            f"sfp_pool_refused_total {pool.refused}",
+            "# HELP sfp_pool_queue_wait_seconds Time connections waited for a worker.",
+            "# TYPE sfp_pool_queue_wait_seconds summary",
+            f"sfp_pool_queue_wait_seconds_sum {pool.waited}",
+            f"sfp_pool_queue_wait_seconds_count {pool.served}",
+        ]
+
+
+def serveMetrics(metrics: Metrics, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    '''
+    Serves metrics over HTTP at /metrics, for Prometheus to scrape, from a daemon thread.
+    :param host: address to bind to, loopback by default: the endpoint has no authentication
+    :return: the HTTP server, already running
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics endpoint: " + format, *args)   # Formatted only if logged
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
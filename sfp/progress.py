@@ -0,0 +1,86 @@
+'''
+progress.py
+
+Progress reporting for file transfers.
+
+Transfer functions accept a progress callback, called as
+progress(transferred, total) after every chunk.
+'''
+
+import sys
+import time
+import threading
+
+__author__ = 'Giulio Corradini'
+
+
+class TransferProgress:
+    '''
+    Progress callback that prints transferred bytes and throughput on a single line.
+    '''
+
+    def __init__(self, filename: str, stream=sys.stderr, interval: float = 0.5):
+        '''
+        :param filename: name shown in front of the progress line
+        :param stream: text stream to print to
+        :param interval: minimum seconds between two updates
+        '''
+        self.filename = filename
+        self.stream = stream
+        self.interval = interval
+
+        self.started = time.monotonic()
+        self.last_update = 0.0
+
+    def __call__(self, transferred: int, total: int):
+        now = time.monotonic()
+        done = transferred >= total
+        if not done and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+
+        elapsed = max(now - self.started, 1e-6)
+        percent = 100 * transferred / total if total else 100
+        print(f"\r{self.filename}: {transferred}/{total} bytes ({percent:.0f}%) "
+              f"{formatRate(transferred / elapsed)}", end='\n' if done else '', file=self.stream, flush=True)
+
+
+def formatRate(bytes_per_second: float) -> str:
+    '''
+    Formats a throughput with a binary unit prefix.
+    :param bytes_per_second: throughput to format
+    :return: string like "12.3 MiB/s"
+    '''
+    for unit in ('B/s', 'KiB/s', 'MiB/s', 'GiB/s'):
+        if bytes_per_second < 1024 or unit == 'GiB/s':
+            return f"{bytes_per_second:.1f} {unit}"
+        bytes_per_second /= 1024
+
+
+class RangeProgress:
+    '''
+    Combines the progress of several ranges of the same file, transferred
+    in parallel, into a single progress(transferred, total) callback.
+    '''
+
+    def __init__(self, progress, total: int):
+        '''
+        :param progress: callback for the whole file, may be None
+        :param total: size of the whole file
+        '''
+        self.progress = progress
+        self.total = total
+        self.transferred = {}
+        self.lock = threading.Lock()
+
+    def forRange(self, offset: int):
+        '''
+        :param offset: first byte of the range, identifies it
+        :return: progress callback for the range starting at offset
+        '''
+        def update(transferred: int, total: int):
+            with self.lock:
+                self.transferred[offset] = transferred
+                if self.progress:
+                    self.progress(sum(self.transferred.values()), self.total)
+        return update
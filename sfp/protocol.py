@@ -0,0 +1,663 @@
+'''
+protocol.py
+
+Server side of SFP, free of I/O.
+
+A ServerSession is fed the bytes received from a client as they come, in
+chunks of any size, and tells its caller what to do next through actions:
+send these bytes, run this filesystem call, open the file of a transfer,
+write these bytes to it, send a range of it, and so on. It never touches a
+socket, a file or a clock itself, so the threaded, asyncio and select
+servers drive the same engine, each with its own I/O model: a driver loops
+on nextAction(), performs every action its own way (inline, in a thread
+pool, in a process pool...) and passes the result back with the next call.
+
+    action = session.nextAction()
+    while not isinstance(action, Close):
+        if isinstance(action, NeedData):
+            session.receiveData(socket.recv(...))   # b'' when the client closed
+            action = session.nextAction()
+        else:
+            action = session.nextAction(perform(action))
+
+When an action fails, e.g. a frame doesn't decompress or a profiler is
+already running, the driver passes the exception with actionFailed()
+instead, and the session answers the client as appropriate. So it does
+with the OSError of a filesystem action (FILESYSTEM_ACTIONS): the command
+is answered with ERROR, after receiving the rest of an upload's payload,
+and the session goes on. Other OSErrors are raised back: the connection
+is lost. Once a download's size is out, instead, the
+client waits for that many bytes: a driver that can't send them, because
+the file has been truncated meanwhile, raises TruncatedFileError and closes
+the connection.
+
+Responses (Send) may be queued by the driver and sent together the next
+time the session needs data, so that pipelined commands are answered with
+as few packets as possible.
+
+CommandParser, the incremental parser of the byte stream, works without a
+session, e.g. to benchmark it (see benchmarks/parser_benchmark.py).
+'''
+
+import os
+import logging
+import datetime as dt
+import functools
+from collections import namedtuple
+
+from sfp.ranges import parseByteRange
+from sfp.uploads import openPartial, partialSize, beginRanges, recordRange, commitUpload
+from sfp.index import DirectoryIndex
+from sfp.checksum import chooseAlgorithm, newDigest, storeDigest, storedDigest, DigestSet
+from sfp.blobs import BlobStore, newContentDigest
+from sfp.compression import chooseMethod, parseFrameHeader, FRAME_HEADER, RAW
+from sfp.framing import VERSION_PREFIX, VERSION_ACCEPTED, HEADER, encodeMessage, parseHeader, decodeFields
+from sfp.metrics import Metrics, Recorder
+
+__author__ = 'Giulio Corradini'
+
+MAX_PROFILE_SECONDS = 600  # Longest capture the P command may ask for
+
+# Per-connection messages, which servers may sample or rate-limit (see sockutil/logqueue.py).
+# Arguments are %-style, formatted only if a record is written.
+request_log = logging.getLogger('sfp.requests')
+
+USAGE = '''Students File Protocol commands usage:
+    U - Upload a file
+    R - Resume an upload
+    A - Announce an upload by digest, skip it if the server has the content
+    D - Download a file
+    L - List files in directory
+    E - Enable protocol extensions (checksums, compression)
+    H - Show this help message
+    S - Show server statistics (admins only)
+    P - Profile the server for some seconds, or dump its stacks (admins only)
+    Q - Disconnect from server, close client\n\n'''
+
+# Actions returned by ServerSession.nextAction()
+NeedData = namedtuple('NeedData', '')           # Receive more bytes, then call receiveData()
+Send = namedtuple('Send', 'data')               # Send bytes to the client, responses may be queued
+Disk = namedtuple('Disk', 'call')               # Run a blocking filesystem call, pass back its result
+OpenFile = namedtuple('OpenFile', 'call')       # Open the file of a transfer with call, once the transfer is admitted
+Write = namedtuple('Write', 'data digest cost')     # Write data to the open file, updating digest (if any) too.
+                                                    # cost is the number of bytes the client sent for it
+Decode = namedtuple('Decode', 'method flag block')  # Decompress a frame with compression.decodeBlock, pass back the block
+SendFile = namedtuple('SendFile', 'offset count digest compression')
+# Send count bytes of the open file from offset, updating digest (if any), as frames if compression is set
+CloseFile = namedtuple('CloseFile', '')         # Close the file of the transfer and release its slot
+Profile = namedtuple('Profile', 'seconds')      # Profile the server and pass back the report path,
+                                                # or dump the stacks if seconds is None
+Close = namedtuple('Close', '')                 # Session over, flush the responses and close the connection
+
+FILESYSTEM_ACTIONS = (Disk, OpenFile, Write, CloseFile)  # Their OSError is passed back to the session
+
+NEED_DATA = NeedData()
+CLOSE_FILE = CloseFile()
+CLOSE = Close()
+
+
+class TruncatedFileError(OSError):
+    '''
+    Raised by drivers when the file of a download ends before the bytes announced to the client.
+    '''
+
+
+def disk(function, *args, **kwargs) -> Disk:
+    return Disk(functools.partial(function, *args, **kwargs))
+
+
+def sanitizeInput(user_input: str, type = "str"):
+    '''
+    Sanitizes user input for path and dates.
+    :param input: string to santize.
+    :param type: "str" or "date", defines the sanity check method.
+    :return: input without paths for str.
+        True/False if date is valid.
+    '''
+    if type == "str":
+        head, tail = os.path.split(user_input)
+        return tail.strip().strip('.')  # Remove leading/trailing spaces and dots
+    elif type == "date":
+        try:
+            dt.datetime.strptime(user_input, "%Y%m%d")
+            return True
+        except ValueError:
+            return False
+
+
+class CommandParser:
+    '''
+    Incremental parser of the bytes sent by a client: text lines, SFP/2
+    messages and raw payloads, out of chunks fed as they are received.
+
+    A chunk fed while nothing is buffered is kept as it is, so payloads
+    usually go from the socket to the file without being copied. Looking
+    for the end of a line resumes where the previous attempt stopped, and a
+    message header is parsed once however many chunks its body takes.
+    '''
+    def __init__(self):
+        self._data = b''    # bytes or bytearray, buffered bytes start at _start
+        self._start = 0
+        self._scanned = 0   # Bytes before this offset hold no LF
+        self._header = None     # Parsed header of the message whose body is awaited
+        self.eof = False    # The client closed its side
+
+    def __len__(self) -> int:
+        return len(self._data) - self._start
+
+    def feed(self, data: bytes) -> None:
+        '''
+        :param data: bytes received, empty when the client closed the connection
+        '''
+        if not data:
+            self.eof = True
+        elif not len(self):
+            self._data, self._start, self._scanned = data, 0, 0
+        else:
+            if not isinstance(self._data, bytearray) or self._start > len(self._data) // 2:
+                with memoryview(self._data) as view:
+                    self._data = bytearray(view[self._start:])
+                self._scanned -= self._start
+                self._start = 0
+            self._data += data
+
+    def take(self, n: int) -> bytes:
+        '''
+        Consumes up to n buffered bytes.
+        '''
+        end = min(self._start + n, len(self._data))
+        if self._start == 0 and end == len(self._data) and isinstance(self._data, bytes):
+            taken = self._data  # The whole chunk, no copy
+        else:
+            taken = self._data[self._start:end]
+        self._advance(end)
+        return taken
+
+    def _advance(self, end: int) -> None:
+        self._start = end
+        if self._start == len(self._data):
+            self._data, self._start, self._scanned = b'', 0, 0
+
+    def line(self):
+        '''
+        :return: next text line without its LF, None if it isn't complete yet
+        '''
+        end = self._data.find(b'\n', max(self._start, self._scanned))
+        if end == -1:
+            self._scanned = len(self._data)
+            return None
+        line = self._data[self._start:end]
+        self._advance(end + 1)
+        return line
+
+    def command(self, version: int):
+        '''
+        :param version: 1 for text lines, 2 for binary messages
+        :return: (verb followed by the arguments, request id) of the next command,
+            None if it isn't complete yet
+        :raise ValueError: if the command is invalid, the stream can't be trusted anymore
+        '''
+        if version == 1:
+            line = self.line()
+            if line is None:
+                return None
+            return line.decode('utf-8').split(' '), 0     # UnicodeDecodeError is a ValueError
+
+        if self._header is None:
+            if len(self) < HEADER.size:
+                return None
+            self._header = parseHeader(self.take(HEADER.size))
+        verb, count, request_id, length = self._header
+        if len(self) < length:
+            return None
+        self._header = None
+        return [verb, *decodeFields(self.take(length), count)], request_id
+
+
+class ServerContext:
+    '''
+    State shared by every session of a server process.
+    '''
+    def __init__(self):
+        self.index = DirectoryIndex()
+        self.blobs: BlobStore = None    # Deduplicating storage, None if disabled
+        self.metrics = Metrics()        # Reported by S
+        self.admins = set()             # Users allowed to run admin commands
+
+    def completeUpload(self, working_directory: str, filename: str, filesize: int, hexdigest: str = None) -> None:
+        '''
+        Moves a received upload out of staging, stores it as a blob and indexes it.
+        A single Disk action, e.g. a single hop to a thread pool.
+        :param hexdigest: content digest computed while receiving, None to hash the file
+        '''
+        commitUpload(working_directory, filename, filesize)
+        if self.blobs: self.blobs.ingest(working_directory, filename, hexdigest)
+        self.index.add(working_directory, filename, filesize)
+
+    def announcedUpload(self, working_directory: str, filename: str, filesize: int, hexdigest: str) -> str:
+        '''
+        Creates an announced upload from the blob store, if it holds its content.
+        :return: response to A
+        '''
+        if os.path.exists(os.path.join(working_directory, filename)):
+            return 'EXISTS'
+        elif self.blobs and self.blobs.linkInto(hexdigest, filesize, working_directory, filename):
+            self.index.add(working_directory, filename, filesize)
+            return 'OK'
+        else:
+            return 'MISSING'   # The client has to upload it
+
+
+class ServerSession:
+    def __init__(self, context: ServerContext, stats: Recorder = None):
+        '''
+        :param context: state shared with the other sessions
+        :param stats: recorder of the session's requests, see metrics.py. Drivers count bytes on it themselves
+        '''
+        self.context = context
+        self.stats = stats or Recorder()
+        self.parser = CommandParser()
+
+        self.user: str = None
+        self.working_directory: str = None
+        self.version = 1            # 2 if the client asked for binary framing at auth
+        self.request = ('', 0)      # Verb and id of the command being answered, with binary framing
+        self.checksum: str = None   # Algorithm negotiated with E, None if disabled
+        self.compression: str = None    # Method negotiated with E, None if disabled
+
+        self._handlers = {
+            'U': self._upload, 'R': self._upload, 'A': self._announce, 'D': self._download,
+            'L': self._list, 'E': self._extensions, 'H': self._help, 'S': self._statistics,
+            'P': self._profile, 'Q': self._quit,
+        }
+        self._steps = self._run()
+        self._closed = False
+        self._failure = None    # Error of the file being received, see _receiveFile
+
+    def receiveData(self, data: bytes) -> None:
+        '''
+        Feeds bytes received from the client, b'' once it closed the connection.
+        '''
+        self.parser.feed(data)
+
+    def nextAction(self, result=None, error: Exception = None):
+        '''
+        :param result: result of the previous action, for those that have one
+        :param error: exception raised by the previous action, if it failed
+        :return: next action for the driver, CLOSE once the session is over
+        '''
+        if self._closed:
+            return CLOSE
+        try:
+            if error is not None:
+                return self._steps.throw(error)
+            return self._steps.send(result)
+        except StopIteration:
+            self._closed = True
+            return CLOSE
+
+    def actionFailed(self, action, error: Exception):
+        '''
+        Passes back the exception raised by an action, if the session can answer it:
+        a refusal (ValueError, RuntimeError) or the OSError of a filesystem action.
+        :return: next action for the driver
+        :raise error: any other OSError, e.g. a reset connection, which ends the session
+        '''
+        if isinstance(error, OSError) and not isinstance(action, FILESYSTEM_ACTIONS):
+            raise error
+        return self.nextAction(error=error)
+
+    def respond(self, *fields: str, text: str = None) -> Send:
+        '''
+        Builds the response to the current command, as text line or binary message.
+        :param fields: tokens of the response, e.g. 'OK', or range and file size
+        :param text: text rendering, when it isn't the fields separated by spaces
+        '''
+        if self.version == 2:
+            return Send(encodeMessage(*self.request, fields))
+        return Send((" ".join(fields) + "\n" if text is None else text).encode('utf-8'))
+
+    #   Steps of the session, each yield hands an action to the driver
+    def _run(self):
+        request_log.debug("User requests auth")
+        line = yield from self._readLine()
+        if line is None:
+            return
+        try:
+            user_auth_str = line.decode('utf-8')
+        except UnicodeDecodeError:
+            user_auth_str = ''
+        if user_auth_str.startswith(VERSION_PREFIX):
+            user_auth_str = user_auth_str[len(VERSION_PREFIX):]
+            self.version = 2
+        sanitized = sanitizeInput(user_auth_str)  # Since a user might inject a malicious path as its username (e.g. ../)
+
+        if not sanitized:
+            yield Send(b'ERROR\n')
+            request_log.warning("Sent an invalid sequence as login name. Forcing disconnection")
+            return
+        self.user = sanitized
+        self.working_directory = dt.datetime.today().strftime("%Y%m%d") + self.user
+        try:
+            yield disk(os.makedirs, self.working_directory, exist_ok=True)
+        except (OSError, ValueError) as e:
+            yield Send(b'ERROR\n')
+            request_log.warning("Can't create the directory of %s: %s", self.user, e)
+            return
+        yield Send(VERSION_ACCEPTED if self.version == 2 else b'OK\n')
+        request_log.debug("%s logged in", self.user)
+
+        while True:
+            self.stats.end()    # The previous command has been served
+            command = yield from self._readCommand()
+            if command is None:
+                break
+            self.stats.begin(command[0])
+
+            handler = self._handlers.get(command[0])
+            if handler is None:
+                yield self.respond('INVALID')
+                continue
+            try:
+                if (yield from handler(command[0], command[1:])):
+                    break
+            except (OSError, ValueError) as e:  # Raised by a filesystem action, e.g. a full disk
+                request_log.warning("%s: %s failed: %s", self.user, command[0], e)
+                yield self.respond('ERROR')
+
+        self.stats.end()
+
+    def _readLine(self):
+        while True:
+            line = self.parser.line()
+            if line is not None:
+                return line
+            if self.parser.eof:
+                return None
+            yield NEED_DATA
+
+    def _readCommand(self):
+        '''
+        :return: next command, verb followed by the arguments. None if the client closed
+            the connection or sent an invalid command
+        '''
+        while True:
+            try:
+                parsed = self.parser.command(self.version)
+            except ValueError as e:
+                request_log.warning("%s sent an invalid message: %s", self.user, e)
+                return None
+            if parsed is not None:
+                command, request_id = parsed
+                self.request = (command[0], request_id)
+                return command
+            if self.parser.eof:
+                request_log.info("%s closed the connection", self.user)
+                return None
+            yield NEED_DATA
+
+    def _readExactly(self, n: int):
+        '''
+        :return: n bytes, None if the client closed the connection before sending them
+        '''
+        while len(self.parser) < n:
+            if self.parser.eof:
+                return None
+            yield NEED_DATA
+        return self.parser.take(n)
+
+    def _receiveFile(self, opener: Disk, n: int, digest=None):
+        '''
+        Receives n bytes of a file from the client, raw or as frames, and writes them to the file opened by opener.
+        If the file can't be opened or written, the rest of the payload is received and discarded all the same,
+        then the error is raised: the client is waiting for a response by then.
+        :return: False if the client disconnected or sent invalid frames, the session must end
+        '''
+        self._failure = None
+        try:
+            yield OpenFile(opener.call)
+        except (OSError, ValueError) as e:
+            self._failure = e
+        if self.compression:
+            received = yield from self._receiveFrames(n, digest)
+        else:
+            received = yield from self._receiveRaw(n, digest)
+        try:
+            yield CLOSE_FILE    # Releases the slot even if the file didn't open
+        except (OSError, ValueError) as e:  # The last write failed, if the driver overlaps them
+            self._failure = self._failure or e
+
+        if not received:
+            request_log.warning("%s disconnected", self.user)
+            return False
+        if self._failure:
+            raise self._failure
+        return True
+
+    def _write(self, data: bytes, digest, cost: int):
+        '''
+        Writes a chunk of the file being received, unless a previous write failed.
+        '''
+        if self._failure is None:
+            try:
+                yield Write(data, digest, cost)
+            except (OSError, ValueError) as e:
+                self._failure = e
+
+    def _receiveRaw(self, n: int, digest):
+        remaining = n
+        while remaining > 0:
+            if not len(self.parser):
+                if self.parser.eof:
+                    return False
+                yield NEED_DATA
+                continue
+            chunk = self.parser.take(remaining)
+            yield from self._write(chunk, digest, len(chunk))
+            remaining -= len(chunk)
+        return True
+
+    def _receiveFrames(self, n: int, digest):
+        '''
+        Receives the frames carrying n bytes of a file (see sfp/compression.py) and writes their blocks.
+        '''
+        remaining = n
+        while remaining > 0:
+            header = yield from self._readExactly(FRAME_HEADER.size)
+            if header is None:
+                return False
+            try:
+                flag, length = parseFrameHeader(header)
+                block = yield from self._readExactly(length)
+                if block is None:
+                    return False
+                cost = FRAME_HEADER.size + length
+                if flag != RAW:
+                    block = yield Decode(self.compression, flag, block)
+                if len(block) > remaining:
+                    raise ValueError(f"{len(block) - remaining} bytes more than announced")
+            except ValueError as e:
+                request_log.warning("%s sent an invalid frame: %s", self.user, e)
+                return False
+            yield from self._write(block, digest, cost)
+            remaining -= len(block)
+        return True
+
+    #   Command handlers, they return True if the session must end
+    def _upload(self, verb: str, args: list):   # Upload, or resume a partial upload
+        try:
+            filename, filesize, *byte_range = args
+            filesize = int(filesize)
+            if filesize < 0:
+                raise ValueError(f"Negative file size {filesize}")
+            if byte_range:  # One of the ranges of a parallel upload
+                offset, count = parseByteRange(byte_range, filesize, clamp=False)
+                if count < 1:
+                    raise ValueError("Empty range")    # Nothing to record, empty files are uploaded whole
+        except ValueError:
+            yield self.respond('ERROR')
+            return
+
+        filename = sanitizeInput(filename)
+        working_directory = self.working_directory
+
+        if (yield disk(os.path.exists, os.path.join(working_directory, filename))):
+            yield self.respond('EXISTS')
+            return
+        elif byte_range:
+            yield disk(beginRanges, working_directory, filename, filesize)
+            yield self.respond('OK')
+            digest = newDigest(self.checksum) if self.checksum else None
+            if not (yield from self._receiveFile(disk(openPartial, working_directory, filename, offset),
+                                                 count, digest)):
+                return True
+            if digest: yield self.respond(digest.hexdigest())
+
+            if (yield disk(recordRange, working_directory, filename, offset, count, filesize)):
+                yield disk(self.context.completeUpload, working_directory, filename, filesize)
+            else:
+                request_log.debug("%s uploaded bytes %d-%d of %s", self.user, offset, offset + count, filename)
+                return
+        else:
+            offset = 0
+            if verb == 'R':
+                offset = yield disk(partialSize, working_directory, filename, filesize)
+                if offset > filesize: offset = 0    # Not the same file, start over
+                yield self.respond(str(offset))
+            else:
+                yield self.respond('OK')
+
+            digest = newDigest(self.checksum) if self.checksum else None
+            content = newContentDigest() if self.context.blobs and not offset else None  # Resumed uploads are hashed on commit
+            if not (yield from self._receiveFile(disk(openPartial, working_directory, filename, offset,
+                                                      truncate=not offset),
+                                                 filesize - offset, DigestSet(digest, content))):
+                return True
+            yield disk(self.context.completeUpload, working_directory, filename, filesize,
+                       content.hexdigest() if content else None)
+
+            if digest:
+                if not offset:  # The payload was the whole file
+                    yield disk(storeDigest, working_directory, filename, self.checksum, digest.hexdigest())
+                yield self.respond(digest.hexdigest())
+
+        request_log.info("%s uploaded a file: %s", self.user, filename)
+
+    def _announce(self, verb: str, args: list):     # Announce the digest of an upload, linked from the blob store if known
+        try:
+            filename, filesize, hexdigest = args
+            filesize = int(filesize)
+            if filesize < 0:
+                raise ValueError(f"Negative file size {filesize}")
+        except ValueError:
+            yield self.respond('ERROR')
+            return
+
+        filename = sanitizeInput(filename)
+
+        response = yield disk(self.context.announcedUpload, self.working_directory, filename, filesize, hexdigest)
+        yield self.respond(response)
+        if response == 'OK':
+            request_log.info("%s uploaded a file: %s, already stored", self.user, filename)
+
+    def _download(self, verb: str, args: list):
+        try:
+            fname, date, *byte_range = args
+        except ValueError:
+            yield self.respond('ERROR')
+            return
+        fname = sanitizeInput(fname)
+        if not sanitizeInput(date, type="date"):
+            yield self.respond('ERROR')
+            return
+
+        directory = f"{date}{self.user}"
+        path = os.path.join(directory, fname)
+        indexed = yield disk(self.context.index.lookup, directory, fname)
+        if indexed is None:
+            yield self.respond('NOTFOUND')
+            return
+
+        try:    # Before responding: once the size is out, the client waits for the bytes
+            yield OpenFile(functools.partial(open, path, 'rb'))
+            filesize = yield disk(os.path.getsize, path)    # The index misses changes that keep the directory's mtime
+            if filesize != indexed:
+                yield disk(self.context.index.add, directory, fname, filesize)
+
+            offset, count = 0, filesize
+            if byte_range:
+                offset, count = parseByteRange(byte_range, filesize)
+
+            digest, hexdigest = None, None
+            if self.checksum:
+                if count == filesize:
+                    hexdigest = yield disk(storedDigest, directory, fname, self.checksum)
+                if not hexdigest:
+                    digest = newDigest(self.checksum)
+        except (OSError, ValueError):
+            yield CLOSE_FILE    # Releases the slot
+            raise
+
+        if byte_range:  # Ranged download, respond with range length and file size
+            yield self.respond(str(count), str(filesize))
+        else:
+            yield self.respond(str(filesize))
+        yield SendFile(offset, count, digest, self.compression)
+        yield CLOSE_FILE
+
+        if digest:
+            hexdigest = digest.hexdigest()
+            if count == filesize:
+                yield disk(storeDigest, directory, fname, self.checksum, hexdigest)
+        if self.checksum:
+            yield self.respond(hexdigest)
+
+    def _list(self, verb: str, args: list):
+        date = args[0] if args else ''
+        if not sanitizeInput(date, type="date"):
+            yield self.respond('ERROR')
+            return
+
+        files = yield disk(self.context.index.listing, f"{date}{self.user}")
+        if files is None:
+            yield self.respond('NOTFOUND')
+        else:
+            yield self.respond(*files, text=", ".join(files) + "\n")
+
+    def _extensions(self, verb: str, args: list):   # Enable protocol extensions
+        self.checksum = chooseAlgorithm(args)
+        self.compression = chooseMethod(args)
+        accepted = [name for name in (self.checksum, self.compression) if name]
+        yield self.respond('OK', *accepted)
+
+    def _help(self, verb: str, args: list):
+        yield self.respond(USAGE, text=USAGE)
+
+    def _statistics(self, verb: str, args: list):   # Server statistics, for admins
+        if self.user in self.context.admins:
+            report = self.context.metrics.render() + "\n"
+            yield self.respond(report, text=report)
+        else:
+            yield self.respond('ERROR', text="ERROR\n\n")  # Double LF terminated, like any S response
+
+    def _profile(self, verb: str, args: list):      # Profiling, for admins
+        if self.user not in self.context.admins:
+            yield self.respond('ERROR')
+            return
+        try:
+            seconds = None  # Stacks only
+            if args != ['stacks']:
+                seconds = float(args[0])
+                if not 0 < seconds <= MAX_PROFILE_SECONDS:
+                    raise ValueError(f"Can't profile for {seconds} seconds")
+            path = yield Profile(seconds)
+        except (IndexError, ValueError, RuntimeError) as e:
+            request_log.warning("%s can't profile: %s", self.user, e)
+            yield self.respond('ERROR')
+            return
+        yield self.respond(path)
+
+    def _quit(self, verb: str, args: list):
+        yield self.respond('GOODBYE')
+        request_log.info("%s disconnected", self.user)
+        return True
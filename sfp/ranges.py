@@ -0,0 +1,45 @@
+'''
+ranges.py
+
+Byte ranges of ranged commands:
+    D <file name> <dirname> <offset> [<count>]
+    U <file name> <file size> <offset> [<count>]
+'''
+
+__author__ = 'Giulio Corradini'
+
+
+def parseByteRange(fields, total: int, clamp: bool = True):
+    '''
+    Parses the optional offset and count fields of a ranged command.
+    :param fields: list of one or two strings, offset and optional count
+    :param total: size of the whole file
+    :param clamp: clamp count to the end of the file, as downloads do. Uploads refuse a range past it instead
+    :return: (offset, count) tuple
+    :raise ValueError: if fields are malformed or the range doesn't start (with clamp) or end within the file
+    '''
+    if not 1 <= len(fields) <= 2:
+        raise ValueError(f"Expected offset and optional count, got {fields}")
+
+    offset = int(fields[0])
+    count = int(fields[1]) if len(fields) == 2 else total - offset
+    if offset < 0 or count < 0 or offset > total or not clamp and offset + count > total:
+        raise ValueError(f"Invalid range {offset}+{count} for a {total} bytes file")
+
+    return offset, min(count, total - offset)
+
+
+def splitRange(total: int, parts: int, min_size: int = 1048576):
+    '''
+    Splits a file into contiguous ranges, to be transferred in parallel.
+    :param total: size of the whole file
+    :param parts: maximum number of ranges
+    :param min_size: ranges smaller than this aren't worth their own connection
+    :return: list of (offset, count) tuples covering [0; total)
+    '''
+    if not total:
+        return [(0, 0)]
+
+    parts = max(1, min(parts, total // min_size))
+    size = -(-total // parts)   # Ceiling division
+    return [(offset, min(size, total - offset)) for offset in range(0, total, size)]
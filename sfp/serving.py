@@ -0,0 +1,253 @@
+'''
+serving.py
+
+What the SFP servers have in common around the sessions of protocol.py,
+whatever their I/O model.
+
+A server process has a single context, profiler and set of transfer limits,
+shared by all its clients and configured from the command line options of
+addServerOptions(). Downloads that can't be sent with sendfile, because they
+are checksummed, compressed or shaped, go out in the chunks (or frames) of
+fileFrames().
+
+BlockingHandler drives a session with blocking calls, in the thread serving
+the client, and serveThreaded() runs a server of such handlers: the
+threaded servers in students_file_transfer/ only tell it how to move bytes
+through their socket. The asyncio and select servers, which can't block,
+perform the actions their own way.
+'''
+
+import socket
+import logging
+import contextlib
+import socketserver
+
+from sfp.protocol import ServerContext, ServerSession, NeedData, Send, Disk, OpenFile, Write, Decode, SendFile, \
+    CloseFile, Profile, Close, TruncatedFileError, request_log
+from sfp.blobs import BlobStore
+from sfp.compression import worthCompressing, encodeBlock, decodeBlock, BLOCK_SIZE
+from sfp.shaping import TransferLimits
+from sfp.metrics import serveMetrics
+from sockutil.profiling import Profiler
+from sockutil.pool import PooledTCPServer
+
+__author__ = 'Giulio Corradini'
+
+CHUNK_SIZE = 65536  # Bytes received, or read from disk, at once: bounds per-connection memory spent on transfers
+
+context = ServerContext()   # Index, blob store (--blobs), metrics and admins (--admin) shared by every client
+profiler = Profiler()       # Captures started by SIGUSR1 or P, reports written to --profile-dir
+limits = TransferLimits()   # Set with --user-rate, --total-rate, --user-transfers and --total-transfers
+
+
+def addServerOptions(parser, shaping: bool = True) -> None:
+    '''
+    Adds the command line options every server accepts to an argparse parser.
+    :param shaping: also add bandwidth and transfer limits, for servers that can wait for them
+    '''
+    parser.add_argument("--address", "-a", default='', required=False, metavar="address")
+    parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    parser.add_argument("--blobs", default=None, required=False, metavar="directory",
+                        help="store identical uploads once, as hard links to files in directory")
+    if shaping:
+        parser.add_argument("--user-rate", type=int, default=None, required=False, metavar="bytes/s",
+                            help="bandwidth of each user's transfers")
+        parser.add_argument("--total-rate", type=int, default=None, required=False, metavar="bytes/s",
+                            help="bandwidth of all transfers together")
+        parser.add_argument("--user-transfers", type=int, default=None, required=False, metavar="transfers",
+                            help="transfers each user may run at once, the others wait their turn")
+        parser.add_argument("--total-transfers", type=int, default=None, required=False, metavar="transfers",
+                            help="transfers the server runs at once, the others wait their turn")
+    parser.add_argument("--metrics-port", type=int, default=None, required=False, metavar="port",
+                        help="serve Prometheus metrics on this port of localhost")
+    parser.add_argument("--admin", action="append", default=[], required=False, metavar="user",
+                        help="user allowed to run admin commands, may be repeated")
+    parser.add_argument("--profile-dir", default=None, required=False, metavar="directory",
+                        help="where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written")
+    parser.add_argument("--profile-seconds", type=float, default=None, required=False, metavar="seconds",
+                        help="length of the profiles started by SIGUSR1, 10 by default")
+
+
+def configureServer(blobs=None, metrics_port=None, admin_users=(), profile_dir=None, profile_seconds=None) -> None:
+    '''
+    Sets up the context and the profiler of the process, as the options of addServerOptions() ask.
+    Transfer limits are set with limits.configure(), profiling signals with profiler.installSignals().
+    :param blobs: directory of the deduplicating blob store, None to disable it
+    :param metrics_port: local port of the Prometheus endpoint, None to disable it
+    :param admin_users: users allowed to run admin commands, e.g. S
+    :param profile_dir: directory of profiling reports, the working directory by default
+    :param profile_seconds: length of the captures started by SIGUSR1
+    '''
+    if blobs:
+        context.blobs = BlobStore(blobs)
+    context.admins.update(admin_users)
+    if metrics_port:
+        serveMetrics(context.metrics, metrics_port)
+    if profile_dir:
+        profiler.directory = profile_dir
+    if profile_seconds:
+        profiler.seconds = profile_seconds
+
+
+def serveThreaded(handler, host, port, pool_workers=None, pool_queue=None, pool_policy='wait') -> None:
+    '''
+    Serves clients with handler, a BlockingHandler, until interrupted.
+    :param pool_workers: threads serving clients, None for a thread per client
+    :param pool_queue: clients waiting for a worker, twice the workers by default
+    :param pool_policy: what to do with new clients when the queue is full, see sockutil/pool.py
+    '''
+    logging.info(f"Starting server on port {port}")
+
+    if pool_workers:
+        server = PooledTCPServer((host, port), handler, pool_workers, pool_queue, pool_policy, refusal=b'ERROR\n')
+        context.metrics.pool = server.stats
+    else:
+        server = socketserver.ThreadingTCPServer((host, port), handler)
+
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Exiting")
+
+
+def fileFrames(fd, offset: int, n: int, digest=None, compression: str = None):
+    '''
+    Reads n bytes of fd starting from offset, one chunk at a time,
+    updating digest with every chunk on the way.
+    With compression enabled, every chunk is a block encoded as a frame.
+    :return: generator of the bytes to send
+    :raise TruncatedFileError: if fd ends before them
+    '''
+    fd.seek(offset)
+    method = compression
+    remaining = n
+    while remaining > 0:
+        chunk = fd.read(min(remaining, BLOCK_SIZE if compression else CHUNK_SIZE))
+        if not chunk:
+            raise TruncatedFileError(f"{fd.name} is shorter than {offset + n} bytes")
+        if digest: digest.update(chunk)
+
+        frame = chunk
+        if compression:
+            if remaining == n and not worthCompressing(fd.name, chunk):
+                method = None   # Raw frames from now on, compressing isn't worth the CPU
+            frame = encodeBlock(method, chunk)  # zlib, bz2 and lzma release the GIL meanwhile
+        remaining -= len(chunk)
+        yield frame
+
+
+class BlockingHandler:
+    '''
+    Mixin of socketserver request handlers, serving a session with blocking calls.
+    The handler calls openSession() once connected and closeSession() when finished,
+    and implements how bytes move through its connection: receive(), respond(),
+    sendPayload(), sendZeroCopy() and, if it queues responses, flush().
+    '''
+    def openSession(self) -> None:
+        self.stats = context.metrics.openSession()
+        self.session = ServerSession(context, self.stats)
+        self.transfer = contextlib.ExitStack()  # Slot and file of the running transfer
+        self.file = None
+
+    def closeSession(self) -> None:
+        self.transfer.close()   # Interrupted transfer, if any
+        profiler.checkpoint(leave=True)     # Pooled workers then wait for a connection, unprofiled
+        context.metrics.closeSession(self.stats)
+
+    def handle(self) -> None:
+        try:
+            action = self.session.nextAction()
+            while not isinstance(action, Close):
+                profiler.checkpoint()   # Joins or leaves captures before Python 3.12, see sockutil/profiling.py
+                if isinstance(action, NeedData):
+                    self.flush()    # No more pipelined commands, answer the previous ones
+                    data = self.receive(CHUNK_SIZE)
+                    self.stats.received += len(data)
+                    self.session.receiveData(data)
+                    action = self.session.nextAction()
+                    continue
+
+                try:
+                    result = self.perform(action)
+                except (ValueError, RuntimeError, OSError) as e:    # Refused, e.g. an invalid frame, or a disk error
+                    action = self.session.actionFailed(action, e)
+                else:
+                    action = self.session.nextAction(result)
+
+            self.flush()
+
+        except TruncatedFileError as e:
+            request_log.warning("%s, closing the connection", e)
+        except socket.error:
+            request_log.info("Connection reset")
+
+        request_log.info("Finished")
+
+    def perform(self, action):
+        '''
+        Performs an action of the session, see sfp/protocol.py.
+        :return: its result, for the actions that have one
+        '''
+        if isinstance(action, Send):
+            self.respond(action.data)
+        elif isinstance(action, Disk):
+            return action.call()
+        elif isinstance(action, Write):
+            self.file.write(action.data)
+            if action.digest: action.digest.update(action.data)
+            limits.pace(self.session.user, action.cost)
+        elif isinstance(action, Decode):
+            return decodeBlock(action.method, action.flag, action.block)    # Releases the GIL meanwhile
+        elif isinstance(action, OpenFile):
+            self.transfer.enter_context(limits.slot(self.session.user))
+            self.file = self.transfer.enter_context(action.call())
+        elif isinstance(action, SendFile):
+            self.flush()    # File data follows its response, and is never queued
+            if action.digest or action.compression or limits.shaper:
+                for frame in fileFrames(self.file, action.offset, action.count, action.digest, action.compression):
+                    self.sendPayload(frame)
+                    self.stats.sent += len(frame)
+                    limits.pace(self.session.user, len(frame))
+            elif action.count:
+                sent = self.sendZeroCopy(self.file, action.offset, action.count)
+                self.stats.sent += sent
+                if sent < action.count:     # The client waits for the rest, the session can't go on
+                    raise TruncatedFileError(f"{self.file.name} is shorter than {action.offset + action.count} bytes")
+        elif isinstance(action, CloseFile):
+            self.transfer.close()
+            self.file = None
+        elif isinstance(action, Profile):
+            if action.seconds is None:
+                return profiler.dumpStacks()
+            return profiler.capture(action.seconds)    # Blocks this client only
+
+    def receive(self, n: int) -> bytes:
+        '''
+        :return: up to n bytes from the client, b'' once it closed the connection
+        '''
+        raise NotImplementedError
+
+    def respond(self, data: bytes) -> None:
+        '''
+        Sends a response, or queues it until flush() is called. Counts the bytes sent on self.stats.
+        '''
+        raise NotImplementedError
+
+    def sendPayload(self, data: bytes) -> None:
+        '''
+        Sends file data, right away.
+        '''
+        raise NotImplementedError
+
+    def sendZeroCopy(self, fd, offset: int, count: int) -> int:
+        '''
+        Sends count bytes of fd starting from offset, zero-copy where possible.
+        :return: bytes sent, fewer than count if fd ended before
+        '''
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        '''
+        Sends the queued responses.
+        '''
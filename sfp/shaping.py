@@ -0,0 +1,223 @@
+'''
+shaping.py
+
+Bandwidth shaping and admission control of file transfers.
+
+Payloads of U, R and D pay for their bytes in token buckets, one per user
+and one for the whole server: a transfer that runs out of tokens sleeps
+until they are refilled at the configured rate. Before starting, a
+transfer also takes a slot from the admission control, which caps the
+transfers running at once per user and in total and queues the others.
+
+Text commands (L, H, E, A, Q) go through neither, so they are answered
+right away while bulk transfers are being throttled or queued.
+'''
+
+import time
+import asyncio
+import threading
+import contextlib
+import collections
+from typing import Optional
+
+__author__ = 'Giulio Corradini'
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        '''
+        :param rate: bytes per second
+        :param burst: bytes that may be sent at once after an idle period, a second's worth by default
+        '''
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> float:
+        '''
+        Takes n tokens, going into debt if there aren't enough.
+        Never blocks, so it serves threads and event loops alike.
+        :return: seconds the caller has to wait before sending the n bytes
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Shaper:
+    def __init__(self, user_rate: Optional[float] = None, total_rate: Optional[float] = None):
+        '''
+        :param user_rate: bytes per second each user may transfer, None for no limit
+        :param total_rate: bytes per second of the whole server, None for no limit
+        '''
+        self.user_rate = user_rate
+        self.total = TokenBucket(total_rate) if total_rate else None
+        self.users = {}     # user -> TokenBucket
+        self._lock = threading.Lock()
+
+    def reserve(self, user: str, n: int) -> float:
+        '''
+        Charges n transferred bytes to user and to the server.
+        :return: seconds to wait before transferring more
+        '''
+        delay = 0.0
+        if self.total:
+            delay = self.total.reserve(n)
+        if self.user_rate:
+            with self._lock:
+                bucket = self.users.get(user)
+                if bucket is None:
+                    bucket = self.users[user] = TokenBucket(self.user_rate)
+            delay = max(delay, bucket.reserve(n))
+        return delay
+
+
+class Ticket:
+    def __init__(self, user: str):
+        self.user = user
+        self.granted = False
+
+
+class Admission:
+    '''
+    Decides which queued transfers may start: at most per_user at once for
+    each user, and at most total overall. A free slot goes to the waiting user
+    with the fewest transfers running, oldest request first, so a user who
+    queues many transfers can't starve the others.
+    Holds no lock: TransferGate and AsyncTransferGate serialize the calls.
+    '''
+    def __init__(self, per_user: Optional[int] = None, total: Optional[int] = None):
+        self.per_user = per_user
+        self.total = total
+        self.running = collections.Counter()    # user -> transfers running
+        self.waiting = []   # Tickets, in arrival order
+
+    def enqueue(self, user: str) -> Ticket:
+        ticket = Ticket(user)
+        self.waiting.append(ticket)
+        self._grant()
+        return ticket
+
+    def leave(self, ticket: Ticket) -> None:
+        '''
+        Ends a transfer, or gives up waiting for it.
+        '''
+        if ticket.granted:
+            self.running[ticket.user] -= 1
+            if not self.running[ticket.user]:
+                del self.running[ticket.user]
+        else:
+            self.waiting.remove(ticket)
+        self._grant()
+
+    def _grant(self) -> None:
+        while self.waiting and (self.total is None or sum(self.running.values()) < self.total):
+            eligible = [ticket for ticket in self.waiting
+                        if self.per_user is None or self.running[ticket.user] < self.per_user]
+            if not eligible:
+                return
+            ticket = min(eligible, key=lambda t: self.running[t.user])     # First of the least served
+            self.waiting.remove(ticket)
+            ticket.granted = True
+            self.running[ticket.user] += 1
+
+
+class TransferGate:
+    '''
+    Admission control for servers with a thread per connection.
+    '''
+    def __init__(self, per_user: Optional[int] = None, total: Optional[int] = None):
+        self.admission = Admission(per_user, total)
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def transfer(self, user: str):
+        '''
+        Blocks until user may start a transfer, which lasts as long as the with block.
+        '''
+        with self._condition:
+            ticket = self.admission.enqueue(user)
+            self._condition.wait_for(lambda: ticket.granted)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.admission.leave(ticket)
+                self._condition.notify_all()
+
+
+class AsyncTransferGate:
+    '''
+    Admission control for asyncio servers. Must be used from a single event loop.
+    '''
+    def __init__(self, per_user: Optional[int] = None, total: Optional[int] = None):
+        self.admission = Admission(per_user, total)
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def transfer(self, user: str):
+        '''
+        Waits until user may start a transfer, which lasts as long as the async with block.
+        '''
+        ticket = self.admission.enqueue(user)
+        try:
+            async with self._condition:
+                await self._condition.wait_for(lambda: ticket.granted)
+            yield
+        finally:
+            self.admission.leave(ticket)    # Also when the client goes away while waiting
+            async with self._condition:
+                self._condition.notify_all()
+
+
+class TransferLimits:
+    '''
+    Bandwidth shaping and admission control of a server, both disabled until configure() is called
+    with some limit, so that drivers can check them on every transfer without testing for None.
+    '''
+    def __init__(self):
+        self.shaper: Optional[Shaper] = None
+        self.gate = None    # TransferGate or AsyncTransferGate
+
+    def configure(self, user_rate=None, total_rate=None, user_transfers=None, total_transfers=None,
+                  gate=TransferGate) -> None:
+        '''
+        :param user_rate: bytes per second each user may transfer, None for no limit
+        :param total_rate: bytes per second of the whole server, None for no limit
+        :param user_transfers: transfers running at once for each user, the others are queued
+        :param total_transfers: transfers running at once on the server, the others are queued
+        :param gate: TransferGate for threaded servers, AsyncTransferGate for asyncio ones
+        '''
+        self.shaper = Shaper(user_rate, total_rate) if user_rate or total_rate else None
+        self.gate = gate(user_transfers, total_transfers) if user_transfers or total_transfers else None
+
+    def slot(self, user: str):
+        '''
+        Waits for the admission control to let user start a transfer.
+        :return: context manager holding the slot (an async one with AsyncTransferGate),
+            a no-op if transfers aren't limited
+        '''
+        if self.gate is None:
+            return contextlib.nullcontext()
+        return self.gate.transfer(user)
+
+    def pace(self, user: str, n: int) -> None:
+        '''
+        Charges n transferred bytes to user's bandwidth, sleeping if it's exhausted.
+        '''
+        if self.shaper:
+            delay = self.shaper.reserve(user, n)
+            if delay: time.sleep(delay)
+
+    async def paceAsync(self, user: str, n: int) -> None:
+        '''
+        Like pace(), without blocking the event loop.
+        '''
+        if self.shaper:
+            delay = self.shaper.reserve(user, n)
+            if delay: await asyncio.sleep(delay)
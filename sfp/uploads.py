@@ -0,0 +1,186 @@
+'''
+uploads.py
+
+Staging of uploads in progress.
+
+Files being uploaded are written to a hidden directory inside the user's
+working directory, and moved next to the completed files only once every
+byte has been received. A dropped connection leaves a partial file that
+a later resume command (R) can continue, without ever exposing a
+truncated file to L and D.
+
+Parallel uploads write disjoint byte ranges of the same partial file over
+several connections. Each connection appends the range it completed to a
+hidden ranges file next to the partial file; whoever completes the last
+missing range moves the file out of staging. The ranges file starts with
+the size of the upload: ranges left by an abandoned upload of another size
+are discarded, instead of counting toward the new one.
+'''
+
+import os
+
+__author__ = 'Giulio Corradini'
+
+PARTIAL_DIRECTORY = '.partial'
+
+
+def partialPath(working_directory: str, filename: str) -> str:
+    '''
+    Path of the partial upload of filename, creating the staging directory if needed.
+    :param working_directory: user's working directory
+    :param filename: sanitized file name
+    '''
+    staging = os.path.join(working_directory, PARTIAL_DIRECTORY)
+    os.makedirs(staging, exist_ok=True)
+    return os.path.join(staging, filename)
+
+
+def rangesPath(working_directory: str, filename: str) -> str:
+    '''
+    Path of the file listing completed ranges of a parallel upload.
+    Sanitized file names never start with a dot, so it can't clash with a partial file.
+    '''
+    return os.path.join(working_directory, PARTIAL_DIRECTORY, f".{filename}.ranges")
+
+
+def openPartial(working_directory: str, filename: str, offset: int = 0, truncate: bool = False):
+    '''
+    Opens the partial file of filename for writing, creating it if needed.
+    :param offset: position to start writing from
+    :param truncate: discard any byte and range already received
+    :return: binary file object positioned at offset
+    '''
+    path = partialPath(working_directory, filename)
+    flags = os.O_WRONLY | os.O_CREAT
+    if truncate:
+        flags |= os.O_TRUNC
+        _removeRanges(working_directory, filename)
+
+    fd = os.fdopen(os.open(path, flags, 0o644), 'wb')
+    fd.seek(offset)
+    return fd
+
+
+def partialSize(working_directory: str, filename: str, filesize: int = None) -> int:
+    '''
+    Number of bytes of filename already received by previous uploads,
+    counting from the start of the file without gaps.
+    :param filesize: size of the upload being resumed, if known
+    :return: length of the received prefix, 0 if there is no partial file
+        or it was left by a parallel upload of another size
+    '''
+    try:
+        with open(rangesPath(working_directory, filename)) as fd:
+            recorded = _recordedSize(fd)
+            if recorded is None or filesize is not None and recorded != filesize:
+                return 0
+            return _coveredPrefix(fd, recorded)
+    except FileNotFoundError:
+        pass
+
+    try:
+        return os.path.getsize(os.path.join(working_directory, PARTIAL_DIRECTORY, filename))
+    except FileNotFoundError:
+        return 0
+
+
+def beginRanges(working_directory: str, filename: str, filesize: int) -> None:
+    '''
+    Prepares the staging of a parallel upload, before receiving one of its ranges.
+    Ranges recorded by an upload of another size are discarded, and the partial file
+    is resized, by the first connection of the upload: the others find its ranges file.
+    '''
+    path = rangesPath(working_directory, filename)
+    staged = partialPath(working_directory, filename)
+    while True:
+        try:
+            with open(path) as fd:
+                if _recordedSize(fd) == filesize:
+                    return
+            os.remove(path)     # Left by an abandoned upload
+        except FileNotFoundError:
+            pass
+        try:
+            with open(path, 'x') as fd:
+                fd.write(f"size {filesize}\n")
+        except FileExistsError:
+            continue    # Created meanwhile by another connection, check its size
+        with os.fdopen(os.open(staged, os.O_WRONLY | os.O_CREAT, 0o644), 'wb') as fd:
+            fd.truncate(filesize)   # Never below the bytes of other ranges: they're within filesize
+        return
+
+
+def recordRange(working_directory: str, filename: str, offset: int, count: int, filesize: int) -> bool:
+    '''
+    Records a completely received range of a parallel upload, started with beginRanges.
+    Small appends are atomic, so concurrent connections (or processes) may record at once.
+    :return: True if every byte of the file has now been received
+    '''
+    path = rangesPath(working_directory, filename)
+    with open(path, 'a') as fd:
+        fd.write(f"{offset} {count}\n")
+
+    with open(path) as fd:
+        if _recordedSize(fd) != filesize:   # Reset meanwhile by an upload of another size
+            return False
+        return _coveredPrefix(fd, filesize) >= filesize
+
+
+def commitUpload(working_directory: str, filename: str, filesize: int = None) -> str:
+    '''
+    Moves a completely received upload out of the staging directory.
+    With parallel uploads, another connection may have committed the file already.
+    :param filesize: size of the upload, the partial file is cut to it. None to leave it as it is
+    :return: path of the completed file
+    '''
+    path = os.path.join(working_directory, filename)
+    staged = partialPath(working_directory, filename)
+    try:
+        if filesize is not None:
+            os.truncate(staged, filesize)   # Bytes past it were left by an earlier, longer upload
+        os.replace(staged, path)
+    except FileNotFoundError:
+        if not os.path.exists(path):
+            raise
+    _removeRanges(working_directory, filename)
+    return path
+
+
+def _recordedSize(fd):
+    '''
+    Reads the "size" line heading a ranges file.
+    :return: size of the upload the ranges belong to, None if the file has no valid header
+    '''
+    fields = fd.readline().split()
+    if len(fields) != 2 or fields[0] != 'size' or not fields[1].isdigit():
+        return None
+    return int(fields[1])
+
+
+def _coveredPrefix(fd, filesize: int) -> int:
+    '''
+    Merges the "offset count" lines following the header and returns the end of the range starting at 0.
+    Ranges which don't fit in filesize can't belong to the upload, and are ignored.
+    '''
+    ranges = []
+    for line in fd:
+        try:
+            offset, count = map(int, line.split())
+        except ValueError:  # Torn or empty line
+            continue
+        if 0 <= offset and 0 < count and offset + count <= filesize:
+            ranges.append((offset, count))
+
+    covered = 0
+    for offset, count in sorted(ranges):
+        if offset > covered:
+            break
+        covered = max(covered, offset + count)
+    return covered
+
+
+def _removeRanges(working_directory: str, filename: str) -> None:
+    try:
+        os.remove(rangesPath(working_directory, filename))
+    except FileNotFoundError:
+        pass
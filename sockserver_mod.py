@@ -15,6 +15,8 @@ import threading
 import argparse
 import sys
 
+from sockutil.profiling import Profiler
+
 quitting_on_idle = threading.Event()
 
 class CustomProtocolRequestHandler(socketserver.BaseRequestHandler):
@@ -60,7 +62,9 @@ class CustomProtocolRequestHandler(socketserver.BaseRequestHandler):
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
-def main(host, port):
+def main(host, port, profile_dir='.'):
+    Profiler(profile_dir).installSignals()  # SIGUSR1 profiles, SIGUSR2 dumps stacks
+
     with ThreadedTCPServer((host, port), CustomProtocolRequestHandler) as server:
 
         def checkForShutdown(): #closure
@@ -79,6 +83,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--address", "-a", default='', required=False, metavar="address")
     parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    parser.add_argument("--profile-dir", default='.', required=False, metavar="directory",
+                        help="where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written")
 
     args = parser.parse_args(sys.argv[1:])
-    main(args.address, args.port)
\ No newline at end of file
+    main(args.address, args.port, args.profile_dir)
\ No newline at end of file
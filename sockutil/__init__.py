@@ -0,0 +1,15 @@
+'''
+sockutil
+
+Protocol-independent socket helpers shared by the examples in this repository.
+
+Scripts in subdirectories put the repository root on sys.path
+before importing from here.
+'''
+
+from sockutil.buffer import SocketBuffer
+from sockutil.profiling import Profiler
+from sockutil.logqueue import configureLogging, limitLogger, addLoggingOptions, configureFromOptions
+from sockutil.pool import PooledTCPServer, addPoolOptions
+
+__author__ = 'Giulio Corradini'
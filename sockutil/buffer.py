@@ -0,0 +1,122 @@
+'''
+buffer.py
+
+Offset buffer for socket I/O.
+
+Bytes are kept in a bytearray between a read offset (start) and a write
+offset (end). Consuming from the front only moves the read offset, so it
+costs O(1) instead of shifting every remaining byte like `del buf[:n]`.
+Free space at the front is reclaimed lazily, when the tail is full.
+
+Incoming data is received with recv_into() straight into the free tail,
+through a memoryview, without intermediate bytes objects.
+'''
+
+__author__ = 'Giulio Corradini'
+
+
+class SocketBuffer:
+    def __init__(self, size: int = 4096):
+        '''
+        :param size: initial capacity in bytes, the buffer grows when needed
+        '''
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._end = 0
+
+        self._scan_sep = None   # Separator of the last unsuccessful find()
+        self._scan_from = 0     # and where the next find() for it can resume
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def recvFrom(self, sock, nbytes: int = 4096) -> int:
+        '''
+        Receives from sock into the buffer, with a single recv_into call.
+        :param sock: socket to receive from
+        :param nbytes: minimum free space to make available before receiving
+        :return: number of received bytes, 0 if the peer closed the connection
+        '''
+        self._reserve(nbytes)
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def append(self, data) -> None:
+        '''
+        Appends a bytes-like object at the end of the buffer.
+        '''
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def sendTo(self, sock) -> int:
+        '''
+        Sends as many buffered bytes as sock accepts with a single send call,
+        then consumes them.
+        :param sock: socket to send to
+        :return: number of sent bytes
+        '''
+        sent = sock.send(self._view[self._start:self._end])
+        self._advance(sent)
+        return sent
+
+    def find(self, sep: bytes) -> int:
+        '''
+        Looks for sep in the buffered bytes.
+        Repeated calls with the same separator only scan bytes received since
+        the previous call, so waiting for a long line costs linear time.
+        :param sep: byte sequence to look for
+        :return: position of sep relative to the first buffered byte, -1 if missing
+        '''
+        begin = self._start
+        if sep == self._scan_sep:
+            begin = max(begin, self._scan_from)
+
+        position = self._data.find(sep, begin, self._end)
+        if position == -1:
+            self._scan_sep = sep
+            self._scan_from = max(self._start, self._end - len(sep) + 1)
+            return -1
+
+        self._scan_sep = None
+        return position - self._start
+
+    def consume(self, n: int) -> bytes:
+        '''
+        Removes up to n bytes from the front of the buffer.
+        :param n: number of bytes to consume
+        :return: consumed bytes
+        '''
+        n = min(n, len(self))
+        consumed = bytes(self._view[self._start:self._start + n])
+        self._advance(n)
+        return consumed
+
+    def _advance(self, n: int) -> None:
+        self._start += n
+        if self._start == self._end:    # Empty, rewind for free
+            self._start = self._end = 0
+            self._scan_sep = None
+
+    def _reserve(self, n: int) -> None:
+        '''
+        Makes sure at least n bytes are free after the last buffered byte,
+        first by moving buffered bytes to the front, then by growing.
+        '''
+        if len(self._data) - self._end >= n:
+            return
+
+        pending = len(self)
+        if len(self._data) - pending >= n:
+            self._view[:pending] = self._view[self._start:self._end]  # memmove
+        else:
+            data = bytearray(max(2 * len(self._data), pending + n))
+            data[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._data = data
+            self._view = memoryview(data)
+
+        self._scan_from -= self._start
+        self._start, self._end = 0, pending
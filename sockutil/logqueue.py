@@ -0,0 +1,226 @@
+'''
+logqueue.py
+
+Logging off the request path.
+
+configureLogging() sets up the root logger like logging.basicConfig, with
+an option to hand records to a background thread through a queue
+(QueueHandler and QueueListener): the thread serving a request only
+creates a record and queues it, while formatting and writing to the
+terminal or the log file happen in the listener thread. The standard
+QueueHandler formats records before queueing them, which is only needed
+when the queue crosses processes; DeferredQueueHandler queues them as they
+are, so their arguments must not change after the logging call, as is the
+case for the strings and numbers logged by these servers.
+
+The queue is bounded: when the listener can't keep up, e.g. on a stalled
+disk, records are dropped and counted instead of blocking the caller.
+
+Messages logged for every request or connection can be sampled or
+rate-limited with limitLogger(). Log them with %-style arguments, e.g.
+log.info("%s uploaded %s", user, filename), so that nothing is formatted
+unless a record is actually written.
+
+Servers expose both as --log-* command line options with
+addLoggingOptions(), and apply them with configureFromOptions().
+'''
+
+import os
+import time
+import queue
+import random
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+__author__ = 'Giulio Corradini'
+
+QUEUE_SIZE = 65536  # Records waiting for the listener, the next ones are dropped
+
+_handler = None     # DeferredQueueHandler of the root logger, if queued
+_listener = None    # QueueListener writing its records
+_installed = None   # Handler configureLogging() added to the root logger
+_hooked = False     # Whether the exit and fork hooks of the listener are registered
+
+
+class DeferredQueueHandler(QueueHandler):
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0    # Records dropped since the last one queued
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record   # Formatted by the listener's handler
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        '''
+        Queues a record without waiting, called with the handler's lock held.
+        '''
+        try:
+            if self.dropped:
+                notice = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                           "%d log records dropped, the log can't keep up", (self.dropped,), None)
+                self.queue.put_nowait(notice)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Lets one in every n records below WARNING through on average, and every warning or error.
+    Records are picked at random: counting them would pick the same message of every
+    connection, since each one logs the same sequence.
+    '''
+    def __init__(self, every: int):
+        super().__init__()
+        self.probability = 1 / every
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.probability
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets at most rate records per second through, in bursts of up to a second's worth.
+    The first record let through after some were suppressed tells how many.
+    '''
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+
+        if suppressed:
+            record.msg = f"({suppressed} similar messages suppressed) {record.msg}"
+        return True
+
+
+def configureLogging(format: str, level=logging.DEBUG, filename: str = None, queued: bool = False) -> None:
+    '''
+    Configures the root logger, like logging.basicConfig.
+    Calling it again, e.g. in a worker process which inherited the configuration, replaces it.
+    :param format: format of the records, see logging.Formatter
+    :param level: records below it aren't even created
+    :param filename: file to append records to, None for stderr
+    :param queued: format and write records in a background thread
+    '''
+    global _handler, _listener, _installed, _hooked
+    _removeConfiguration()
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(logging.Formatter(format))
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not queued:
+        _installed = target
+        root.addHandler(target)
+        return
+
+    _handler = DeferredQueueHandler(queue.Queue(QUEUE_SIZE))
+    _listener = QueueListener(_handler.queue, target, respect_handler_level=True)
+    _listener.start()
+    _installed = _handler
+    root.addHandler(_handler)
+    if not _hooked:
+        atexit.register(stopLogging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_restartListener)
+        _hooked = True
+
+
+def limitLogger(logger: logging.Logger, sample: int = None, rate: float = None) -> None:
+    '''
+    Thins out the records of a chatty logger, e.g. the one of per-request messages.
+    Replaces the limits of a previous call.
+    :param sample: keep one record in sample, below WARNING, None to keep all
+    :param rate: keep at most rate records per second, None for no limit
+    '''
+    for limit in [f for f in logger.filters if isinstance(f, (SampleFilter, RateLimitFilter))]:
+        logger.removeFilter(limit)
+    if sample and sample > 1:
+        logger.addFilter(SampleFilter(sample))
+    if rate:
+        logger.addFilter(RateLimitFilter(rate))
+
+
+def addLoggingOptions(parser) -> None:
+    '''
+    Adds the command line options read by configureFromOptions() to an argparse parser.
+    '''
+    parser.add_argument("--log-file", default=None, required=False, metavar="path",
+                        help="append the log to this file instead of stderr")
+    parser.add_argument("--log-level", default='DEBUG', required=False, metavar="level",
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), help="least severe records logged")
+    parser.add_argument("--log-queue", action="store_true", required=False,
+                        help="format and write the log in a background thread, off the clients' way")
+    parser.add_argument("--log-sample", type=int, default=None, required=False, metavar="n",
+                        help="log one in n per-connection messages, warnings excluded")
+    parser.add_argument("--log-rate", type=float, default=None, required=False, metavar="messages/s",
+                        help="log at most this many per-connection messages per second")
+
+
+def configureFromOptions(options, format: str, logger: logging.Logger) -> None:
+    '''
+    Configures logging as the options added by addLoggingOptions() ask.
+    :param options: parsed arguments, or any object with the same log_* attributes
+    :param format: format of the records, see logging.Formatter
+    :param logger: logger of the per-connection messages, which --log-sample and --log-rate thin out
+    '''
+    configureLogging(format, options.log_level, options.log_file, options.log_queue)
+    limitLogger(logger, options.log_sample, options.log_rate)
+
+
+def stopLogging() -> None:
+    '''
+    Writes the queued records and stops the listener thread. Registered to run at exit.
+    '''
+    global _listener
+    if _listener is None:
+        return
+    try:
+        _listener.stop()
+    except queue.Full:  # No room for the sentinel, the records left are lost
+        pass
+    _listener = None
+
+
+def _removeConfiguration() -> None:
+    '''
+    Undoes the previous configureLogging(), if any: its handler leaves the root logger and is closed.
+    '''
+    global _handler, _installed
+    if _installed is None:
+        return
+    logging.getLogger().removeHandler(_installed)
+    targets = _listener.handlers if _listener else (_installed,)
+    stopLogging()
+    for target in targets:
+        target.close()
+    _handler = _installed = None
+
+
+def _restartListener() -> None:
+    '''
+    Gives a forked child, e.g. a worker process, a listener thread of its own:
+    threads don't survive fork, and the parent's queue may have been locked meanwhile.
+    '''
+    global _listener
+    if _listener is None:
+        return
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _listener = QueueListener(_handler.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
@@ -0,0 +1,168 @@
+'''
+pool.py
+
+TCP server serving connections with a fixed pool of threads.
+
+socketserver.ThreadingTCPServer starts a thread for every connection, so a
+burst of clients means as many threads, stacks and context switches.
+PooledTCPServer accepts connections into a bounded queue instead, served in
+order by a fixed number of worker threads: memory and scheduling costs stay
+the same however many clients connect at once.
+
+When the queue is full, the server either:
+    - waits for room before accepting again ('wait'): new clients queue up
+      in the listen backlog of the kernel, and beyond it their connections
+      are refused or time out;
+    - closes new connections right away ('reject');
+    - sends them a refusal message, then closes them ('error').
+
+A connection holds its worker until its handler returns, so the pool size
+is also the number of clients served at once: the queued ones wait for a
+client to leave.
+'''
+
+import time
+import queue
+import socket
+import logging
+import threading
+import socketserver
+
+__author__ = 'Giulio Corradini'
+
+POLICIES = ('wait', 'reject', 'error')  # What to do with new connections when the queue is full
+WAIT_POLL = 0.5     # Seconds between checks for shutdown while waiting for room in the queue
+
+
+class PoolStats:
+    '''
+    Saturation of a pool, updated under its lock.
+    '''
+    def __init__(self, workers: int, capacity: int):
+        self.workers = workers
+        self.capacity = capacity    # Connections the queue holds
+        self.busy = 0           # Workers serving a connection
+        self.queued = 0         # Connections waiting for a worker
+        self.accepted = 0       # Connections queued since the start
+        self.refused = 0        # Connections closed because the queue was full
+        self.served = 0         # Connections handed to a worker
+        self.waited = 0.0       # Seconds they spent in the queue
+
+
+class PooledTCPServer(socketserver.TCPServer):
+    request_queue_size = socket.SOMAXCONN  # Listen backlog: with the 'wait' policy, clients queue up there
+                                           # (TCPServer's 5 drops the handshakes of a burst)
+
+    def __init__(self, server_address, RequestHandlerClass, workers: int, capacity: int = None,
+                 policy: str = 'wait', refusal: bytes = b''):
+        '''
+        :param workers: threads serving connections
+        :param capacity: connections waiting for a worker, twice the workers by default
+        :param policy: what to do when the queue is full, one of POLICIES
+        :param refusal: sent to the connections refused with the 'error' policy
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, expected one of {', '.join(POLICIES)}")
+        capacity = capacity or 2 * workers
+        self.policy = policy
+        self.refusal = refusal
+        self.stats = PoolStats(workers, capacity)
+        self._queue = queue.SimpleQueue()
+        self._slots = threading.Semaphore(workers + capacity)   # Connections served or queued, see process_request
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._workers = []
+        super().__init__(server_address, RequestHandlerClass)   # Binds and listens, may raise
+
+        for index in range(workers):
+            worker = threading.Thread(target=self._work, name=f"Worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address) -> None:
+        '''
+        Queues an accepted connection for the workers, applying the policy if the queue is full.
+        Called by serve_forever, in its thread. Room is counted with a semaphore rather than
+        by the queue itself: the workers may not have taken the connections queued right before.
+        '''
+        if self.policy == 'wait':
+            while not self._slots.acquire(timeout=WAIT_POLL):
+                if self._stopping:
+                    self.refuse(request)
+                    return
+        elif not self._slots.acquire(blocking=False):
+            self.refuse(request)
+            return
+
+        with self._lock:
+            self.stats.queued += 1
+            self.stats.accepted += 1
+        self._queue.put((request, client_address, time.monotonic()))
+
+    def refuse(self, request) -> None:
+        with self._lock:
+            self.stats.refused += 1
+        if self.policy == 'error' and self.refusal:
+            try:
+                request.send(self.refusal)  # Fits in the empty send buffer of a new connection
+            except OSError:
+                pass
+        self.shutdown_request(request)
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:    # Sentinel of server_close
+                return
+            request, client_address, queued_at = item
+            with self._lock:
+                self.stats.queued -= 1
+                self.stats.busy += 1
+                self.stats.served += 1
+                self.stats.waited += time.monotonic() - queued_at
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._lock:
+                    self.stats.busy -= 1
+                self._slots.release()
+
+    def shutdown(self) -> None:
+        self._stopping = True   # Stops waiting for room in the queue
+        super().shutdown()
+
+    def server_close(self) -> None:
+        '''
+        Closes the queued connections and waits for the workers to finish the running ones.
+        '''
+        self._stopping = True
+        super().server_close()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(item[0])
+            with self._lock:
+                self.stats.queued -= 1
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        logging.debug(f"Pool of {len(self._workers)} workers stopped")
+
+
+def addPoolOptions(parser) -> None:
+    '''
+    Adds the command line options of a pool (--pool, --pool-queue, --pool-full) to an argparse parser.
+    '''
+    parser.add_argument("--pool", type=int, default=None, required=False, metavar="workers",
+                        help="serve clients with a fixed pool of threads instead of a thread each")
+    parser.add_argument("--pool-queue", type=int, default=None, required=False, metavar="clients",
+                        help="clients waiting for a worker of the pool, twice the workers by default")
+    parser.add_argument("--pool-full", default='wait', required=False, metavar="policy", choices=POLICIES,
+                        help="when the queue is full: stop accepting (wait), close new clients (reject) "
+                             "or answer them ERROR (error)")
@@ -0,0 +1,267 @@
+'''
+profiling.py
+
+On-demand profiling of running servers.
+
+A capture runs cProfile and tracemalloc for a few seconds, then writes a
+report with the functions which took most time, the lines which allocated
+most memory meanwhile, and the stack of every thread. A stack dump writes
+the stacks alone, right away, with those of the asyncio tasks if any.
+
+Servers start captures on SIGUSR1 and dump stacks on SIGUSR2 (see
+Profiler.installSignals), or on admin commands. Nothing is hooked into the
+interpreter between captures, so profiling costs nothing while it's off.
+
+From Python 3.12 cProfile uses sys.monitoring, which sees every thread.
+Before, a profiler only sees the thread which enables it, and only that
+thread can disable it. Threads join captures themselves, by calling
+Profiler.checkpoint() between steps of their work, e.g. the threads serving
+clients of a threaded server, pooled or not: each capture has a generation,
+and a thread enables a profiler of its own when it finds a new capture
+running, or disables it when the capture it joined has ended. Other
+threads, e.g. those of the asyncio server's file pool, aren't profiled.
+A report only includes the profiles of threads which have left the capture,
+or ended, by the time it is written: the others are still being updated.
+'''
+
+import io
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import pstats
+import cProfile
+import datetime
+import threading
+import traceback
+import tracemalloc
+
+__author__ = 'Giulio Corradini'
+
+TOP_FUNCTIONS = 40      # Functions listed in a capture report
+TOP_ALLOCATIONS = 25    # Lines listed in a capture report
+ALL_THREADS = sys.version_info >= (3, 12)   # cProfile uses sys.monitoring, which isn't per thread
+STOP_GRACE = 0.5        # Seconds a report waits for the profiled threads to leave the capture
+
+
+class _ThreadCapture(threading.local):
+    generation = 0  # Of the last capture the thread joined or left, see Profiler.checkpoint
+    profile = None  # Its cProfile.Profile while in a capture
+
+
+class Profiler:
+    def __init__(self, directory: str = '.', seconds: float = 10.0):
+        '''
+        :param directory: where reports are written
+        :param seconds: default length of a capture
+        '''
+        self.directory = directory
+        self.seconds = seconds
+
+        self._profiles = []     # cProfile.Profile of the threads which left the running capture
+        self._running = {}      # Thread of every profile still enabled, before Python 3.12
+        self._generation = 0    # Odd while capturing, incremented when a capture starts or stops
+        self._capturing = None  # Length of the running capture, None if there isn't one
+        self._tracing = False   # True if the capture started tracemalloc
+        self._thread = _ThreadCapture()
+        self._lock = threading.Condition()
+
+    def startCapture(self, seconds: float = None) -> float:
+        '''
+        Starts profiling. Must be stopped by stopCapture, from the same thread.
+        :return: seconds the capture should last
+        :raise RuntimeError: if a capture is running already
+        '''
+        with self._lock:
+            if self._capturing is not None:
+                raise RuntimeError("A capture is running already")
+            self._capturing = seconds or self.seconds
+            self._generation += 1
+            self._profiles, self._running = [], {}
+            if ALL_THREADS:
+                self._profiles.append(cProfile.Profile())
+
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        if ALL_THREADS:
+            self._profiles[0].enable()
+        else:
+            self.checkpoint()
+        logging.info(f"Profiling for {self._capturing:g} seconds")
+        return self._capturing
+
+    def checkpoint(self, leave: bool = False) -> None:
+        '''
+        Joins the running capture, or leaves the one which ended, from the calling thread.
+        Threads serving clients call it between steps of their work, before Python 3.12:
+        it costs an attribute lookup while the thread's capture, if any, is current.
+        :param leave: leave the running capture too, e.g. before waiting for new work:
+            the profile collected so far makes it to the report, the next checkpoint joins again
+        '''
+        if ALL_THREADS or self._thread.generation == self._generation and not leave:
+            return
+        thread = self._thread
+        with self._lock:
+            left, thread.profile = thread.profile, None
+            if left is not None:
+                left.disable()
+                if self._running.pop(left, None):   # Still awaited by the report
+                    self._profiles.append(left)
+                    self._lock.notify_all()
+            thread.generation = self._generation
+            if leave:
+                thread.generation = None
+            elif self._capturing is not None:
+                thread.profile = cProfile.Profile()
+                self._running[thread.profile] = threading.current_thread()
+                thread.profile.enable()
+
+    def _stoppedProfiles(self) -> tuple:
+        '''
+        Waits up to STOP_GRACE for the profiled threads to leave the capture which just ended.
+        :return: (profiles of the threads which left it or ended, number of threads still in it)
+        '''
+        deadline = time.monotonic() + STOP_GRACE
+        with self._lock:
+            while True:
+                for profile, thread in list(self._running.items()):
+                    if not thread.is_alive():   # Its profiler was disabled with it
+                        del self._running[profile]
+                        self._profiles.append(profile)
+                remaining = deadline - time.monotonic()
+                if not self._running or remaining <= 0:
+                    break
+                self._lock.wait(min(remaining, 0.05))   # Ended threads don't notify
+            profiles, missed = self._profiles, len(self._running)
+            self._profiles, self._running = [], {}  # Threads still in it leave at their next checkpoint
+        return profiles, missed
+
+    def stopCapture(self) -> str:
+        '''
+        Stops profiling and writes the report.
+        :return: path of the report
+        '''
+        with self._lock:
+            seconds, self._capturing = self._capturing, None
+            self._generation += 1
+        if ALL_THREADS:
+            self._profiles[0].disable()
+            profiles, missed = self._profiles, 0
+            self._profiles = []
+        else:
+            self.checkpoint()
+            profiles, missed = self._stoppedProfiles()
+        snapshot = tracemalloc.take_snapshot()
+        if self._tracing:
+            tracemalloc.stop()
+
+        path = self.reportPath('profile')
+        with open(path, 'w') as fd:
+            fd.write(f"Capture of {seconds:g} seconds, process {os.getpid()}, "
+                     f"profiled threads: {len(profiles) if not ALL_THREADS else 'all'}")
+            fd.write(f", {missed} left out: still in the capture when it ended\n\n" if missed else "\n\n")
+
+            fd.write("Functions by cumulative time (cProfile)\n\n")
+            stats = pstats.Stats(*profiles, stream=fd)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+            fd.write("Lines which allocated most memory during the capture (tracemalloc)\n\n")
+            for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                fd.write(f"{statistic}\n")
+
+            fd.write("\n")
+            self.writeStacks(fd)
+        logging.info(f"Profile written to {path}")
+        return path
+
+    def capture(self, seconds: float = None) -> str:
+        '''
+        Profiles for a while, blocking the calling thread meanwhile.
+        :return: path of the report
+        '''
+        seconds = self.startCapture(seconds)
+        try:
+            time.sleep(seconds)
+        finally:
+            path = self.stopCapture()
+        return path
+
+    async def captureAsync(self, seconds: float = None) -> str:
+        '''
+        Profiles for a while, without blocking the event loop.
+        :return: path of the report
+        '''
+        seconds = self.startCapture(seconds)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            path = self.stopCapture()   # Also when cancelled, the profiler mustn't stay on
+        return path
+
+    def dumpStacks(self) -> str:
+        '''
+        Writes the stacks of every thread and, if called in an event loop, of its tasks.
+        :return: path of the dump
+        '''
+        path = self.reportPath('stacks')
+        with open(path, 'w') as fd:
+            self.writeStacks(fd)
+        logging.info(f"Stacks written to {path}")
+        return path
+
+    def writeStacks(self, fd) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            fd.write(f"Thread {names.get(ident, ident)}\n")
+            fd.write("".join(traceback.format_stack(frame)))
+            fd.write("\n")
+
+        try:
+            tasks = asyncio.all_tasks()     # Of the running loop
+        except RuntimeError:
+            return
+        for task in tasks:
+            stack = io.StringIO()
+            task.print_stack(file=stack)
+            fd.write(f"{stack.getvalue()}\n")
+
+    def reportPath(self, kind: str) -> str:
+        '''
+        :param kind: 'profile' or 'stacks'
+        '''
+        return os.path.join(self.directory, f"{kind}-{os.getpid()}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}.txt")
+
+    def installSignals(self, loop: asyncio.AbstractEventLoop = None) -> None:
+        '''
+        Starts a capture on SIGUSR1 and dumps stacks on SIGUSR2. Must be called from the main thread.
+        Without an event loop, captures are stopped by SIGALRM.
+        :param loop: event loop of an asyncio server, which handles the signals and stops captures
+        '''
+        if not hasattr(signal, 'SIGUSR1'):
+            logging.warning("Profiling signals aren't available on this platform")
+            return
+
+        def startOnSignal(*args):
+            try:
+                seconds = self.startCapture()
+            except RuntimeError as e:
+                logging.warning(f"Profiling not started: {e}")
+                return
+            if loop:
+                loop.call_later(seconds, self.stopCapture)
+            else:
+                signal.setitimer(signal.ITIMER_REAL, seconds)
+
+        def dumpOnSignal(*args):
+            self.dumpStacks()
+
+        if loop:
+            loop.add_signal_handler(signal.SIGUSR1, startOnSignal)
+            loop.add_signal_handler(signal.SIGUSR2, dumpOnSignal)
+        else:
+            signal.signal(signal.SIGUSR1, startOnSignal)
+            signal.signal(signal.SIGUSR2, dumpOnSignal)
+            signal.signal(signal.SIGALRM, lambda *args: self.stopCapture())
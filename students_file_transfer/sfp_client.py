@@ -4,65 +4,305 @@ import argparse
 import sys
 import os
 import datetime
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sfp.progress import TransferProgress, RangeProgress, formatRate
+from sfp.ranges import splitRange
+from sockutil.buffer import SocketBuffer
+from sfp.checksum import ChecksumError, chooseAlgorithm, newDigest
+from sfp.blobs import hashFile
+from sfp.compression import chooseMethod, worthCompressing, encodeBlock, decodeBlock, parseFrameHeader, \
+    FRAME_HEADER, BLOCK_SIZE
+from sfp.framing import VERSION_PREFIX, VERSION_ACCEPTED, HEADER, encodeMessage, parseHeader, decodeFields
 
 __author__ = 'Giulio Corradini'
 
+CHUNK_SIZE = 65536          # Receive buffer size
+SENDFILE_CHUNK = 1048576    # Bytes handed to each sendfile() call, one progress update each
+
 class SFPClientHandler(socket.socket):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.buffer = bytearray()
+        self.buffer = SocketBuffer()
         self.user: str = None
+        self.version = 1        # 2 once the server accepted binary framing
+        self.request_id = 0     # Id of the last command sent with binary framing
+        self.reply_id = 0       # and of the last response received
+        self.checksum: str = None   # Algorithm accepted by the server, None if disabled
+        self.compression: str = None    # Method accepted by the server, None if disabled
 
-    def uploadFile(self, filename, filesize):
-        command = f"U {filename} {filesize}\n".encode('utf-8')
-        self.sendall(command)
+    def uploadFile(self, filename, filesize, progress=None, resume=False, dedupe=False):
+        '''
+        Uploads a file to the server, telling the user how it went.
+        :param resume: continue a partial upload left on the server by a previous connection
+        :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+        '''
+        response = self.upload(filename, filesize, progress, resume, dedupe)
+        if response == b'STORED\n':
+            print("File already on server, not transferred")
+        elif response == b'EXISTS\n':
+            print("File exists")
+        elif response != b'OK\n':
+            print("Server error")
 
-        can_tx = self.consumeBuffer(self.recvUntil(b'\n'))
-        if can_tx == b'OK\n':
+    def upload(self, filename, filesize=None, progress=None, resume=False, dedupe=False) -> bytes:
+        '''
+        Uploads a file to the server.
+        :param filesize: size of the file, read from disk if None
+        :param resume: continue a partial upload left on the server by a previous connection
+        :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+        :return: b'OK\n' if the file has been sent, b'STORED\n' if the server had its content already,
+            b'EXISTS\n' if the server has a file with that name, b'ERROR\n' otherwise
+        :raise ChecksumError: if checksums are enabled and the server received something else
+        '''
+        if filesize is None:
+            filesize = os.path.getsize(filename)
+        if dedupe:
+            announced = self.announceFile(filename, filesize)
+            if announced == b'OK\n':
+                return b'STORED\n'
+            elif announced == b'EXISTS\n':
+                return announced
+
+        verb = 'R' if resume else 'U'
+        self.sendCommand(verb, filename, str(filesize))
+
+        can_tx = self.recvReply()
+        if can_tx == b'OK\n' or (resume and can_tx.rstrip(b'\n').isdigit()):
+            offset = 0 if can_tx == b'OK\n' else int(can_tx)   # Bytes already on the server
+            digest = newDigest(self.checksum) if self.checksum else None
             with open(filename, 'rb') as fd:
-                self.sendall(fd.read())
+                fd.seek(offset)
+                self.sendFromFile(fd, filesize - offset, progress, digest)
+            self.checkDigest(digest)
+            return b'OK\n'
         elif can_tx == b'EXISTS\n':
-            print("File exists")
+            return can_tx
         else:
-            print("Server error")
+            return b'ERROR\n'
 
-    def downloadFile(self, filename, date):
-        command = f"D {filename} {date}\n".encode('utf-8')
-        self.sendall(command)
+    def announceFile(self, filename, filesize) -> bytes:
+        '''
+        Announces the digest of a file, so that a server with a deduplicating
+        store can create it without the upload. Hashing reads the local file once.
+        :return: server response, b'OK\n' if the file has been created,
+            b'MISSING\n' if it has to be uploaded
+        '''
+        self.sendCommand('A', filename, str(filesize), hashFile(filename))
+        return self.recvReply()
 
-        response = self.consumeBuffer(self.recvUntil(b'\n'))
-        if response == b'NOTFOUND\n':
+    def downloadFile(self, filename, date, progress=None, resume=False):
+        '''
+        Downloads a file from the server, telling the user how it went.
+        :param resume: if a partial copy of filename exists, only request the missing bytes
+        '''
+        try:
+            count = self.download(filename, date, progress, resume)
+        except FileNotFoundError:
             print("File not found on server")
+            return
+        if count is None:
+            print("Server error")   # Also sent when offset is past the end of the remote file
+        else:
+            print(f"Received {count} bytes")
 
+    def download(self, filename, date, progress=None, resume=False):
+        '''
+        Downloads a file from the server.
+        :param date: day the file has been uploaded, as yyyymmdd
+        :param resume: if a partial copy of filename exists, only request the missing bytes
+        :return: number of bytes received, None if the server refused the request
+        :raise FileNotFoundError: if the server has no such file
+        :raise ChecksumError: if checksums are enabled and the file arrived corrupted
+        '''
+        offset = os.path.getsize(filename) if resume and os.path.exists(filename) else 0
+        if offset:
+            self.sendCommand('D', filename, date, str(offset))
+        else:
+            self.sendCommand('D', filename, date)
+
+        response = self.recvReply()
+        if response == b'NOTFOUND\n':
+            raise FileNotFoundError(f"{filename} of {date} not found on server")
         elif response == b'ERROR\n':
-            print("Server error")
+            return None
 
-        else:
-            filesize = int(response.decode('utf-8'))
-            self.recvLeast(filesize)
-            with open(filename, 'wb') as fd:
-                fd.write(self.consumeBuffer(filesize))
-            print(f"Received {filesize} bytes")
+        count = int(response.split()[0])   # Ranged responses also carry the whole file size
+        digest = newDigest(self.checksum) if self.checksum else None
+        with open(filename, 'ab' if offset else 'wb') as fd:
+            self.recvToFile(fd, count, progress, digest)
+        self.checkDigest(digest)
+        return count
+
+    def uploadRange(self, filename, filesize, offset, count, progress=None) -> bytes:
+        '''
+        Uploads bytes [offset; offset + count) of a file, as part of a parallel upload.
+        :return: server response, b'OK\n' if the range has been sent
+        '''
+        self.sendCommand('U', filename, str(filesize), str(offset), str(count))
+
+        response = self.recvReply()
+        if response == b'OK\n':
+            digest = newDigest(self.checksum) if self.checksum else None
+            with open(filename, 'rb') as fd:
+                fd.seek(offset)
+                self.sendFromFile(fd, count, progress, digest)
+            self.checkDigest(digest)
+        return response
+
+    def downloadRange(self, filename, date, offset, count, progress=None):
+        '''
+        Downloads bytes [offset; offset + count) of a file into the same range
+        of the local copy, as part of a parallel download.
+        The local file must already exist unless count is 0.
+        :return: size of the whole remote file, None if it can't be downloaded
+        '''
+        self.sendCommand('D', filename, date, str(offset), str(count))
+
+        response = self.recvReply()
+        if response in (b'NOTFOUND\n', b'ERROR\n'):
+            return None
+
+        count, filesize = map(int, response.split())
+        digest = newDigest(self.checksum) if self.checksum else None
+        if count:
+            with open(filename, 'r+b') as fd:
+                fd.seek(offset)
+                self.recvToFile(fd, count, progress, digest)
+        self.checkDigest(digest)
+        return filesize
 
     def sendTextCommand(self, command: str, payload: str = None) -> str:
-        command += f" {payload}\n"
+        if payload is not None:     # Q, H and S take no argument
+            command += f" {payload}"
+
+        self.sendCommand(*command.split(' '))
+        return self.recvResponse(command, self.request_id)
+
+    def sendBatch(self, commands) -> list:
+        '''
+        Pipelines commands: sends all of them at once, then reads the responses
+        in order, paying a single round trip instead of one per command.
+        Uploads can't be pipelined, they wait for the server's go-ahead.
+        :param commands: command lines without the trailing LF, e.g. "L 20201019".
+            D commands download the whole file, saved with its remote name
+        :return: list of responses, as returned by sendTextCommand
+        '''
+        for command in commands:
+            if command[0] in ('U', 'R') or (command[0] == 'D' and len(command.split(' ')) != 3):
+                raise ValueError(f"Command can't be pipelined: {command}")
+
+        batch = []
+        request_ids = []
+        for command in commands:
+            batch.append(self.encodeCommand(*command.split(' ')))
+            request_ids.append(self.request_id)
+        self.sendall(b''.join(batch))
+        return [self.recvResponse(command, request_id) for command, request_id in zip(commands, request_ids)]
+
+    def recvResponse(self, command: str, request_id: int = None) -> str:
+        '''
+        Receives the response to a command, and the file that follows it for downloads.
+        :param request_id: id the response must carry, with binary framing
+        :raise ValueError: if the response answers another command
+        '''
+        if self.version == 1 and command[0] in ('H', 'S'):
+            return self.consumeBuffer(self.recvUntil(b'\n\n') + 1).decode('utf-8')   # Both LFs
 
-        self.sendall(command.encode('utf-8'))
-        if command[0] == 'H':
-            response = self.consumeBuffer(self.recvUntil(b'\n\n'))
+        if self.version == 1:
+            response = self.recvReply()
         else:
-            response = self.consumeBuffer(self.recvUntil(b'\n'))
+            fields = self.recvFields()
+            if request_id is not None and self.reply_id != request_id:
+                raise ValueError(f"Response to command {self.reply_id}, expected {request_id}")
+            if command[0] in ('H', 'S'):
+                return fields[0]    # Help text or statistics, LF terminated already
+            separator = ', ' if command[0] == 'L' else ' '
+            response = (separator.join(fields) + "\n").encode('utf-8')
+
+        if command[0] == 'D' and response[:1].isdigit():
+            digest = newDigest(self.checksum) if self.checksum else None
+            with open(command.split(' ')[1], 'wb') as fd:
+                self.recvToFile(fd, int(response.split()[0]), digest=digest)
+            self.checkDigest(digest)
         return response.decode('utf-8')
 
-    def auth(self, user: str) -> bool:
+    def enableExtensions(self, *extensions) -> bool:
+        '''
+        Enables protocol extensions for the rest of the session:
+        a checksum algorithm (see sfp/checksum.py) and/or a compression method (see sfp/compression.py).
+        :param extensions: names of the extensions, e.g. 'blake2b', 'zlib'
+        :return: True if the server supports all of them
+        '''
+        self.sendCommand('E', *extensions)
+        accepted = self.recvReply().decode('utf-8').split()[1:]
+        self.checksum = chooseAlgorithm(accepted)
+        self.compression = chooseMethod(accepted)
+        return set(extensions) <= set(accepted)
+
+    def checkDigest(self, digest) -> None:
+        '''
+        Receives the digest trailer of a payload and compares it with the local one.
+        :param digest: hash object fed with the payload, None if checksums are disabled
+        :raise ChecksumError: if the two digests differ
+        '''
+        if digest is None:
+            return
+        remote = self.recvReply().decode('utf-8').rstrip('\n')
+        if remote != digest.hexdigest():
+            raise ChecksumError(f"{self.checksum} mismatch: local {digest.hexdigest()}, server {remote}")
+
+    def auth(self, user: str, version: int = 1) -> bool:
+        '''
+        :param version: 2 to ask for binary framing, see sfp/framing.py.
+            The session stays on text lines if the server doesn't support it
+        '''
+        if version == 2:
+            user = VERSION_PREFIX + user
         self.sendall(user.encode('utf-8') + b'\n')
         auth_result = self.consumeBuffer(self.recvUntil(b'\n'))
-        if auth_result == b'OK\n':
+        if auth_result == VERSION_ACCEPTED:
+            self.version = 2
+            return True
+        elif auth_result == b'OK\n':
             return True
         else:
             return False
 
+    def encodeCommand(self, verb: str, *arguments: str) -> bytes:
+        '''
+        Encodes a command as text line or binary message, depending on the session.
+        '''
+        if self.version == 1:
+            return (" ".join([verb, *arguments]) + "\n").encode('utf-8')
+        self.request_id += 1
+        return encodeMessage(verb, self.request_id, arguments)
+
+    def sendCommand(self, verb: str, *arguments: str) -> None:
+        self.sendall(self.encodeCommand(verb, *arguments))
+
+    def recvFields(self) -> list:
+        '''
+        Receives a binary message and records its request id.
+        :return: fields of the message
+        '''
+        verb, count, self.reply_id, length = parseHeader(self.recvExactly(HEADER.size))
+        return decodeFields(self.recvExactly(length), count)
+
+    def recvReply(self) -> bytes:
+        '''
+        Receives a single line response, or a binary message rendered as such a line
+        (fields separated by spaces), so that both versions compare the same.
+        '''
+        if self.version == 1:
+            return self.consumeBuffer(self.recvUntil(b'\n'))
+        return (" ".join(self.recvFields()) + "\n").encode('utf-8')
+
     #   Utility functions for socket buffer management
     def recvUntil(self, char: bytes) -> int:
         '''
@@ -70,32 +310,125 @@ class SFPClientHandler(socket.socket):
         :param char: byte value to look for
         :return: char position in self.buffer
         '''
-        str_end = -1
+        str_end = self.buffer.find(char)
         while str_end == -1:
-            self.buffer += self.recv(4096)
+            if not self.buffer.recvFrom(self):
+                self.close()
+                raise socket.error()
             str_end = self.buffer.find(char)
 
         return str_end
 
-    def consumeBuffer(self, n=0, include_last=True) -> bytearray:
+    def consumeBuffer(self, n=0, include_last=True) -> bytes:
         '''
         Consume bytes from self.buffer and deletes from it
         :param n: Position of last byte to consume
         :param include_last: Include n-th byte in consumed slice
-        :return: bytearray slice in range [0; n]
+        :return: bytes in range [0; n]
         '''
         if include_last:
             n += 1
-        consumed = self.buffer[:n]
-        del self.buffer[:n]
-        return consumed
+        return self.buffer.consume(n)
 
-    def recvLeast(self, n):
+    def recvToFile(self, fd, n, progress=None, digest=None):
+        '''
+        Receives exactly n bytes from the socket and writes them to fd,
+        one chunk at a time, so memory usage doesn't depend on n.
+        :param fd: binary file object to write to
+        :param n: number of bytes to transfer
+        :param progress: optional callback, called as progress(transferred, n)
+        :param digest: optional hash object, updated with every chunk
+        '''
+        if self.compression:
+            return self.recvFramesToFile(fd, n, progress, digest)
+
+        buffered = self.consumeBuffer(min(n, len(self.buffer)), include_last=False)
+        fd.write(buffered)
+        if digest: digest.update(buffered)
+        received = len(buffered)
+
+        chunk = memoryview(bytearray(min(n - received, CHUNK_SIZE)))
+        while received < n:
+            length = self.recv_into(chunk, min(n - received, CHUNK_SIZE))
+            if not length:
+                self.close()
+                raise socket.error()
+            fd.write(chunk[:length])
+            if digest: digest.update(chunk[:length])
+            received += length
+            if progress: progress(received, n)
+
+    def sendFromFile(self, fd, n, progress=None, digest=None):
+        '''
+        Sends n bytes of fd through the socket, using sendfile when available.
+        :param fd: binary file object to read from, at its current position
+        :param n: number of bytes to transfer
+        :param progress: optional callback, called as progress(transferred, n)
+        :param digest: optional hash object, updated with every chunk.
+            Bytes have to pass through user space then, so sendfile isn't used
+        '''
+        if self.compression:
+            return self.sendFramesFromFile(fd, n, progress, digest)
+
+        offset = fd.tell()
+        sent = 0
+        while sent < n:
+            if digest:
+                chunk = fd.read(min(n - sent, CHUNK_SIZE))
+                digest.update(chunk)
+                self.sendall(chunk)
+                length = len(chunk)
+            else:
+                length = self.sendfile(fd, offset + sent, min(n - sent, SENDFILE_CHUNK))
+            if not length:
+                raise EOFError(f"{fd.name} is shorter than {n} bytes")
+            sent += length
+            if progress: progress(sent, n)
+
+    def recvFramesToFile(self, fd, n, progress=None, digest=None):
+        '''
+        Receives the frames carrying n bytes of a file (see sfp/compression.py),
+        decompresses them and writes them to fd.
+        :raise ValueError: if a frame is invalid
+        '''
         received = 0
         while received < n:
-            data = self.recv(65536)
-            self.buffer += data
-            received += len(data)
+            flag, length = parseFrameHeader(self.recvExactly(FRAME_HEADER.size))
+            block = decodeBlock(self.compression, flag, self.recvExactly(length))
+            if received + len(block) > n:
+                raise ValueError(f"{received + len(block) - n} bytes more than announced")
+            fd.write(block)
+            if digest: digest.update(block)
+            received += len(block)
+            if progress: progress(received, n)
+
+    def sendFramesFromFile(self, fd, n, progress=None, digest=None):
+        '''
+        Sends n bytes of fd as frames (see sfp/compression.py),
+        compressing them unless the file doesn't seem worth it.
+        '''
+        method = self.compression
+        sent = 0
+        while sent < n:
+            block = fd.read(min(n - sent, BLOCK_SIZE))
+            if not block:
+                raise EOFError(f"{fd.name} is shorter than {n} bytes")
+            if digest: digest.update(block)
+            if not sent and not worthCompressing(fd.name, block):
+                method = None   # Raw frames from now on, compressing isn't worth the CPU
+            self.sendall(encodeBlock(method, block))
+            sent += len(block)
+            if progress: progress(sent, n)
+
+    def recvExactly(self, n: int) -> bytes:
+        '''
+        Receives bytes from the socket until n of them are buffered, then consumes them.
+        '''
+        while len(self.buffer) < n:
+            if not self.buffer.recvFrom(self, n - len(self.buffer)):
+                self.close()
+                raise socket.error()
+        return self.buffer.consume(n)
 
     def recv(self, *args, **kwargs) -> bytes:
         '''
@@ -107,16 +440,203 @@ class SFPClientHandler(socket.socket):
             raise socket.error()
         return data
 
-def main(host, port):
+def connect(host, port, user, extensions=(), version=1) -> SFPClientHandler:
+    '''
+    Opens an authenticated connection.
+    :param extensions: protocol extensions to enable, e.g. ('blake2b', 'zlib')
+    :param version: 2 to ask for binary framing
+    :raise ConnectionRefusedError: if the server doesn't accept user
+    '''
+    s = SFPClientHandler(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((host, port))
+    if not s.auth(user, version):
+        s.close()
+        raise ConnectionRefusedError(f"Authentication of {user} failed")
+    s.user = user
+    if extensions and not s.enableExtensions(*extensions):
+        s.close()
+        raise ConnectionRefusedError(f"Server doesn't support {' '.join(extensions)}")
+    return s
+
+def parallelUpload(host, port, user, filename, streams, progress=None, extensions=(), dedupe=False,
+                   version=1) -> bool:
+    '''
+    Uploads a file splitting it in byte ranges, each one sent over its own connection.
+    :param streams: maximum number of concurrent connections
+    :param extensions: protocol extensions enabled on every connection, e.g. ('blake2b', 'zlib')
+    :param dedupe: announce the file's digest first, skip the transfer if the server has its content
+    :param version: 2 to ask for binary framing on every connection
+    :return: True if the whole file has been uploaded
+    '''
+    filesize = os.path.getsize(filename)
+    if dedupe:
+        with connect(host, port, user, version=version) as s:
+            announced = s.announceFile(filename, filesize)
+            s.sendTextCommand('Q')
+        if announced == b'OK\n':
+            print("File already on server, not transferred")
+            return True
+    if not filesize:    # No range to upload, the server refuses empty ones
+        with connect(host, port, user, extensions, version) as s:
+            response = s.upload(filename, filesize, progress)
+            s.sendTextCommand('Q')
+        if response != b'OK\n':
+            print("File exists" if response == b'EXISTS\n' else "Server error")
+        return response == b'OK\n'
+    combined = RangeProgress(progress, filesize)
+
+    def uploadOne(byte_range):
+        offset, count = byte_range
+        with connect(host, port, user, extensions, version) as s:
+            response = s.uploadRange(filename, filesize, offset, count, combined.forRange(offset))
+            s.sendTextCommand('Q')  # Once answered, the server is done with the range
+        return response
+
+    ranges = splitRange(filesize, streams)
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="Stream") as pool:
+        responses = list(pool.map(uploadOne, ranges))
+
+    if all(response == b'OK\n' for response in responses):
+        return True
+    print("File exists" if b'EXISTS\n' in responses else "Server error")
+    return False
+
+def parallelDownload(host, port, user, filename, date, streams, progress=None, extensions=(), version=1) -> bool:
+    '''
+    Downloads a file splitting it in byte ranges, each one received over its own connection.
+    :param streams: maximum number of concurrent connections
+    :param extensions: protocol extensions enabled on every connection, e.g. ('blake2b', 'zlib')
+    :param version: 2 to ask for binary framing on every connection
+    :return: True if the whole file has been downloaded
+    '''
+    with connect(host, port, user, extensions, version) as s:
+        filesize = s.downloadRange(filename, date, 0, 0)    # Only asks for the size
+        s.sendTextCommand('Q')
+    if filesize is None:
+        print("File not found on server")
+        return False
+
+    with open(filename, 'wb') as fd:
+        fd.truncate(filesize)
+    combined = RangeProgress(progress, filesize)
+
+    def downloadOne(byte_range):
+        offset, count = byte_range
+        with connect(host, port, user, extensions, version) as s:
+            received = s.downloadRange(filename, date, offset, count, combined.forRange(offset))
+            s.sendTextCommand('Q')
+        return received
+
+    ranges = splitRange(filesize, streams)
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="Stream") as pool:
+        results = list(pool.map(downloadOne, ranges))
+
+    if None in results:
+        print("Server error")
+        return False
+    print(f"Received {filesize} bytes")
+    return True
+
+def parseManifest(path) -> list:
+    '''
+    Reads the operations of a batch from a manifest file, one per line:
+    "U file_name" uploads a file, "D file_name [yyyymmdd]" downloads one, today's by default.
+    Blank lines and lines starting with # are skipped.
+    :return: list of (verb, file name, date) tuples, date is None for uploads
+    :raise ValueError: if a line isn't an operation
+    '''
+    operations = []
+    with open(path) as fd:
+        for number, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            verb, _, filename = line.partition(' ')
+            filename = filename.strip()
+            if verb not in ('U', 'D') or not filename:
+                raise ValueError(f"{path}:{number}: expected \"U file_name\" or \"D file_name [yyyymmdd]\"")
+
+            date = None
+            if verb == 'D':
+                head, _, tail = filename.rpartition(' ')
+                if head and len(tail) == 8 and tail.isdigit():
+                    filename, date = head, tail
+                else:
+                    date = datetime.datetime.now().strftime("%Y%m%d")
+            operations.append((verb, filename, date))
+    return operations
+
+def runBatch(host, port, user, operations, workers=4, extensions=(), dedupe=False, version=1) -> bool:
+    '''
+    Runs uploads and downloads without prompting, spread across worker connections,
+    then prints the bytes, time and throughput of every file and of the whole batch.
+    :param operations: (verb, file name, date) tuples, see parseManifest
+    :param workers: connections transferring files at once
+    :return: True if no operation failed. Uploads of files the server already has are skipped, not failed
+    '''
+    pending = queue.SimpleQueue()
+    for operation in operations:
+        pending.put(operation)
+    results = []    # (verb, file name, bytes, seconds, status), appended by every worker
+
+    def work():
+        with connect(host, port, user, extensions, version) as s:
+            while True:
+                try:
+                    verb, filename, date = pending.get_nowait()
+                except queue.Empty:
+                    break
+
+                started = time.monotonic()
+                size = 0
+                try:
+                    if verb == 'U':
+                        if not os.path.isfile(filename):
+                            status = 'NOFILE'
+                        else:
+                            status = s.upload(filename, dedupe=dedupe).decode('utf-8').rstrip('\n')
+                            if status == 'OK':
+                                size = os.path.getsize(filename)
+                    else:
+                        size = s.download(filename, date)
+                        status = 'ERROR' if size is None else 'OK'
+                except FileNotFoundError:
+                    status = 'NOTFOUND'
+                except ChecksumError:
+                    status = 'CORRUPTED'
+                results.append((verb, filename, size or 0, time.monotonic() - started, status))
+            s.sendTextCommand('Q')
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Worker") as pool:
+        for future in [pool.submit(work) for _ in range(min(workers, len(operations)))]:
+            future.result()     # Raises connection errors
+    elapsed = time.monotonic() - started
+
+    width = max((len(filename) for _, filename, *_ in results), default=0)
+    for verb, filename, size, seconds, status in results:
+        rate = formatRate(size / seconds) if size and seconds else '-'
+        print(f"{verb} {filename:<{width}} {size:>12} B {seconds:8.2f} s {rate:>12}  {status}")
+
+    total = sum(size for _, _, size, _, _ in results)
+    failed = sum(status not in ('OK', 'STORED', 'EXISTS') for *_, status in results)
+    print(f"{len(results)} files, {total} bytes in {elapsed:.2f} s "
+          f"({formatRate(total / elapsed) if elapsed else '-'}), {failed} failed")
+    return not failed
+
+def main(host, port, streams=1, extensions=(), dedupe=False, version=1):
     with SFPClientHandler(socket.AF_INET, socket.SOCK_STREAM) as s:
 
         try:
             s.connect((host, port))
 
             user = input("What's your name?")
-            if not s.auth(user):
+            if not s.auth(user, version):
                 print("User authentication error")
                 raise KeyboardInterrupt()
+            if extensions and not s.enableExtensions(*extensions):
+                print(f"Server doesn't support {' '.join(extensions)}")
+                raise KeyboardInterrupt()
 
             while True:
                 command = input(">> ")
@@ -129,19 +649,29 @@ def main(host, port):
                         print("This file doesn't exist")
                         continue
 
-                    s.uploadFile(filename, filesize)
+                    if streams > 1:
+                        parallelUpload(host, port, user, filename, streams, TransferProgress(filename), extensions, dedupe,
+                                       version)
+                    else:
+                        s.uploadFile(filename, filesize, TransferProgress(filename), resume=True, dedupe=dedupe)
 
                 elif command[0] == 'D':
                     dirname = input("What day did you upload the file?(yyyymmdd) ")
                     if not dirname: dirname = datetime.datetime.now().strftime("%Y%m%d")
                     filename = input("Enter filename: ")
+                    resume = False
                     if os.path.exists(filename):
-                        overwrite = input("File exists. Overwrite?[y/n] ")
-                        if overwrite != 'y':
+                        choice = input("File exists. Resume, overwrite or abort?[r/o/n] ")
+                        if choice not in ('r', 'o'):
                             print("File download aborted")
                             continue
+                        resume = choice == 'r'
 
-                    s.downloadFile(filename, dirname)
+                    if streams > 1 and not resume:
+                        parallelDownload(host, port, user, filename, dirname, streams, TransferProgress(filename), extensions,
+                                         version)
+                    else:
+                        s.downloadFile(filename, dirname, TransferProgress(filename), resume)
 
                 elif command[0] == 'L':
                     dirname = input("What day do you want to search for?(yyyymmdd) ")
@@ -161,6 +691,9 @@ def main(host, port):
         except ConnectionResetError:
             logging.info("Server forced a disconnection")
 
+        except ChecksumError as e:
+            logging.error(f"Transfer corrupted, {e}")
+
         logging.info("Closing connection")
 
 
@@ -170,7 +703,47 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", metavar="host", type=str, default='localhost', required=False)
     parser.add_argument("--port", metavar="port", type=int, default=9999, required=False)
+    parser.add_argument("--streams", metavar="streams", type=int, default=1, required=False,
+                        help="connections used to transfer each file in parallel")
+    parser.add_argument("--checksum", metavar="algorithm", type=str, default=None, required=False,
+                        help="verify every transfer with a digest, e.g. blake2b or sha256")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="skip uploads of files whose content the server already holds")
+    parser.add_argument("--compression", metavar="method", type=str, default=None, required=False,
+                        help="compress transfers with zlib, bz2 or lzma")
+    parser.add_argument("--protocol", metavar="version", type=int, choices=(1, 2), default=1, required=False,
+                        help="2 to use binary framing, if the server supports it")
+    batch = parser.add_argument_group("batch mode", "transfer files without prompting, then print a summary")
+    batch.add_argument("--user", metavar="name", type=str, default=None, required=False,
+                       help="name to log in with, required in batch mode")
+    batch.add_argument("--upload", metavar="file", type=str, nargs='+', action='extend', default=[],
+                       help="files to upload")
+    batch.add_argument("--download", metavar="file", type=str, nargs='+', action='extend', default=[],
+                       help="files to download")
+    batch.add_argument("--date", metavar="yyyymmdd", type=str, default=None, required=False,
+                       help="day of the files to download, today by default")
+    batch.add_argument("--manifest", metavar="path", type=str, default=None, required=False,
+                       help="file listing operations, one per line: \"U file_name\" or \"D file_name [yyyymmdd]\"")
+    batch.add_argument("--workers", metavar="workers", type=int, default=4, required=False,
+                       help="connections transferring files at once")
 
     args = parser.parse_args(sys.argv[1:])
-
-    main(args.host, args.port)
\ No newline at end of file
+    extensions = [name for name in (args.checksum, args.compression) if name]
+
+    if args.upload or args.download or args.manifest:
+        if not args.user:
+            parser.error("batch mode needs --user")
+        date = args.date or datetime.datetime.now().strftime("%Y%m%d")
+        operations = [('U', filename, None) for filename in args.upload] + \
+                     [('D', filename, date) for filename in args.download]
+        try:
+            if args.manifest:
+                operations += parseManifest(args.manifest)
+            succeeded = runBatch(args.host, args.port, args.user, operations, args.workers,
+                                 extensions, args.dedupe, args.protocol)
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            succeeded = False
+        sys.exit(0 if succeeded else 1)
+
+    main(args.host, args.port, args.streams, extensions, args.dedupe, args.protocol)
\ No newline at end of file
@@ -5,228 +5,106 @@ Students File Protocol server implementation.
 Using blocking-IO model and threading.
 
 Protocol is defined in README.md of this directory.
+Sessions are implemented by sfp/protocol.py, this server performs their I/O.
 '''
 
 import socket
 import socketserver
 import os
-import logging
 import argparse
 import sys
-import datetime as dt
 
-__author__ = 'Giulio Corradini'
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sockutil.buffer import SocketBuffer
+from sfp.protocol import request_log
+from sfp.serving import BlockingHandler, profiler, limits, addServerOptions, configureServer, serveThreaded
+from sockutil.logqueue import addLoggingOptions, configureFromOptions
+from sockutil.pool import addPoolOptions
 
+__author__ = 'Giulio Corradini'
 
-class SFPClientHandler(socketserver.BaseRequestHandler, socket.socket):
+class SFPClientHandler(BlockingHandler, socketserver.BaseRequestHandler, socket.socket):
     CLIENT_NUMBER = 0
 
     def __init__(self, request, client_address, server):
-        socket.socket.__init__(self, fileno=request.fileno())
+        # The handler takes over the descriptor: sharing it with request closed it twice, the second time
+        # possibly under another connection which had been given the same number meanwhile
+        socket.socket.__init__(self, fileno=request.detach())
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Responses are coalesced by flush
         SFPClientHandler.CLIENT_NUMBER += 1
 
-        self.buffer = bytearray()
-        self.user: str = None
-        self.working_directory: str = None
+        self.write_buffer = SocketBuffer()
+        self.openSession()
 
         socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
 
-    def handle(self) -> None:
+    def finish(self) -> None:
+        self.closeSession()
         try:
-            while True:
-                if self.user == None:   #Read authentication string
-                    logging.debug("User requests auth")
-
-                    user_auth_str = self.consumeBuffer(self.readUntil(b'\n'))\
-                                        .decode('utf-8')\
-                                        .rstrip('\n')
-                    sanitized = self.sanitizeInput(user_auth_str)   # Since a user might inject a malicious
-                                                                    # path as its username (e.g. ../)
-
-                    if not sanitized:
-                        self.sendall(b'ERROR\n')
-                        logging.warning("Sent an invalid sequence as login name. Forcing disconnection")
-                        break
-                    else:
-                        self.sendall(b'OK\n')
-                    self.user = sanitized
-
-                    self.working_directory = dt.datetime.today().strftime("%Y%m%d") + self.user
-                    if not os.path.exists(self.working_directory):
-                        os.mkdir(self.working_directory)
-
-                    logging.debug("{} logged in".format(self.user))
-
-
-                command = self.consumeBuffer( self.readUntil(b'\n') )\
-                            .decode('utf-8')[:-1]\
-                            .split(' ', 3)
-
-                # Parse commands
-                if command[0] == 'U':
-                    filename, filesize = command[1:]
-
-                    try:
-                        filesize = int(filesize)
-                    except ValueError:
-                        self.sendall(b'ERROR\n')
-                        continue
-
-                    filename = self.sanitizeInput(filename)
-
-                    path = os.path.join(self.working_directory, filename)
-
-                    if os.path.exists(path):
-                        self.sendall(b'EXISTS\n')
-                        continue
-                    else:
-                        self.sendall(b'OK\n')
-                        with open(path, 'bw') as fd:
-                            self.recvLeast(filesize)
-                            fd.write(self.consumeBuffer(filesize))
-
-                        logging.info(f"{self.user} uploaded a file: {filename}")
-
-                elif command[0] == 'D':
-                    fname, date = command[1:]
-                    fname = self.sanitizeInput(fname)
-                    if not self.sanitizeInput(date, type="date"):
-                        self.sendall(b'ERROR\n')
-                        continue
-
-                    found = None
-                    for dirpath, _, filenames in os.walk(f"{date}{self.user}"):
-                        if fname in filenames:
-                            found = os.path.join(dirpath, fname)
-
-                    if found:
-                        filesize = os.stat(found).st_size
-                        self.sendall(f"{filesize}\n".encode('utf-8'))
-                        with open(found, 'rb') as fd:
-                            self.sendall(fd.read())
-                    else:
-                        self.sendall(b'NOTFOUND\n')
-
-                elif command[0] == 'L':
-                    date = command[1]
-                    if not self.sanitizeInput(date, type="date"):
-                        self.sendall(b'ERROR\n')
-                        continue
-
-                    filelist = None
-                    for _, _, filenames in os.walk(f"{date}{self.user}"):
-                        filelist = ", ".join(filenames) + "\n"
-                        self.sendall(filelist.encode('utf-8'))
-                        break
-
-                    if not filelist: self.sendall(b'NOTFOUND\n')
-
-                elif command[0] == 'H':
-                    self.sendall('''Students File Protocol commands usage:
-                    U - Upload a file
-                    D - Download a file
-                    L - List files in directory
-                    H - Show this help message
-                    Q - Disconnect from server, close client\n\n'''.encode('utf-8'))
-
-                elif command[0] == 'Q':
-                    self.sendall(b'GOODBYE\n')
-                    logging.info("Client has notified disconnection")
-                    break
-
-                else:
-                    self.sendall(b'INVALID\n')
-
-        except socket.error:
-            logging.info("Connection reset")
-
-        logging.info("Finished")
-
-    def sanitizeInput(self, user_input: str, type = "str"):
-        '''
-        Sanitizes user input for path and dates.
-        :param input: string to santize.
-        :param type: "str" or "date", defines the sanity check method.
-        :return: input without paths for str.
-            True/False if date is valid.
-        '''
-        if type == "str":
-            head, tail = os.path.split(user_input)
-            return tail.strip().strip('.')  # Remove leading/trailing spaces and dots
-        elif type == "date":
-            try:
-                dt.datetime.strptime(user_input, "%Y%m%d")
-                return True
-            except ValueError:
-                return False
-
-    def recv(self, *args, **kwargs) -> bytes:
-        '''
-        Reimplemented recv with auto-check and close
-        '''
-        data = super().recv(*args, **kwargs)
-        if not data:
-            logging.warning("{} disconnected".format(self.user))
-            raise socket.error()
-        return data
-
-    def recvLeast(self, n):
-        received = 0
-        while received < n:
-            data = self.recv(4096)
-            self.buffer += data
-            received += len(data)
-
-    #   Utility functions for socket buffer management
-    def readUntil(self, char: bytes) -> int:
+            self.shutdown(socket.SHUT_WR)   # What the server would do to request, now detached
+        except OSError:
+            pass
+        self.close()
+
+    def receive(self, n: int) -> bytes:
+        return self.recv(n)
+
+    def respond(self, data: bytes) -> None:
         '''
-        Receives bytes from the socket until char is met.
-        :param char: byte value to look for
-        :return: char position in self.buffer
+        Queues data until flush is called.
+        Responses to pipelined commands leave in as few packets as possible.
         '''
-        str_end = -1
-        while str_end == -1:
-            self.buffer += self.recv(4096)
-            str_end = self.buffer.find(char)
+        self.write_buffer.append(data)
+
+    def sendPayload(self, data: bytes) -> None:
+        self.sendall(data)
 
-        return str_end
+    def sendZeroCopy(self, fd, offset: int, count: int) -> int:
+        return self.sendfile(fd, offset, count)     # Falls back to chunked send()
 
-    def consumeBuffer(self, n=0, include_last=True) -> bytearray:
+    def flush(self) -> None:
         '''
-        Consume bytes from self.buffer and deletes from it
-        :param n: Position of last byte to consume
-        :param include_last: Include n-th byte in consumed slice
-        :return: bytearray slice in range [0; n]
+        Sends every queued response.
         '''
-        if include_last:
-            n += 1
-        consumed = self.buffer[:n]
-        del self.buffer[:n]
-        return consumed
-
+        while self.write_buffer:
+            self.stats.sent += self.write_buffer.sendTo(self)
 
 
-def main(host, port):
+def main(host, port, blobs=None, user_rate=None, total_rate=None, user_transfers=None, total_transfers=None,
+         metrics_port=None, admin_users=(), profile_dir=None, profile_seconds=None, pool_workers=None,
+         pool_queue=None, pool_policy='wait'):
     '''
     Front desk. Manages the registration of clients.
     :param host: host to bind the listening socket to
     :param port: port to listen on
+    :param blobs: directory of the deduplicating blob store, None to disable it
+    :param user_rate: bytes per second transferred by each user, None for no limit
+    :param total_rate: bytes per second transferred by the server, None for no limit
+    :param user_transfers: transfers running at once for each user, the others are queued
+    :param total_transfers: transfers running at once on the server, the others are queued
+    :param metrics_port: local port of the Prometheus endpoint, None to disable it
+    :param admin_users: users allowed to run admin commands, e.g. S
+    :param profile_dir: directory of profiling reports, the working directory by default
+    :param profile_seconds: length of the captures started by SIGUSR1
+    :param pool_workers: threads serving clients, None for a thread per client
+    :param pool_queue: clients waiting for a worker, twice the workers by default
+    :param pool_policy: what to do with new clients when the queue is full, see sockutil/pool.py
     '''
-
-    logging.info(f"Starting server on port {port}")
-
-    with socketserver.ThreadingTCPServer((host, port), SFPClientHandler) as server:
-        try:
-            server.serve_forever()
-        except KeyboardInterrupt:
-            logging.info("Exiting")
+    configureServer(blobs, metrics_port, admin_users, profile_dir, profile_seconds)
+    limits.configure(user_rate, total_rate, user_transfers, total_transfers)
+    profiler.installSignals()
+    serveThreaded(SFPClientHandler, host, port, pool_workers, pool_queue, pool_policy)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(format="%(asctime)s\t%(levelname)s\t%(threadName)s\t%(message)s", level=logging.DEBUG)
     parser = argparse.ArgumentParser()
-    parser.add_argument("--address", "-a", default='', required=False, metavar="address")
-    parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    addServerOptions(parser)
+    addPoolOptions(parser)
+    addLoggingOptions(parser)
 
     args = parser.parse_args(sys.argv[1:])
-    main(args.address, args.port)
\ No newline at end of file
+    configureFromOptions(args, "%(asctime)s\t%(levelname)s\t%(threadName)s\t%(message)s", request_log)
+    main(args.address, args.port, args.blobs,
+         args.user_rate, args.total_rate, args.user_transfers, args.total_transfers, args.metrics_port, args.admin,
+         args.profile_dir, args.profile_seconds, args.pool, args.pool_queue, args.pool_full)
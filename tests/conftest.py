@@ -0,0 +1,12 @@
+'''
+conftest.py
+
+Shared modules live in the repository root, tests import them from there.
+'''
+
+import os
+import sys
+
+__author__ = 'Giulio Corradini'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
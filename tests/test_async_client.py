@@ -0,0 +1,87 @@
+'''
+test_async_client.py
+
+The pooled asyncio client against the asyncio server.
+'''
+
+import os
+import socket
+import asyncio
+import importlib.util
+
+import pytest
+
+from test_drivers import ROOT, SERVERS, running
+
+__author__ = 'Giulio Corradini'
+
+# Its directory is named after the standard library package, so it can't be imported by name
+spec = importlib.util.spec_from_file_location('async_sfp_client', os.path.join(ROOT, 'asyncio/async_sfp_client.py'))
+client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(client)
+
+
+@pytest.fixture
+def server(tmp_path):
+    directory = tmp_path / 'server'
+    directory.mkdir()
+    with running(SERVERS['async'], directory) as (address, _):
+        yield address
+
+
+def test_pool_reuses_connection_after_notfound(server):
+    async def session():
+        async with client.SFPPool(*server, 'alice', size=1) as pool:
+            with pytest.raises(client.RemoteFileNotFoundError):
+                await pool.download('missing.txt')
+            assert len(pool._idle) == 1
+            assert await pool.list() == []
+
+    asyncio.run(session())
+
+
+def test_pool_closes_connection_after_local_error(server, tmp_path):
+    source = tmp_path / 'a.txt'
+    source.write_bytes(b'hello')
+
+    async def session():
+        async with client.SFPPool(*server, 'alice', size=1) as pool:
+            assert await pool.upload(str(source), remote='a.txt') == b'OK\n'
+            with pytest.raises(FileNotFoundError):
+                await pool.download('a.txt', local=str(tmp_path / 'nodir' / 'a.txt'))  # Payload left unread
+            assert not pool._idle
+            assert await pool.list() == ['a.txt']      # On a new connection
+
+    asyncio.run(session())
+
+
+def test_sync_tree(server, tmp_path):
+    tree = tmp_path / 'tree'
+    (tree / 'notes').mkdir(parents=True)
+    (tree / 'a.txt').write_bytes(b'hello')
+    (tree / 'notes' / 'week1.txt').write_bytes(b'x' * 200000)     # Several chunks
+
+    async def session():
+        async with client.SFPPool(*server, 'alice', extensions=('blake2b',)) as pool:
+            assert await pool.syncTree(str(tree), dedupe=True) == {'a.txt': b'OK\n',
+                                                                   os.path.join('notes', 'week1.txt'): b'OK\n'}
+            assert sorted(await pool.list()) == ['a.txt', 'notes__week1.txt']
+            assert await pool.download('notes__week1.txt', local=str(tmp_path / 'week1.txt')) == 200000
+
+    asyncio.run(session())
+    assert (tmp_path / 'week1.txt').read_bytes() == b'x' * 200000
+
+
+def test_text_command_without_payload():
+    async def session(local):
+        reader, writer = await asyncio.open_connection(sock=local)
+        sfp = client.SFPClient(reader, writer)
+        assert await sfp.sendTextCommand('Q') == 'GOODBYE\n'
+        writer.close()
+        await writer.wait_closed()
+
+    local, server = socket.socketpair()
+    with server:
+        server.sendall(b'GOODBYE\n')
+        asyncio.run(session(local))
+        assert server.recv(100) == b'Q\n'
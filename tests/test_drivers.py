@@ -0,0 +1,296 @@
+'''
+test_drivers.py
+
+Sessions over a real connection, with every server of the repository
+running as a process of its own.
+'''
+
+import os
+import sys
+import time
+import socket
+import contextlib
+import zlib
+import datetime
+import subprocess
+
+import pytest
+
+from sfp.compression import FRAME_HEADER, COMPRESSED, parseFrameHeader, decodeBlock
+from sfp.framing import HEADER, VERSION_ACCEPTED, encodeMessage, parseHeader, decodeFields
+
+__author__ = 'Giulio Corradini'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    'thread': 'students_file_transfer/sfp_server.py',
+    'stream': 'students_file_transfer/sfp_server_stream.py',
+    'async': 'asyncio/async_sfp_server.py',
+    'select': 'wait_fd_select/sfp_server_select.py',
+}
+TIMEOUT = 5
+
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def running(script: str, directory, *options):
+    '''
+    Runs a server in directory until the block ends.
+    :param options: command line options of the server
+    :return: ((host, port) it listens on, its process)
+    '''
+    port = freePort()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, script), '-p', str(port), *options],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield ('127.0.0.1', port), process
+    finally:
+        process.terminate()
+        process.wait(TIMEOUT)
+
+
+@pytest.fixture(params=SERVERS)
+def server(request, tmp_path):
+    '''
+    Starts a server in an empty working directory.
+    :return: (host, port) it listens on
+    '''
+    with running(SERVERS[request.param], tmp_path) as (address, _):
+        yield address
+
+
+def connect(address) -> socket.socket:
+    sock = socket.create_connection(address)
+    sock.settimeout(TIMEOUT)
+    return sock
+
+
+def readLine(sock: socket.socket) -> bytes:
+    line = b''
+    while not line.endswith(b'\n'):
+        byte = sock.recv(1)
+        if not byte:
+            break
+        line += byte
+    return line
+
+
+def login(address) -> socket.socket:
+    sock = connect(address)
+    sock.sendall(b'alice\n')
+    assert readLine(sock) == b'OK\n'
+    return sock
+
+
+def test_parallel_upload(server, tmp_path):
+    first, second = login(server), login(server)
+    with first, second:
+        second.sendall(b'U big 10 5 5\n')
+        assert readLine(second) == b'OK\n'
+        first.sendall(b'U big 10 0 5\n')
+        assert readLine(first) == b'OK\n'
+        first.sendall(b'01234')
+        second.sendall(b'56789')
+
+        for sock in (first, second):
+            sock.sendall(b'Q\n')
+            assert readLine(sock) == b'GOODBYE\n'
+
+    directory = tmp_path / f"{datetime.date.today():%Y%m%d}alice"
+    assert (directory / 'big').read_bytes() == b'0123456789'
+
+
+def test_upload_range_past_the_file_is_refused(server):
+    with login(server) as sock:
+        sock.sendall(b'U big 10 5 6\n')
+        assert readLine(sock) == b'ERROR\n'
+        sock.sendall(b'Q\n')
+        assert readLine(sock) == b'GOODBYE\n'
+
+
+def readUntil(sock: socket.socket, end: bytes) -> bytes:
+    received = b''
+    while not received.endswith(end):
+        data = sock.recv(4096)
+        if not data:
+            break
+        received += data
+    return received
+
+
+def test_pipelined_commands_are_answered_in_order(server):
+    today = f"{datetime.date.today():%Y%m%d}".encode()
+    with connect(server) as sock:
+        sock.sendall(b'alice\nU a.txt 5\nhelloD a.txt %s\nD a.txt %s 1 3\nX\nQ\n' % (today, today))
+        assert readUntil(sock, b'GOODBYE\n') == b'OK\nOK\n5\nhello3 5\nellINVALID\nGOODBYE\n'
+
+
+def readExactly(sock: socket.socket, n: int) -> bytes:
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def compressedUpload(address) -> bytes:
+    '''
+    Uploads a file in a compressed frame, then downloads it.
+    :return: downloaded file bytes
+    '''
+    data = b'abc' * 1000
+    block = zlib.compress(data)
+    with login(address) as sock:
+        sock.sendall(b'E zlib\n')
+        assert readLine(sock) == b'OK zlib\n'
+        sock.sendall(b'U z 3000\n')
+        assert readLine(sock) == b'OK\n'
+        sock.sendall(FRAME_HEADER.pack(COMPRESSED, len(block)) + block)
+
+        sock.sendall(b'D z %s\n' % f"{datetime.date.today():%Y%m%d}".encode())
+        assert readLine(sock) == b'3000\n'
+        received = b''
+        while len(received) < len(data):
+            flag, length = parseFrameHeader(readExactly(sock, FRAME_HEADER.size))
+            received += decodeBlock('zlib', flag, readExactly(sock, length))
+        return received
+
+
+def test_compressed_transfer(server):
+    assert compressedUpload(server) == b'abc' * 1000
+
+
+def test_compression_processes_release_the_port(tmp_path):
+    with running(SERVERS['async'], tmp_path) as (address, _):
+        compressedUpload(address)   # Starts the compression pool
+    assert portReleased(address)
+
+
+def portReleased(address, timeout: float = 0) -> bool:
+    '''
+    Whether no process listens on address anymore, waiting up to timeout for it.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(address)
+                return True
+            except OSError:
+                if time.monotonic() > deadline:
+                    return False
+        time.sleep(0.1)
+
+
+def readMessage(sock: socket.socket) -> tuple:
+    '''
+    :return: (code, request id, fields) of an SFP/2 message
+    '''
+    code, count, request_id, length = parseHeader(readExactly(sock, HEADER.size))
+    return code, request_id, decodeFields(readExactly(sock, length), count)
+
+
+def test_binary_framing(server):
+    today = f"{datetime.date.today():%Y%m%d}"
+    with connect(server) as sock:
+        sock.sendall(b'SFP/2 alice\n')
+        assert readLine(sock) == VERSION_ACCEPTED
+        sock.sendall(encodeMessage('U', 1, ['a b.txt', '5']))   # Names may hold spaces
+        assert readMessage(sock) == ('U', 1, ['OK'])
+        sock.sendall(b'hello' + encodeMessage('L', 2, [today]) + encodeMessage('Q', 3, []))
+        assert readMessage(sock) == ('L', 2, ['a b.txt'])
+        assert readMessage(sock) == ('Q', 3, ['GOODBYE'])
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason="Workers need SO_REUSEPORT")
+def test_workers_stop_when_the_supervisor_dies(tmp_path):
+    with running(SERVERS['async'], tmp_path, '--workers', '2') as (address, supervisor):
+        supervisor.kill()   # No chance to stop its workers
+        supervisor.wait()
+        assert portReleased(address, TIMEOUT)
+
+
+def test_filesystem_error_is_answered(server):
+    with login(server) as sock:
+        sock.sendall(b'U a\x00b 5\nabcde')  # The partial file can't be opened: payload discarded
+        assert readLine(sock) == b'OK\n'
+        assert readLine(sock) == b'ERROR\n'
+
+        sock.sendall(b'U b 5\nabcde')       # The session goes on
+        assert readLine(sock) == b'OK\n'
+        sock.sendall(b'Q\n')
+        assert readLine(sock) == b'GOODBYE\n'
+
+
+def readUntilClosed(sock: socket.socket) -> bytes:
+    '''
+    :return: what the server sends until it closes the connection
+    :raise socket.timeout: if it doesn't close it
+    '''
+    received = b''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return received
+        received += data
+
+
+@pytest.mark.parametrize('script, response', [
+    (b'alice\nQ\n', b'OK\nGOODBYE\n'),
+    (b'SFP/2 alice\n' + b'\xff' * 11, b'OK SFP/2\n'),     # Invalid header
+    (b'\xff\xfe\n', b'ERROR\n'),                         # Login isn't utf-8
+])
+def test_connection_is_closed_when_the_session_ends(server, script, response):
+    with connect(server) as sock:
+        sock.sendall(script)
+        assert readUntilClosed(sock) == response
+
+
+def test_truncated_file_is_sent_whole(server, tmp_path):
+    today = f"{datetime.date.today():%Y%m%d}"
+    with login(server) as sock:
+        sock.sendall(b'U a.txt 5\nhello')
+        assert readLine(sock) == b'OK\n'
+        sock.sendall(b'L %s\n' % today.encode())   # Indexes the directory
+        assert readLine(sock) == b'a.txt\n'
+        os.truncate(tmp_path / f"{today}alice" / 'a.txt', 3)
+        sock.sendall(b'D a.txt %s\nQ\n' % today.encode())
+        assert readUntil(sock, b'GOODBYE\n') == b'3\nhelGOODBYE\n'
+
+
+@pytest.mark.parametrize('script', ['thread', 'stream', 'async'])
+def test_shaped_transfers(script, tmp_path):
+    limits = ('--user-rate', '1000000', '--total-rate', '2000000', '--user-transfers', '1', '--total-transfers', '2')
+    with running(SERVERS[script], tmp_path, *limits) as (address, _):
+        with login(address) as sock:
+            sock.sendall(b'U a.txt 5\nhelloD a.txt %s\nQ\n' % f"{datetime.date.today():%Y%m%d}".encode())
+            assert readUntil(sock, b'GOODBYE\n') == b'OK\n5\nhelloGOODBYE\n'
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason="Workers need SO_REUSEPORT")
+def test_workers_log_once_to_the_log_file(tmp_path):
+    log = tmp_path / 'server.log'
+    with running(SERVERS['async'], tmp_path, '--workers', '2', '--log-file', str(log)):
+        deadline = time.monotonic() + TIMEOUT
+        while log.read_text().count("Starting server") < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    lines = log.read_text().splitlines()
+    for worker in ('Worker-0', 'Worker-1'):
+        assert sum(worker in line and "Starting server" in line for line in lines) == 1
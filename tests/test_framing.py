@@ -0,0 +1,37 @@
+'''
+test_framing.py
+
+Binary messages of SFP/2.
+'''
+
+import pytest
+
+from sfp.framing import HEADER, MAX_BODY, encodeMessage, parseHeader, decodeFields
+
+__author__ = 'Giulio Corradini'
+
+
+def test_message_round_trip():
+    message = encodeMessage('D', 7, ['a file.txt', '20240101', ''])
+    code, count, request_id, length = parseHeader(message[:HEADER.size])
+    assert (code, count, request_id, length) == ('D', 3, 7, len(message) - HEADER.size)
+    assert decodeFields(message[HEADER.size:], count) == ['a file.txt', '20240101', '']
+
+
+@pytest.mark.parametrize('header', [
+    b'\xff' + HEADER.pack(b'L', 0, 1, 0)[1:],        # Code isn't ASCII
+    HEADER.pack(b'L', 0, 1, MAX_BODY + 1),           # Body too large
+])
+def test_invalid_header_is_refused(header):
+    with pytest.raises(ValueError):
+        parseHeader(header)
+
+
+@pytest.mark.parametrize('body, count', [
+    (b'\x00\x02ab', 2),         # Fewer fields than announced
+    (b'\x00\x02abc', 1),        # Bytes after the last field
+    (b'\x00\x02\xff\xfe', 1),   # Field isn't utf-8
+])
+def test_invalid_body_is_refused(body, count):
+    with pytest.raises(ValueError):
+        decodeFields(body, count)
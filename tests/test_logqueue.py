@@ -0,0 +1,43 @@
+'''
+test_logqueue.py
+
+Logging configured more than once, as forked worker processes do.
+'''
+
+import logging
+
+import pytest
+
+from sockutil import logqueue
+from sockutil.logqueue import configureLogging, limitLogger, SampleFilter, RateLimitFilter
+
+__author__ = 'Giulio Corradini'
+
+
+@pytest.fixture(autouse=True)
+def unconfigured():
+    yield
+    logqueue._removeConfiguration()
+
+
+@pytest.mark.parametrize('queued', [False, True])
+def test_configuration_is_replaced(tmp_path, queued):
+    root = logging.getLogger()
+    before = len(root.handlers)
+    configureLogging("first %(message)s", filename=str(tmp_path / 'first.log'), queued=queued)
+    configureLogging("second %(message)s", filename=str(tmp_path / 'second.log'), queued=queued)
+    assert len(root.handlers) == before + 1
+
+    logging.getLogger('test').warning("hello")
+    logqueue._removeConfiguration()     # Writes the queued records
+    assert (tmp_path / 'first.log').read_text() == ''
+    assert (tmp_path / 'second.log').read_text() == "second hello\n"
+
+
+def test_limits_are_replaced():
+    logger = logging.getLogger('test.limits')
+    limitLogger(logger, 10, 5.0)
+    limitLogger(logger, 2)
+    assert [type(f) for f in logger.filters] == [SampleFilter]
+    limitLogger(logger)
+    assert not logger.filters
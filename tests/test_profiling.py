@@ -0,0 +1,78 @@
+'''
+test_profiling.py
+
+Captures of threads which exist before they start, like pooled workers.
+'''
+
+import sys
+import time
+import threading
+
+from sockutil.profiling import Profiler
+
+__author__ = 'Giulio Corradini'
+
+
+def busyFunction():
+    return sum(range(1000))
+
+
+def serveClient(profiler: Profiler) -> None:
+    '''
+    What the thread of a threaded server does for a client.
+    '''
+    profiler.checkpoint()
+    busyFunction()
+    profiler.checkpoint(leave=True)
+
+
+def test_existing_thread_joins_capture(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    client, served = threading.Event(), threading.Event()
+    hooks = []
+
+    def worker():
+        client.wait()
+        serveClient(profiler)
+        hooks.append(sys.getprofile())
+        served.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    profiler.startCapture(1)
+    client.set()
+    served.wait()
+    path = profiler.stopCapture()
+    thread.join()
+
+    with open(path) as fd:
+        report = fd.read()
+    assert 'profiled threads: 2\n' in report
+    assert 'busyFunction' in report
+    assert hooks == [None]  # The worker left the capture
+
+
+def test_busy_thread_leaves_ended_capture(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    joined, stop = threading.Event(), threading.Event()
+
+    def worker():   # Busy with a long transfer, a checkpoint for every chunk
+        while not stop.is_set():
+            profiler.checkpoint()
+            busyFunction()
+            if sys.getprofile() is not None:
+                joined.set()
+            time.sleep(0.01)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    profiler.startCapture(1)
+    joined.wait()
+    path = profiler.stopCapture()   # Waits for the worker to leave
+    stop.set()
+    thread.join()
+
+    with open(path) as fd:
+        report = fd.read()
+    assert 'profiled threads: 2\n' in report
+    assert 'busyFunction' in report
@@ -0,0 +1,173 @@
+'''
+test_protocol.py
+
+Sessions of the sans-I/O engine, driven inline like the threaded server does.
+'''
+
+import os
+import zlib
+import datetime
+
+import pytest
+
+from sfp.protocol import ServerContext, ServerSession, NeedData, Send, Disk, OpenFile, Write, Decode, SendFile, \
+    CloseFile, Profile, Close
+from sfp.compression import decodeBlock, FRAME_HEADER, COMPRESSED
+from sfp.framing import HEADER, MAX_BODY, VERSION_ACCEPTED, encodeMessage
+
+__author__ = 'Giulio Corradini'
+
+
+def converse(chunks, context: ServerContext = None) -> tuple:
+    '''
+    Drives a session, performing its actions inline.
+    :param chunks: bytes sent by the client, each one received at once. The client closes the connection after them
+    :return: (bytes sent to the client, names of the actions in order)
+    '''
+    session = ServerSession(context or ServerContext())
+    chunks = iter(chunks)
+    sent, actions, fd = [], [], None
+    action = session.nextAction()
+    while not isinstance(action, Close):
+        actions.append(type(action).__name__)
+        result = None
+        try:
+            if isinstance(action, NeedData):
+                session.receiveData(next(chunks, b''))
+            elif isinstance(action, Send):
+                sent.append(action.data)
+            elif isinstance(action, Disk):
+                result = action.call()
+            elif isinstance(action, OpenFile):
+                fd = action.call()
+            elif isinstance(action, Write):
+                fd.write(action.data)
+                if action.digest: action.digest.update(action.data)
+            elif isinstance(action, Decode):
+                result = decodeBlock(action.method, action.flag, action.block)
+            elif isinstance(action, SendFile):
+                fd.seek(action.offset)
+                data = fd.read(action.count)
+                if action.digest: action.digest.update(data)
+                sent.append(data)
+            elif isinstance(action, CloseFile):
+                if fd: fd.close()
+                fd = None
+            elif isinstance(action, Profile):
+                raise RuntimeError("Not profiling in tests")
+        except (ValueError, RuntimeError, OSError) as e:
+            action = session.actionFailed(action, e)
+        else:
+            action = session.nextAction(result)
+    return b''.join(sent), actions
+
+
+@pytest.fixture(autouse=True)
+def workingDirectory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # Sessions create the users' directories in the current one
+    return tmp_path
+
+
+@pytest.mark.parametrize('command', [b'U a -5\n', b'R a -5\n', b'A a -1 ' + b'0' * 64 + b'\n'])
+def test_negative_file_size_is_refused(command):
+    sent, _ = converse([b'alice\n', command, b'Q\n'])
+    assert sent == b'OK\nERROR\nGOODBYE\n'
+
+
+@pytest.mark.parametrize('command', [b'U a 10 0 0\n', b'U a 10 10 0\n', b'U a 10 5 6\n', b'U a 10 -1 2\n'])
+def test_invalid_upload_range_is_refused(command):
+    sent, _ = converse([b'alice\n', command, b'Q\n'])
+    assert sent == b'OK\nERROR\nGOODBYE\n'
+
+
+def today() -> bytes:
+    return datetime.date.today().strftime('%Y%m%d').encode()
+
+
+def test_upload_action_sequence(workingDirectory):
+    sent, actions = converse([b'alice\n', b'U a.txt 5\n', b'hello', b'Q\n'])
+    assert sent == b'OK\nOK\nGOODBYE\n'
+    assert actions == ['NeedData', 'Disk', 'Send',                          # Login, creating the directory
+                       'NeedData', 'Disk', 'Send',                          # U, checking the file doesn't exist
+                       'OpenFile', 'NeedData', 'Write', 'CloseFile', 'Disk',   # Payload, then commit
+                       'NeedData', 'Send']                                  # Q
+    assert (workingDirectory / f"{today().decode()}alice" / 'a.txt').read_bytes() == b'hello'
+
+
+def test_pipelined_commands_are_answered_in_order():
+    converse([b'alice\nU a.txt 5\nhello'])
+    sent, actions = converse([b'alice\nD a.txt %s\nD a.txt %s 1 3\nL %s\nX\nQ\n' % (today(), today(), today())])
+    assert sent == b'OK\n5\nhello3 5\nella.txt\nINVALID\nGOODBYE\n'  # Range "ell", then L
+    assert actions.count('NeedData') == 1   # Everything arrived in a single chunk
+    assert actions.count('OpenFile') == actions.count('CloseFile') == 2
+
+
+def test_download_of_missing_file():
+    sent, actions = converse([b'alice\nD a.txt %s\nQ\n' % today()])
+    assert sent == b'OK\nNOTFOUND\nGOODBYE\n'
+    assert 'OpenFile' not in actions
+
+
+def test_compressed_upload():
+    data = b'abc' * 1000
+    block = zlib.compress(data)
+    frame = FRAME_HEADER.pack(COMPRESSED, len(block)) + block
+    sent, actions = converse([b'alice\nE zlib\nU z 3000\n', frame, b'D z %s\nQ\n' % today()])
+    assert sent.startswith(b'OK\nOK zlib\nOK\n3000\n')
+    assert 'Decode' in actions
+
+
+def test_invalid_frame_ends_the_session():
+    sent, actions = converse([b'alice\nE zlib\nU z 3000\n', FRAME_HEADER.pack(COMPRESSED, 3) + b'bad', b'Q\n'])
+    assert sent == b'OK\nOK zlib\nOK\n'
+    assert actions[-1] == 'CloseFile'
+
+
+def test_parallel_upload_commits_once_every_range_arrived(workingDirectory):
+    directory = workingDirectory / f"{today().decode()}alice"
+    assert converse([b'alice\nU big 10 5 5\n56789Q\n'])[0] == b'OK\nOK\nGOODBYE\n'
+    assert not (directory / 'big').exists()
+
+    assert converse([b'alice\nU big 10 0 5\n01234Q\n'])[0] == b'OK\nOK\nGOODBYE\n'
+    assert (directory / 'big').read_bytes() == b'0123456789'
+    assert converse([b'alice\nU big 10 0 5\nQ\n'])[0] == b'OK\nEXISTS\nGOODBYE\n'
+
+
+def test_parallel_upload_ignores_abandoned_upload_of_another_size(workingDirectory):
+    converse([b'alice\nU big 20 0 10\n0123456789Q\n'])  # Abandoned
+    converse([b'alice\nU big 10 5 5\nfghijQ\n'])
+    converse([b'alice\nU big 10 0 5\nabcdeQ\n'])
+    assert (workingDirectory / f"{today().decode()}alice" / 'big').read_bytes() == b'abcdefghij'
+
+
+def test_binary_framing():
+    sent, _ = converse([b'SFP/2 alice\n', encodeMessage('L', 7, [today().decode()]), encodeMessage('Q', 8, [])])
+    assert sent == VERSION_ACCEPTED + encodeMessage('L', 7, []) + encodeMessage('Q', 8, ['GOODBYE'])  # No files yet
+
+
+@pytest.mark.parametrize('message', [
+    b'\xff' + HEADER.pack(b'L', 0, 1, 0)[1:],        # Code isn't ASCII
+    HEADER.pack(b'L', 0, 1, MAX_BODY + 1),           # Body too large
+    HEADER.pack(b'L', 2, 1, 4) + b'\x00\x02ab',      # Fewer fields than announced
+    HEADER.pack(b'L', 1, 1, 5) + b'\x00\x02abc',     # Bytes after the last field
+    HEADER.pack(b'L', 1, 1, 4) + b'\x00\x02\xff\xfe',    # Field isn't utf-8
+])
+def test_invalid_binary_message_ends_the_session(message):
+    sent, actions = converse([b'SFP/2 alice\n', message, encodeMessage('Q', 2, [])])
+    assert sent == VERSION_ACCEPTED     # Never answered: the stream can't be trusted anymore
+    assert actions == ['NeedData', 'Disk', 'Send', 'NeedData']
+
+
+@pytest.mark.parametrize('login', [b'\xff\xfe\n', b'../\n', b'\n'])
+def test_invalid_login_is_refused(login):
+    sent, _ = converse([login, b'Q\n'])
+    assert sent == b'ERROR\n'
+
+
+def test_download_sends_the_size_on_disk(workingDirectory):
+    context = ServerContext()
+    converse([b'alice\nU a.txt 5\nhello'], context)
+    assert converse([b'alice\nD a.txt %s\n' % today()], context)[0] == b'OK\n5\nhello'
+    os.truncate(workingDirectory / f"{today().decode()}alice" / 'a.txt', 3)  # The directory's mtime doesn't change
+    sent, _ = converse([b'alice\nD a.txt %s\nD a.txt %s 1 4\n' % (today(), today())], context)
+    assert sent == b'OK\n3\nhel2 3\nel'     # Ranges are clamped to the size on disk too
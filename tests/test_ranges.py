@@ -0,0 +1,35 @@
+'''
+test_ranges.py
+
+Byte ranges of ranged downloads and uploads.
+'''
+
+import pytest
+
+from sfp.ranges import parseByteRange, splitRange
+
+__author__ = 'Giulio Corradini'
+
+
+def test_download_range_is_clamped():
+    assert parseByteRange(['8', '10'], 12) == (8, 4)
+    assert parseByteRange(['8'], 12) == (8, 4)
+
+
+def test_upload_range_past_the_file_is_refused():
+    assert parseByteRange(['8', '4'], 12, clamp=False) == (8, 4)
+    with pytest.raises(ValueError):
+        parseByteRange(['8', '10'], 12, clamp=False)
+
+
+@pytest.mark.parametrize('fields', [['-1'], ['0', '-1'], ['13'], [], ['1', '2', '3'], ['a']])
+def test_invalid_range_is_refused(fields):
+    with pytest.raises(ValueError):
+        parseByteRange(fields, 12)
+
+
+def test_split_range_covers_the_file():
+    ranges = splitRange(10 * 1048576 + 1, 4)
+    assert ranges[0][0] == 0
+    assert sum(count for _, count in ranges) == 10 * 1048576 + 1
+    assert all(offset + count == following for (offset, count), (following, _) in zip(ranges, ranges[1:]))
@@ -0,0 +1,60 @@
+'''
+test_serving.py
+
+Driver code shared by the servers.
+'''
+
+import io
+
+import pytest
+
+from sfp.protocol import ServerContext, ServerSession, Send, Disk, SendFile, TruncatedFileError
+from sfp.compression import FRAME_HEADER, parseFrameHeader, decodeBlock
+from sfp.serving import CHUNK_SIZE, fileFrames
+
+__author__ = 'Giulio Corradini'
+
+
+def namedFile(data: bytes, name: str = 'a.txt') -> io.BytesIO:
+    fd = io.BytesIO(data)
+    fd.name = name
+    return fd
+
+
+def test_file_frames_are_chunks():
+    data = bytes(range(256)) * 1000
+    frames = list(fileFrames(namedFile(data), 10, len(data) - 20))
+    assert b''.join(frames) == data[10:-10]
+    assert max(map(len, frames)) == CHUNK_SIZE
+
+
+def test_compressed_file_frames():
+    data = b'abc' * 100000
+    stream = b''.join(fileFrames(namedFile(data), 0, len(data), compression='zlib'))
+    assert len(stream) < len(data)
+    received = b''
+    while stream:
+        flag, length = parseFrameHeader(stream[:FRAME_HEADER.size])
+        received += decodeBlock('zlib', flag, stream[FRAME_HEADER.size:FRAME_HEADER.size + length])
+        stream = stream[FRAME_HEADER.size + length:]
+    assert received == data
+
+
+def test_truncated_file_frames():
+    with pytest.raises(TruncatedFileError):
+        list(fileFrames(namedFile(b'hello'), 2, 5))
+
+
+def test_only_filesystem_errors_are_answered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    session = ServerSession(ServerContext())
+    session.nextAction()
+    session.receiveData(b'alice\nL 20201019\n')
+    assert isinstance(session.nextAction(), Disk)   # Creating the user's directory
+    assert isinstance(session.nextAction(), Send)
+    listing = session.nextAction()
+    assert isinstance(listing, Disk)
+    assert session.actionFailed(listing, PermissionError()) == Send(b'ERROR\n')
+
+    with pytest.raises(ConnectionResetError):   # Lost with the connection
+        session.actionFailed(SendFile(0, 5, None, None), ConnectionResetError())
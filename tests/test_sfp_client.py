@@ -0,0 +1,28 @@
+'''
+test_sfp_client.py
+
+The threaded client, talking to a socket pair.
+'''
+
+import os
+import socket
+import importlib.util
+
+from test_drivers import ROOT
+
+__author__ = 'Giulio Corradini'
+
+spec = importlib.util.spec_from_file_location('sfp_client', os.path.join(ROOT, 'students_file_transfer/sfp_client.py'))
+client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(client)
+
+
+def test_text_command_without_payload():
+    local, server = socket.socketpair()
+    with server, client.SFPClientHandler(fileno=local.detach()) as sock:
+        server.sendall(b'GOODBYE\n')
+        assert sock.sendTextCommand('Q') == 'GOODBYE\n'
+        assert server.recv(100) == b'Q\n'
+        server.sendall(b'a.txt\n')
+        assert sock.sendTextCommand('L', '20201019') == 'a.txt\n'
+        assert server.recv(100) == b'L 20201019\n'
@@ -0,0 +1,92 @@
+'''
+test_uploads.py
+
+Staging of uploads: ranges of parallel uploads and their commit.
+'''
+
+import os
+
+from sfp.uploads import PARTIAL_DIRECTORY, partialPath, rangesPath, openPartial, partialSize, beginRanges, \
+    recordRange, commitUpload
+
+__author__ = 'Giulio Corradini'
+
+PAYLOAD = b'abcdefghijkl'   # 12 bytes, uploaded as ranges (0, 6) and (6, 6)
+
+
+def writeRange(directory, offset: int, data: bytes) -> None:
+    with openPartial(directory, 'f.txt', offset) as fd:
+        fd.write(data)
+
+
+def uploadRanges(directory, ranges) -> list:
+    '''
+    Receives ranges of PAYLOAD like a connection of a parallel upload does.
+    :return: what recordRange returned for each of them
+    '''
+    completed = []
+    for offset, count in ranges:
+        beginRanges(directory, 'f.txt', len(PAYLOAD))
+        writeRange(directory, offset, PAYLOAD[offset:offset + count])
+        completed.append(recordRange(directory, 'f.txt', offset, count, len(PAYLOAD)))
+    return completed
+
+
+def leaveStaleUpload(directory, ranges_text: str, size: int = 20) -> None:
+    with open(partialPath(directory, 'f.txt'), 'wb') as fd:
+        fd.write(b'x' * size)
+    with open(rangesPath(directory, 'f.txt'), 'w') as fd:
+        fd.write(ranges_text)
+
+
+def test_parallel_upload_commits_once_complete(tmp_path):
+    assert uploadRanges(tmp_path, [(6, 6), (0, 6)]) == [False, True]
+    commitUpload(tmp_path, 'f.txt', len(PAYLOAD))
+    assert (tmp_path / 'f.txt').read_bytes() == PAYLOAD
+    assert not os.path.exists(rangesPath(tmp_path, 'f.txt'))
+
+
+def test_stale_ranges_of_another_size_are_discarded(tmp_path):
+    leaveStaleUpload(tmp_path, "size 20\n0 10\n")
+    assert uploadRanges(tmp_path, [(6, 6)]) == [False]  # (0, 10) belonged to the 20 bytes upload
+    assert uploadRanges(tmp_path, [(0, 6)]) == [True]
+    commitUpload(tmp_path, 'f.txt', len(PAYLOAD))
+    assert (tmp_path / 'f.txt').read_bytes() == PAYLOAD
+
+
+def test_ranges_without_size_are_discarded(tmp_path):
+    leaveStaleUpload(tmp_path, "0 10\n")
+    assert uploadRanges(tmp_path, [(6, 6), (0, 6)]) == [False, True]
+
+
+def test_ranges_past_the_file_size_are_ignored(tmp_path):
+    leaveStaleUpload(tmp_path, "size 12\n0 20\n", size=12)
+    assert uploadRanges(tmp_path, [(6, 6)]) == [False]
+
+
+def test_commit_cuts_the_partial_file_to_size(tmp_path):
+    leaveStaleUpload(tmp_path, "", size=20)
+    with openPartial(tmp_path, 'f.txt') as fd:
+        fd.write(PAYLOAD)
+    commitUpload(tmp_path, 'f.txt', len(PAYLOAD))
+    assert (tmp_path / 'f.txt').read_bytes() == PAYLOAD
+    assert os.listdir(tmp_path / PARTIAL_DIRECTORY) == []
+
+
+def test_partial_size_of_parallel_upload(tmp_path):
+    uploadRanges(tmp_path, [(0, 6)])
+    assert partialSize(tmp_path, 'f.txt', len(PAYLOAD)) == 6
+    assert partialSize(tmp_path, 'f.txt', 20) == 0     # Not the same upload, start over
+
+
+def test_ranges_with_a_gap_are_not_committed(tmp_path):
+    assert uploadRanges(tmp_path, [(0, 3), (6, 6)]) == [False, False]
+    assert partialSize(tmp_path, 'f.txt', len(PAYLOAD)) == 3
+    assert uploadRanges(tmp_path, [(2, 4)]) == [True]   # Overlapping ranges merge
+
+
+def test_torn_range_lines_are_skipped(tmp_path):
+    uploadRanges(tmp_path, [(0, 6)])
+    with open(rangesPath(tmp_path, 'f.txt'), 'a') as fd:
+        fd.write("6\n")     # Left by a crash in the middle of an append
+    assert uploadRanges(tmp_path, [(6, 6)]) == [True]
@@ -31,6 +31,7 @@ Reference: UNIX Network Programming - Third Edition - Vol I Chapter 6
 
 __author__ = "Giulio Corradini"
 
+import os
 import sys
 import socket
 import logging
@@ -40,13 +41,20 @@ import select
 from collections import defaultdict
 from typing import Dict
 
-def main(host, port):
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sockutil.buffer import SocketBuffer
+from sockutil.profiling import Profiler
+
+def main(host, port, profile_dir='.'):
     '''
     Front desk. Manages the registration of clients.
     WITHOUT using threads.
     :param host: host to bind the listening socket to
     :param port: port to listen on
+    :param profile_dir: where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written
     '''
+    Profiler(profile_dir).installSignals()
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as fds:
         fds.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)   # For debug purposes on UNIX
@@ -54,7 +62,7 @@ def main(host, port):
         fds.listen(5)
 
         active = [fds]
-        buffers: Dict[socket.socket, bytearray] = defaultdict(bytearray)
+        buffers: Dict[socket.socket, SocketBuffer] = defaultdict(SocketBuffer)
 
         logging.info("Started server")
 
@@ -69,24 +77,21 @@ def main(host, port):
                         logging.info("A new client connected with address {}".format(addr))
 
                     else:
-                        data = sock.recv(4096)
-                        if not data:
+                        if not buffers[sock].recvFrom(sock):
+                            logging.warning("{} disconnected".format(sock.getpeername()))
                             active.remove(sock)
+                            buffers.pop(sock)
                             sock.close()
-                            logging.warning("{} disconnected".format(sock.getpeername()))
-                        else:
-                            buffers[sock] += data
 
                 for sock in writable:
                     response = buffers.get(sock)
                     if response:    # Available response [bytes] to send
-                        sent = sock.send(response)
+                        sent = response.sendTo(sock)  # Sent bytes are consumed from the buffer
                         if sent == 0:   # Socket closed by other end
+                            logging.warning("{} disconnected".format(sock.getpeername()))
                             sock.close()
                             active.remove(sock)
-                            logging.warning("{} disconnected".format(sock.getpeername()))
-                        else:
-                            del response[:sent] # Remove sent bytes from bytearray
+                            buffers.pop(sock)
 
             except KeyboardInterrupt:
                 for sock in active:
@@ -102,6 +107,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--address", "-a", default='', required=False, metavar="address")
     parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    parser.add_argument("--profile-dir", default='.', required=False, metavar="directory",
+                        help="where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written")
 
     args = parser.parse_args(sys.argv[1:])
-    main(args.address, args.port)
\ No newline at end of file
+    main(args.address, args.port, args.profile_dir)
\ No newline at end of file
@@ -11,6 +11,7 @@ Fashion: select
 
 __author__ = 'Giulio Corradini'
 
+import os
 import sys
 import argparse
 import logging
@@ -19,6 +20,11 @@ from select import select
 from typing import Set
 import threading
 
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sockutil.buffer import SocketBuffer
+from sockutil.profiling import Profiler
+
 quit_on_idle = False
 closing = False
 
@@ -31,8 +37,8 @@ class ClientSession(socket.socket):
         self.session_count = ClientSession.session_count + 1
         ClientSession.session_count += 1
 
-        self.write_buffer = bytearray()
-        self.read_buffer = bytearray()
+        self.write_buffer = SocketBuffer()
+        self.read_buffer = SocketBuffer()
 
         logging.info(f"{self.getpeername()} connected as client #{self.session_count}")
 
@@ -56,28 +62,28 @@ class ClientSession(socket.socket):
             return "Not recognized."
 
     def processData(self):
-        command = self.read_buffer[:1].decode()
-        del self.read_buffer[:1]
+        command = self.read_buffer.consume(1).decode()
         response = self.processCommand(command) + '\n'
         self.sendall(response.encode())
 
         return
 
-    def recv(self, bufsize: int, flags: int = 0) -> bytes:
-        data = super().recv(bufsize, flags)
-        self.read_buffer += data
-        return data
+    def recvData(self, bufsize: int = 1024) -> int:
+        '''
+        Receives available data into read_buffer.
+        :return: number of received bytes, 0 if the client closed the connection
+        '''
+        return self.read_buffer.recvFrom(self, bufsize)
 
     def sendall(self, data: bytes, flags: int = ...) -> None:
-        self.write_buffer += data
+        self.write_buffer.append(data)
 
     def flushWriteBuffer(self) -> int:
-        sent = super().send(self.write_buffer)
-        del self.write_buffer[:sent]
-        return sent
+        return self.write_buffer.sendTo(self)
 
-def main(host, port):
+def main(host, port, profile_dir='.'):
     global closing
+    Profiler(profile_dir).installSignals()  # SIGUSR1 profiles, SIGUSR2 dumps stacks
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
@@ -104,8 +110,8 @@ def main(host, port):
                         active_clients.append(ClientSession(conn))
 
                     else:
-                        data = r.recv(1024)
-                        if not data: closed_clients.add(r)
+                        received = r.recvData()
+                        if not received: closed_clients.add(r)
                         else:
                             while r.read_buffer:
                                 r.processData() # Process all available data
@@ -131,6 +137,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--address", "-a", default='', required=False, metavar="address")
     parser.add_argument("--port", "-p", type=int, default=9999, required=False, metavar="port")
+    parser.add_argument("--profile-dir", default='.', required=False, metavar="directory",
+                        help="where profiles (SIGUSR1) and stack dumps (SIGUSR2) are written")
 
     args = parser.parse_args(sys.argv[1:])
-    main(args.address, args.port)
\ No newline at end of file
+    main(args.address, args.port, args.profile_dir)
\ No newline at end of file
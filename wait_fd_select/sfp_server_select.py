@@ -0,0 +1,279 @@
+'''
+sfp_server_select.py
+
+Students File Protocol server implementation.
+Using non-blocking IO model and select, in a single thread.
+
+Protocol is defined in README.md of students_file_transfer, and
+implemented by sfp/protocol.py: this server only drives the sessions,
+moving bytes between sockets and sessions when select says it won't block.
+
+Filesystem calls run inline, so a slow disk stalls every client: the
+asyncio server is the one to pick for that. Downloads are sent a chunk at a
+time, when the client's socket is writable, so a slow client never holds
+more than a chunk of its download in memory, and plain downloads are
+zero-copy with os.sendfile. Bandwidth shaping and transfer limits, which
+need a thread or a task to wait, aren't available.
+'''
+
+__author__ = 'Giulio Corradini'
+
+import os
+import sys
+import time
+import socket
+import select
+import logging
+import argparse
+from typing import Set
+
+# Shared modules live in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sockutil.buffer import SocketBuffer
+from sockutil.logqueue import addLoggingOptions, configureFromOptions
+from sfp.protocol import ServerSession, NeedData, Send, Disk, OpenFile, Write, Decode, SendFile, CloseFile, \
+    Profile, Close, TruncatedFileError, request_log
+from sfp.compression import decodeBlock
+from sfp.serving import CHUNK_SIZE, context, profiler, addServerOptions, configureServer, fileFrames
+
+WRITE_BUFFER_HIGH = 262144  # Queued responses that stop a client's session until it reads them
+
+
+class SFPConnection:
+    def __init__(self, sock: socket.socket):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Responses are coalesced in write_buffer
+        self.sock = sock
+        self.peer = sock.getpeername()
+
+        self.write_buffer = SocketBuffer()
+        self.stats = context.metrics.openSession()
+        self.session = ServerSession(context, self.stats)
+        self.action = self.session.nextAction()     # Next action of the session, waiting to be performed
+
+        self.file = None        # File of the running transfer
+        self.download = None    # Generator sending the running download, a step each time the socket is writable
+        self.capture_end = None     # Monotonic time when the running P capture ends
+        self.closed = False
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def wantsRead(self) -> bool:
+        return isinstance(self.action, NeedData) and not self.closed
+
+    def wantsWrite(self) -> bool:
+        return bool(self.write_buffer) or self.download is not None
+
+    def onReadable(self) -> None:
+        try:
+            data = self.sock.recv(CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        self.stats.received += len(data)
+        self.session.receiveData(data)
+        self.action = self.session.nextAction()
+        self.run()
+
+    def onWritable(self) -> None:
+        self.flush()
+        if self.download is not None and not self.write_buffer:
+            try:
+                next(self.download)
+            except StopIteration:
+                self.download = None
+                self.action = self.session.nextAction()
+        self.run()
+
+    def onCaptureEnd(self) -> None:
+        self.capture_end = None
+        self.action = self.session.nextAction(profiler.stopCapture())
+        self.run()
+
+    def run(self) -> None:
+        '''
+        Performs the actions of the session until one has to wait for the client, or for a capture.
+        '''
+        while not self.closed and self.download is None and self.capture_end is None:
+            if isinstance(self.action, NeedData):
+                self.flush()    # No more pipelined commands, answer the previous ones
+                return
+            if isinstance(self.action, Close):
+                self.flush()
+                if not self.write_buffer:
+                    self.close()
+                return
+            if len(self.write_buffer) >= WRITE_BUFFER_HIGH:
+                return  # Until the client reads its responses
+
+            try:
+                result = self.perform(self.action)
+            except (ValueError, RuntimeError, OSError) as e:    # Refused, e.g. an invalid frame, or a disk error
+                self.action = self.session.actionFailed(self.action, e)
+                continue
+            if self.download is None and self.capture_end is None:
+                self.action = self.session.nextAction(result)
+
+    def perform(self, action):
+        '''
+        Performs an action of the session, see sfp/protocol.py.
+        Downloads and profiling captures only start here, the session resumes once they end.
+        :return: its result, for the actions that have one
+        '''
+        if isinstance(action, Send):
+            self.write_buffer.append(action.data)
+        elif isinstance(action, Disk):
+            return action.call()
+        elif isinstance(action, Write):
+            self.file.write(action.data)
+            if action.digest: action.digest.update(action.data)
+        elif isinstance(action, Decode):
+            return decodeBlock(action.method, action.flag, action.block)
+        elif isinstance(action, OpenFile):
+            self.file = action.call()
+        elif isinstance(action, SendFile):
+            if action.count:
+                self.download = self.sendFromFile(self.file, action.offset, action.count, action.digest,
+                                                  action.compression)
+        elif isinstance(action, CloseFile):
+            if self.file:   # None if it didn't open
+                self.file.close()
+            self.file = None
+        elif isinstance(action, Profile):
+            if action.seconds is None:
+                return profiler.dumpStacks()
+            self.capture_end = time.monotonic() + profiler.startCapture(action.seconds)
+
+    def sendFromFile(self, fd, offset, n, digest=None, compression=None):
+        '''
+        Sends n bytes of fd starting from offset, a step each time the socket is writable.
+        Plain downloads go with os.sendfile, the others one chunk (or frame) at a time,
+        updating digest with every chunk on the way.
+        '''
+        if not (digest or compression) and hasattr(os, 'sendfile'):
+            while n > 0:
+                try:
+                    sent = os.sendfile(self.sock.fileno(), fd.fileno(), offset, n)
+                except BlockingIOError:
+                    sent = None
+                if sent == 0:
+                    raise TruncatedFileError(f"{fd.name} is shorter than {offset + n} bytes")
+                if sent:
+                    self.stats.sent += sent
+                    offset += sent
+                    n -= sent
+                yield
+            return
+
+        for frame in fileFrames(fd, offset, n, digest, compression):
+            self.write_buffer.append(frame)
+            yield
+
+    def flush(self) -> None:
+        '''
+        Sends as many queued bytes as the socket accepts without blocking.
+        '''
+        try:
+            while self.write_buffer:
+                self.stats.sent += self.write_buffer.sendTo(self.sock)
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.file:
+            self.file.close()
+        if self.capture_end is not None:    # Nobody is waiting for its report anymore
+            profiler.stopCapture()
+        context.metrics.closeSession(self.stats)
+        self.sock.close()
+        request_log.info("%s disconnected", self.peer)
+
+
+def main(host, port, blobs=None, metrics_port=None, admin_users=(), profile_dir=None, profile_seconds=None):
+    '''
+    Front desk. Manages the registration of clients.
+    WITHOUT using threads.
+    :param host: host to bind the listening socket to
+    :param port: port to listen on
+    :param blobs: directory of the deduplicating blob store, None to disable it
+    :param metrics_port: local port of the Prometheus endpoint, None to disable it
+    :param admin_users: users allowed to run admin commands, e.g. S
+    :param profile_dir: directory of profiling reports, the working directory by default
+    :param profile_seconds: length of the captures started by SIGUSR1
+    '''
+    configureServer(blobs, metrics_port, admin_users, profile_dir, profile_seconds)
+    profiler.installSignals()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as fds:
+        fds.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)   # For debug purposes on UNIX
+        fds.bind((host, port))
+        fds.listen(128)
+        fds.setblocking(False)
+
+        connections: Set[SFPConnection] = set()
+
+        logging.info(f"Starting server on port {port}")
+
+        while True:
+            try:
+                readers = [fds] + [conn for conn in connections if conn.wantsRead()]
+                writers = [conn for conn in connections if conn.wantsWrite()]
+                captures = [conn.capture_end for conn in connections if conn.capture_end is not None]
+                timeout = max(0.0, min(captures) - time.monotonic()) if captures else None
+
+                readable, writable, _ = select.select(readers, writers, [], timeout)
+                for conn in readable:
+                    if conn is fds:
+                        try:
+                            sock, addr = fds.accept()
+                        except BlockingIOError:
+                            continue
+                        connections.add(SFPConnection(sock))
+                        request_log.info("A new client connected with address %s", addr)
+                        continue
+                    try:
+                        conn.onReadable()
+                    except OSError as e:
+                        request_log.info("%s: %s", conn.peer, e)
+                        conn.close()
+                    except Exception:   # Only this client's session is lost
+                        logging.exception(f"{conn.peer} failed")
+                        conn.close()
+
+                for conn in writable:
+                    try:
+                        if not conn.closed:
+                            conn.onWritable()
+                    except OSError as e:
+                        request_log.info("%s: %s", conn.peer, e)
+                        conn.close()
+                    except Exception:
+                        logging.exception(f"{conn.peer} failed")
+                        conn.close()
+
+                now = time.monotonic()
+                for conn in connections:
+                    if conn.capture_end is not None and conn.capture_end <= now and not conn.closed:
+                        conn.onCaptureEnd()
+
+                connections = {conn for conn in connections if not conn.closed}
+
+            except KeyboardInterrupt:
+                for conn in connections:
+                    conn.close()
+                break
+
+    logging.info("Goodbye")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    addServerOptions(parser, shaping=False)
+    addLoggingOptions(parser)
+
+    args = parser.parse_args(sys.argv[1:])
+    configureFromOptions(args, "%(asctime)s\t%(levelname)s\t%(message)s", request_log)
+    main(args.address, args.port, args.blobs, args.metrics_port, args.admin, args.profile_dir, args.profile_seconds)